@@ -0,0 +1,56 @@
+# Модель документа без Tk: построение, вставки, удаления и поиск строк
+# в таблице фрагментов на большом тексте.
+#
+#   python benchmarks/bench_model.py [мегабайт]
+import random
+import sys
+import time
+
+from common import load_editor, make_text, summary, timed
+
+OPERATIONS = 20000
+
+
+def bench(mip, size_mb):
+    text = make_text(size_mb * 1024 * 1024)
+    started = time.perf_counter()
+    model = mip.DocumentModel(text)
+    print(f"построение {size_mb} МБ: {(time.perf_counter() - started) * 1000:.1f} мс, строк: {model.line_count}")
+
+    rng = random.Random(1)
+    cursor = [(model.line_count // 2, 0)]
+
+    def random_position():
+        return rng.randint(1, model.line_count - 1), rng.randint(0, 40)
+
+    def insert_char():
+        model.insert(random_position(), "x")
+
+    def type_char():
+        line, column = cursor[0]
+        model.insert((line, column), "y")
+        cursor[0] = (line, column + 1)
+
+    def delete_word():
+        line, column = random_position()
+        model.delete((line, column), (line, column + 5))
+
+    def get_line():
+        line = rng.randint(1, model.line_count - 1)
+        model.get((line, 0), (line + 1, 0))
+
+    results = {
+        "insert": timed(insert_char, OPERATIONS),
+        "typing": timed(type_char, OPERATIONS),
+        "delete": timed(delete_word, OPERATIONS),
+        "line_lookup": timed(lambda: model.offset(random_position()), OPERATIONS),
+        "get_line": timed(get_line, OPERATIONS),
+        "full_text": timed(model.get, 5),
+    }
+    for name, samples in results.items():
+        stats = summary(samples)
+        print(f"{name:>12}  mean: {stats['mean_us']:9.1f} us  p50: {stats['p50_us']:9.1f} us  p95: {stats['p95_us']:9.1f} us")
+
+
+if __name__ == "__main__":
+    bench(load_editor(), int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,86 @@
+# Сохранение и загрузка документа .mip: 10 МБ текста и 100k отрезков стилей.
+#
+#   python benchmarks/bench_richtext.py
+#
+# С DISPLAY замеряется полный цикл через TextEditor (dump и tag add),
+# без него - кодирование, разбор и расчет позиций.
+import os
+import random
+import tempfile
+import time
+
+from common import enter_workdir, has_display, load_editor, make_text
+
+SIZE = 10 * 1024 * 1024
+RUNS = 100000
+STYLES = [
+    {"font": ["Ubuntu Mono", 12, "bold"]},
+    {"font": ["Ubuntu Mono", 12, "italic"], "foreground": "#ff0000"},
+    {"background": "#00ff00"},
+    {"font": ["Ubuntu Mono", 14, "underline"]},
+]
+
+
+def make_document():
+    rng = random.Random(7)
+    text = make_text(SIZE)
+    step = len(text) // RUNS
+    runs = []
+    for _ in range(RUNS):
+        runs.extend((step, rng.randrange(-1, len(STYLES))))
+    runs[-2] += len(text) - step * RUNS
+    return text, runs
+
+
+def report(label, started):
+    print(f"{label:<32} {(time.perf_counter() - started) * 1000:8.1f} ms")
+
+
+def bench_model(mip):
+    text, runs = make_document()
+
+    started = time.perf_counter()
+    data = mip.encode_rich_document(text, STYLES, runs)
+    report("encode", started)
+
+    started = time.perf_counter()
+    text, styles, runs = mip.decode_rich_document(data)
+    spans = mip.rich_spans(text, runs)
+    index = mip.StyleRuns()
+    for start, end, style in spans:
+        index.append(start, end, style)
+    report(f"decode + {len(spans)} spans", started)
+
+
+def bench_widget(mip):
+    import tkinter as tk
+    root = tk.Tk()
+    root.withdraw()
+    enter_workdir()
+    editor = mip.TextEditor(root)
+    text, runs = make_document()
+    path = os.path.join(tempfile.mkdtemp(), "bench" + mip.RICH_EXTENSION)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(mip.encode_rich_document(text, STYLES, runs))
+
+    started = time.perf_counter()
+    editor.open_rich_file(path)
+    report("open_rich_file", started)
+
+    started = time.perf_counter()
+    data = mip.encode_rich_document(*editor.rich_document_snapshot())
+    report("dump + encode", started)
+
+    started = time.perf_counter()
+    editor.saver.write(path, data)
+    report("write", started)
+    root.destroy()
+
+
+if __name__ == "__main__":
+    mip = load_editor()
+    if has_display():
+        bench_widget(mip)
+    else:
+        print("DISPLAY не задан: замеряется только формат без виджета")
+        bench_model(mip)
@@ -0,0 +1,55 @@
+# Стоимость обновления строки состояния на одно нажатие клавиши
+# в зависимости от размера документа.
+#
+#   python benchmarks/bench_status.py
+#
+# С DISPLAY замеряется настоящий TextEditor (полное сканирование против
+# дельт), без него - только модель DocumentStats.
+from common import enter_workdir, has_display, load_editor, make_text, summary, timed
+
+SIZES_MB = [1, 5, 20, 50]
+KEYSTROKES = 200
+
+
+def bench_widget(mip):
+    import tkinter as tk
+    root = tk.Tk()
+    root.withdraw()
+    enter_workdir()
+    editor = mip.TextEditor(root)
+    text_area = editor.text_area
+    for size in SIZES_MB:
+        text_area.delete(1.0, tk.END)
+        text_area.insert(1.0, make_text(size * 1024 * 1024))
+        editor.update_status()
+
+        def full_scan():
+            text_area.insert(tk.INSERT, "a")
+            len(text_area.get(1.0, tk.END)) - 1
+
+        def incremental():
+            text_area.insert(tk.INSERT, "a")
+            editor.update_status()
+
+        old = summary(timed(full_scan, KEYSTROKES // 10))
+        new = summary(timed(incremental, KEYSTROKES))
+        print(f"{size:>4} MB  full scan p50 {old['p50_us']:>10.0f} us   "
+              f"incremental p50 {new['p50_us']:>8.0f} us")
+    root.destroy()
+
+
+def bench_model(mip):
+    for size in SIZES_MB:
+        stats = mip.DocumentStats()
+        stats.recount(make_text(size * 1024 * 1024))
+        result = summary(timed(lambda: stats.on_edit("insert", "1.0", "a"), KEYSTROKES))
+        print(f"{size:>4} MB  incremental p50 {result['p50_us']:>8.2f} us")
+
+
+if __name__ == "__main__":
+    mip = load_editor()
+    if has_display():
+        bench_widget(mip)
+    else:
+        print("DISPLAY не задан: замеряется только модель DocumentStats")
+        bench_model(mip)
@@ -0,0 +1,66 @@
+# Число тегов Tk и время перерисовки после 10k операций форматирования.
+#
+#   python benchmarks/bench_tags.py
+#
+# Нужен настоящий Tk: без DISPLAY поднимается Xvfb, а если его нет,
+# замер пропускается.
+import random
+import sys
+import time
+
+from common import enter_workdir, has_display, load_editor, make_text, start_xvfb
+
+OPERATIONS = 10000
+REPORT_EVERY = 2000
+COLORS = ["#ff0000", "#00ff00", "#0000ff", "#ffff00", "#00ffff", "#ff00ff"]
+
+
+def random_operation(rng):
+    kind = rng.choice(["bold", "italic", "underline", "fg", "bg"])
+    return kind, rng.choice(COLORS)
+
+
+def bench_widget(mip):
+    import tkinter as tk
+    rng = random.Random(1)
+    root = tk.Tk()
+    root.withdraw()
+    enter_workdir()
+    editor = mip.TextEditor(root)
+    text_area = editor.text_area
+    text_area.insert(1.0, make_text(2 * 1024 * 1024))
+    lines = int(text_area.index("end-1c").split('.')[0])
+
+    for step in range(1, OPERATIONS + 1):
+        line = rng.randint(1, lines - 1)
+        start = f"{line}.{rng.randint(0, 40)}"
+        text_area.tag_remove(tk.SEL, 1.0, tk.END)
+        text_area.tag_add(tk.SEL, start, f"{start}+{rng.randint(1, 200)}c")
+        kind, color = random_operation(rng)
+        if kind == "fg":
+            editor.apply_text_color(color)
+        elif kind == "bg":
+            editor.apply_bg_color(color)
+        else:
+            editor.apply_formatting(kind)
+
+        if step % REPORT_EVERY == 0:
+            editor.collect_tags()
+            started = time.perf_counter()
+            text_area.insert(1.0, "x")
+            text_area.update_idletasks()
+            redraw = (time.perf_counter() - started) * 1000
+            print(f"{step:>6} ops  tags: {len(text_area.tag_names()):>4}  redraw: {redraw:7.2f} ms")
+    root.destroy()
+
+
+if __name__ == "__main__":
+    xvfb = None if has_display() else start_xvfb()
+    if not has_display():
+        print("DISPLAY не задан и Xvfb не найден: замер тегов пропущен")
+        sys.exit(0)
+    try:
+        bench_widget(load_editor())
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
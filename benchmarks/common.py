@@ -0,0 +1,101 @@
+import importlib.util
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EDITOR_PATH = os.path.join(ROOT, "madeinpython1.0.py")
+
+
+def load_editor():
+    # Имя файла с точкой не импортируется обычным import
+    spec = importlib.util.spec_from_file_location("madeinpython", EDITOR_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def enter_workdir():
+    # Настройки и журнал редактора пишутся в текущую папку - уводим их из
+    # репозитория, иначе оставшийся журнал остановит запуск на askyesno
+    workdir = tempfile.mkdtemp(prefix="mip-run-")
+    os.chdir(workdir)
+    return workdir
+
+
+def has_display():
+    return bool(os.environ.get("DISPLAY"))
+
+
+def make_text(size_bytes, line_length=80):
+    line = ("lorem ipsum dolor sit amet " * 4)[:line_length - 1] + "\n"
+    return line * (size_bytes // len(line))
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summary(samples):
+    ordered = sorted(samples)
+    return {
+        "mean_us": statistics.mean(ordered) * 1e6,
+        "p50_us": ordered[len(ordered) // 2] * 1e6,
+        "p95_us": ordered[int(len(ordered) * 0.95) - 1] * 1e6,
+    }
+
+
+def percentiles(samples):
+    # Сводка в миллисекундах для JSON-отчета
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.mean(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": pick(0.5),
+        "p90_ms": pick(0.9),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def start_xvfb(display=":99"):
+    # Виртуальный X-сервер для прогона с настоящим Tk; None, если Xvfb нет
+    executable = shutil.which("Xvfb")
+    if executable is None:
+        return None
+    process = subprocess.Popen([executable, display, "-screen", "0", "1280x1024x24", "-nolisten", "tcp"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        if os.path.exists(f"/tmp/.X11-unix/X{display.lstrip(':')}"):
+            os.environ["DISPLAY"] = display
+            return process
+        if process.poll() is not None:
+            return None
+        time.sleep(0.1)
+    process.terminate()
+    return None
+
+
+def ensure_file(directory, size_mb):
+    # Тестовые файлы создаются один раз и переиспользуются между прогонами
+    path = os.path.join(directory, f"bench_{size_mb}mb.txt")
+    size = size_mb * 1024 * 1024
+    if not os.path.exists(path) or os.path.getsize(path) < size * 0.99:
+        block = make_text(1024 * 1024)
+        with open(path, "w", encoding="utf-8") as file:
+            for _ in range(size_mb):
+                file.write(block)
+    return path
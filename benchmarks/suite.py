@@ -0,0 +1,428 @@
+# Набор замеров горячих путей редактора с JSON-отчетом и сравнением
+# с сохраненной базой.
+#
+#   python benchmarks/suite.py --output results.json
+#   python benchmarks/suite.py --baseline results.json --threshold 0.2
+#
+# С DISPLAY (или с Xvfb, который запускается сам) замеряется настоящий
+# TextEditor. Без дисплея те же сценарии прогоняются на части редактора,
+# не требующей Tk (модель документа, декодер загрузки, фоновая запись),
+# и отчет помечается режимом "headless" - сравнивать его можно только
+# с базой того же режима.
+import argparse
+import codecs
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import (ROOT, ensure_file, enter_workdir, has_display, load_editor, make_text, percentiles,
+                    start_xvfb)
+
+KEYSTROKES = 2000
+FORMAT_RUNS = 10000
+FORMAT_SAMPLES = 200
+PASTE_MB = 10
+GUTTER_LINES = 1000000
+GUTTER_SAMPLES = 200
+STARTUP_RUNS = 5
+PUMP_TIMEOUT_S = 600
+
+
+def pump(root, done, timeout=PUMP_TIMEOUT_S):
+    # Крутит цикл событий Tk, пока не выполнится условие
+    deadline = time.perf_counter() + timeout
+    while not done():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("сценарий не завершился вовремя")
+        root.update()
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class WidgetSuite:
+    # Сценарии на настоящем TextEditor
+    mode = "tk"
+
+    def __init__(self, mip):
+        import tkinter as tk
+        self.tk = tk
+        self.mip = mip
+        self.root = tk.Tk()
+        self.root.withdraw()
+        self.editor = mip.TextEditor(self.root)
+
+    def close(self):
+        self.editor.saver.flush()
+        self.editor.journal.close()
+        self.root.destroy()
+
+    def open_file(self, path):
+        editor = self.editor
+        # Повторное открытие того же файла иначе просто переключит вкладку
+        for document in list(editor.documents):
+            if document.path == path:
+                editor.close_document(document)
+        self.mip.filedialog.askopenfilename = lambda **kwargs: path
+        started = time.perf_counter()
+        editor.open_file()
+        opened = time.perf_counter() - started
+        if editor.large_view is not None:
+            pump(self.root, lambda: editor.large_view.index.done)
+        else:
+            pump(self.root, lambda: editor.loader is None)
+        return opened, time.perf_counter() - started
+
+    def save_file(self):
+        editor = self.editor
+        if editor.large_view is not None:
+            return None
+        started = time.perf_counter()
+        editor.save_file()
+        blocked = time.perf_counter() - started
+        pump(self.root, lambda: editor.save_job is None and not editor.saver.busy)
+        return blocked, time.perf_counter() - started
+
+    def keystrokes(self):
+        editor = self.editor
+        editor.new_file()
+        editor.text_area.insert(1.0, make_text(1024 * 1024))
+        editor.text_area.mark_set(self.tk.INSERT, "500.10")
+        status = []
+        total = []
+        for _ in range(KEYSTROKES):
+            started = time.perf_counter()
+            editor.text_area.insert(self.tk.INSERT, "a")
+            middle = time.perf_counter()
+            editor.update_status()
+            finished = time.perf_counter()
+            status.append(finished - middle)
+            total.append(finished - started)
+        return status, total
+
+    def formatting(self):
+        editor = self.editor
+        text_area = editor.text_area
+        editor.new_file()
+        text_area.insert(1.0, make_text(2 * 1024 * 1024))
+        # Документ с FORMAT_RUNS отрезками стилей
+        rng = random.Random(1)
+        lines = int(text_area.index("end-1c").split('.')[0]) - 1
+        for run in range(FORMAT_RUNS):
+            line = 1 + run * (lines - 1) // FORMAT_RUNS
+            text_area.tag_remove(self.tk.SEL, 1.0, self.tk.END)
+            text_area.tag_add(self.tk.SEL, f"{line}.0", f"{line}.20")
+            editor.apply_text_color(rng.choice(["#ff0000", "#00ff00", "#0000ff"]))
+        samples = []
+        for _ in range(FORMAT_SAMPLES):
+            line = rng.randint(1, lines - 200)
+            text_area.tag_remove(self.tk.SEL, 1.0, self.tk.END)
+            text_area.tag_add(self.tk.SEL, f"{line}.5", f"{line + rng.randint(1, 200)}.30")
+            started = time.perf_counter()
+            editor.apply_formatting(rng.choice(["bold", "italic", "underline"]))
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    def gutter(self):
+        # Перерисовка номеров строк после прокрутки в произвольное место
+        # документа в GUTTER_LINES строк, часть строк помечена измененными
+        editor = self.editor
+        text_area = editor.text_area
+        editor.new_file()
+        text_area.insert(1.0, "строка\n" * GUTTER_LINES)
+        rng = random.Random(1)
+        for _ in range(1000):
+            text_area.insert(f"{rng.randint(1, GUTTER_LINES)}.0", "правка\n")
+        editor.show_line_numbers = True
+        self.root.update_idletasks()
+        samples = []
+        for _ in range(GUTTER_SAMPLES):
+            text_area.yview(f"{rng.randint(1, GUTTER_LINES)}.0")
+            started = time.perf_counter()
+            editor.refresh_gutter()
+            samples.append(time.perf_counter() - started)
+        if not editor.gutter.canvas.find_all():
+            raise RuntimeError("полоса номеров строк ничего не нарисовала")
+        return samples
+
+    def paste(self):
+        editor = self.editor
+        editor.new_file()
+        text = make_text(PASTE_MB * 1024 * 1024)
+        self.root.clipboard_clear()
+        self.root.clipboard_append(text)
+        started = time.perf_counter()
+        editor.paste_text()
+        blocked = time.perf_counter() - started
+        pump(self.root, lambda: editor.doc_stats.char_count >= len(text))
+        return blocked, time.perf_counter() - started
+
+
+class HeadlessSuite:
+    # Те же сценарии без Tk: загрузка через тот же декодер в модель
+    # документа, запись через BackgroundSaver, индекс стилей
+    mode = "headless"
+
+    def __init__(self, mip):
+        self.mip = mip
+        self.model = mip.DocumentModel()
+        self.stats = mip.DocumentStats()
+        self.saver = mip.BackgroundSaver()
+        self.directory = tempfile.mkdtemp(prefix="mip-save-")
+
+    def close(self):
+        self.saver.flush()
+
+    def open_file(self, path):
+        mip = self.mip
+        started = time.perf_counter()
+        if os.path.getsize(path) >= mip.LARGE_FILE_THRESHOLD:
+            import mmap
+            with open(path, "rb") as file:
+                mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                index = mip.LineIndex(mm)
+                index.start()
+                opened = time.perf_counter() - started
+                while not index.done:
+                    time.sleep(0.01)
+                elapsed = time.perf_counter() - started
+                index.cancel()
+                mm.close()
+            self.model = None
+            return opened, elapsed
+
+        self.model = model = mip.DocumentModel()
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(), translate=True)
+        opened = None
+        with open(path, "rb") as file:
+            size = mip.LOAD_FIRST_CHUNK
+            while True:
+                data = file.read(size)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    model.insert(model.position(model.char_count), text)
+                if opened is None:
+                    opened = time.perf_counter() - started
+                if not data:
+                    break
+                size = mip.LOAD_CHUNK_SIZE
+        return opened, time.perf_counter() - started
+
+    def save_file(self):
+        if self.model is None:
+            return None
+        started = time.perf_counter()
+        content = self.model.get() + "\n"
+        self.saver.submit(os.path.join(self.directory, "saved.txt"), content, "")
+        blocked = time.perf_counter() - started
+        self.saver.flush()
+        self.saver.results.get()
+        return blocked, time.perf_counter() - started
+
+    def keystrokes(self):
+        model = self.mip.DocumentModel(make_text(1024 * 1024))
+        stats = self.mip.DocumentStats()
+        stats.recount(model.get())
+        line, column = 500, 10
+        status = []
+        total = []
+        for _ in range(KEYSTROKES):
+            started = time.perf_counter()
+            model.insert((line, column), "a")
+            middle = time.perf_counter()
+            stats.on_edit("insert", f"{line}.{column}", "a")
+            column += 1
+            finished = time.perf_counter()
+            status.append(finished - middle)
+            total.append(finished - started)
+        return status, total
+
+    def formatting(self):
+        model = self.mip.DocumentModel(make_text(2 * 1024 * 1024))
+        runs = model.styles
+        rng = random.Random(1)
+        lines = model.line_count - 1
+        for run in range(FORMAT_RUNS):
+            line = 1 + run * (lines - 1) // FORMAT_RUNS
+            runs.assign((line, 0), (line, 20), f"tag{run % 3}")
+        samples = []
+        for _ in range(FORMAT_SAMPLES):
+            line = rng.randint(1, lines - 200)
+            start, end = (line, 5), (line + rng.randint(1, 200), 30)
+            started = time.perf_counter()
+            for run_start, run_end, tag in runs.segments(start, end):
+                runs.assign(run_start, run_end, f"{tag}_b")
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    def gutter(self):
+        # Без Tk перерисовку не замерить - замеряется сдвиг меток измененных
+        # строк при вставке перевода строки в середину документа
+        changes = self.mip.ChangedLines()
+        rng = random.Random(1)
+        for _ in range(1000):
+            line = rng.randint(1, GUTTER_LINES)
+            changes.mark(line, line + 1)
+        samples = []
+        for _ in range(GUTTER_SAMPLES):
+            started = time.perf_counter()
+            changes.on_edit("insert", f"{rng.randint(1, GUTTER_LINES)}.0", "\n")
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    def paste(self):
+        model = self.mip.DocumentModel()
+        text = make_text(PASTE_MB * 1024 * 1024)
+        started = time.perf_counter()
+        model.insert((1, 0), text)
+        elapsed = time.perf_counter() - started
+        return elapsed, elapsed
+
+
+def startup_samples(headless):
+    # Холодный старт - отдельный процесс на каждый замер
+    samples = []
+    for _ in range(STARTUP_RUNS):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-probe"]
+                       + (["--headless"] if headless else []), check=True, cwd=os.getcwd())
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def startup_probe(headless):
+    mip = load_editor()
+    if headless:
+        return
+    import tkinter as tk
+    root = tk.Tk()
+    editor = mip.TextEditor(root)
+    root.update()
+    editor.journal.close()
+    root.destroy()
+
+
+def run(suite, sizes, directory, repeat):
+    results = {}
+
+    def record(name, samples):
+        if samples:
+            results[name] = percentiles(samples)
+            print(f"{name:>24}  p50: {results[name]['p50_ms']:10.2f} ms  p90: {results[name]['p90_ms']:10.2f} ms")
+
+    for size_mb in sizes:
+        path = ensure_file(directory, size_mb)
+        opens = [suite.open_file(path) for _ in range(repeat)]
+        record(f"open_{size_mb}mb_first_paint", [opened for opened, loaded in opens])
+        record(f"open_{size_mb}mb_total", [loaded for opened, loaded in opens])
+        saves = [suite.save_file() for _ in range(repeat)]
+        if None in saves:
+            print(f"{'save_' + str(size_mb) + 'mb':>24}  пропущено: файл открыт только для чтения")
+        else:
+            record(f"save_{size_mb}mb_blocking", [blocked for blocked, saved in saves])
+            record(f"save_{size_mb}mb_total", [saved for blocked, saved in saves])
+
+    status, total = suite.keystrokes()
+    record("keystroke_update_status", status)
+    record("keystroke_total", total)
+    record("apply_formatting_10k_runs", suite.formatting())
+    record("gutter_redraw" if suite.mode == "tk" else "gutter_changes_newline", suite.gutter())
+    pastes = [suite.paste() for _ in range(repeat)]
+    record(f"paste_{PASTE_MB}mb_blocking", [blocked for blocked, pasted in pastes])
+    record(f"paste_{PASTE_MB}mb_total", [pasted for blocked, pasted in pastes])
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Регрессия - рост медианы больше чем на threshold относительно базы
+    regressions = []
+    if baseline["meta"].get("mode") != results["meta"]["mode"]:
+        print(f"Внимание: база снята в режиме {baseline['meta'].get('mode')}, текущий прогон - {results['meta']['mode']}")
+    for name, current in sorted(results["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:>24}  нет в базе")
+            continue
+        ratio = current["p50_ms"] / max(base["p50_ms"], 1e-6)
+        flag = "РЕГРЕССИЯ" if ratio > 1 + threshold else ""
+        print(f"{name:>24}  база: {base['p50_ms']:10.2f} ms  сейчас: {current['p50_ms']:10.2f} ms  x{ratio:5.2f}  {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности редактора")
+    parser.add_argument("--sizes", default="1,100,1024", help="размеры файлов в МБ через запятую")
+    parser.add_argument("--output", help="куда записать JSON с результатами")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимый рост медианы (0.2 = 20%%)")
+    parser.add_argument("--repeat", type=int, default=3, help="повторы открытия, сохранения и вставки")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "mip-bench"))
+    parser.add_argument("--headless", action="store_true", help="не запускать Tk даже при наличии дисплея")
+    parser.add_argument("--startup-probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_probe:
+        startup_probe(args.headless)
+        return 0
+
+    xvfb = None
+    if not args.headless and not has_display():
+        xvfb = start_xvfb()
+    headless = args.headless or not has_display()
+    os.makedirs(args.data_dir, exist_ok=True)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    enter_workdir()
+    mip = load_editor()
+    suite = HeadlessSuite(mip) if headless else WidgetSuite(mip)
+    print(f"Режим: {suite.mode}")
+    try:
+        results = run(suite, sizes, args.data_dir, max(1, args.repeat))
+    finally:
+        suite.close()
+    results["cold_startup"] = percentiles(startup_samples(headless))
+    print(f"{'cold_startup':>24}  p50: {results['cold_startup']['p50_ms']:10.2f} ms")
+    if xvfb is not None:
+        xvfb.terminate()
+
+    report = {
+        "meta": {
+            "mode": suite.mode,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "sizes_mb": sizes,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,3299 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, font, colorchooser
+from tkinter import filedialog, messagebox, font, colorchooser, simpledialog
 import os
+import sys
+import io
+import re
 import json
-from collections import defaultdict
+import random
+import mmap
+import time
+import queue
+import codecs
+import keyword
+import shutil
+import tempfile
+import subprocess
+import threading
+import functools
+import argparse
+import fnmatch
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Панель статистики: опрос фонового подсчета и скорость чтения (слов в минуту)
+STATS_POLL_MS = 100
+READING_WPM = 180
+
+# Профилирование: включается из меню «Сервис» или переменной окружения,
+# по каждой операции хранятся последние PROFILE_RING_SIZE замеров
+PROFILE_ENV = "MIP_PROFILE"
+PROFILE_RING_SIZE = 1024
+PROFILE_OVERLAY_MS = 500
+PROFILE_OVERLAY_ROWS = 20
+
+# Обновления интерфейса сводятся к одному проходу за кадр (~60 Гц);
+# что не уложилось в бюджет прохода, переносится на следующий кадр
+FRAME_MS = 16
+REFRESH_BUDGET_MS = 10
+
+# Полоса номеров строк: отступы номеров и ширина метки измененной строки
+GUTTER_PADDING = 8
+GUTTER_MARKER_WIDTH = 3
+
+# Потоковое открытие файлов: первая часть меньше, чтобы первый экран
+# появлялся сразу, дальше - крупными частями по одной за такт after
+LOAD_FIRST_CHUNK = 64 * 1024
+LOAD_CHUNK_SIZE = 1024 * 1024
+
+# Слежение за растущим файлом (журналом): один os.stat за интервал опроса,
+# дописанное дочитывается частями по одной за такт after
+FOLLOW_POLL_MS = 500
+FOLLOW_CHUNK_SIZE = 256 * 1024
+
+# Кодировка и переводы строк определяются по BOM и образцу начала файла;
+# текст не в UTF-8 и без BOM считается cp1251. Формат текста документа -
+# (кодировка, BOM, перевод строки), при сохранении он пишется обратно
+ENCODING_SAMPLE_SIZE = 64 * 1024
+FALLBACK_ENCODING = "cp1251"
+DEFAULT_TEXT_FORMAT = ("utf-8", b"", "\n")
+NEWLINE_NAMES = {"\n": "LF", "\r\n": "CRLF", "\r": "CR"}
+SAVE_CHUNK_SIZE = 1024 * 1024
+
+# Файлы больше порога открываются в режиме просмотра только для чтения
+LARGE_FILE_THRESHOLD = 256 * 1024 * 1024
+# Индекс хранит смещение каждой LINE_INDEX_STRIDE-й строки
+LINE_INDEX_STRIDE = 256
+LINE_INDEX_WINDOW = 8 * 1024 * 1024
+# Запас строк над и под видимой областью и предел длины показываемой строки
+LARGE_VIEW_MARGIN = 50
+LARGE_VIEW_LINE_LIMIT = 4096
+INDEX_POLL_MS = 200
+# Длинные строки: с первого порога (в байтах) перенос по словам отключается,
+# со второго файл открывается в окне просмотра, где от каждой строки
+# показывается только отрезок LARGE_VIEW_LINE_LIMIT вокруг курсора
+LONG_LINE_WRAP_LIMIT = 10 * 1024
+LONG_LINE_LIMIT = 1024 * 1024
+
+# Политика fsync при сохранении: "none" - без fsync, "file" - fsync
+# временного файла перед заменой, "full" - еще и fsync каталога после замены
+FSYNC_POLICIES = ("none", "file", "full")
+SAVE_POLL_MS = 50
+
+# Пакетный режим: наибольшее число файлов в одной пересылке процессу пула
+BATCH_MAX_CHUNK = 32
+# Замена в пакетном режиме идет потоком: совпадение вместе с проверками
+# вокруг него должно укладываться в это число символов
+BATCH_MATCH_LIMIT = 64 * 1024
+
+# Период сборщика тегов форматирования, у которых не осталось диапазонов
+TAG_GC_INTERVAL_MS = 2000
+
+# Собственный формат документа с форматированием: строка-сигнатура,
+# JSON-заголовок с таблицей стилей и RLE-отрезками, затем сам текст
+RICH_EXTENSION = ".mip"
+RICH_MAGIC = "MIPDOC 1\n"
+# Экспорт в HTML и RTF пишется на диск частями такого размера (в символах)
+EXPORT_CHUNK_SIZE = 256 * 1024
+
+# Список шрифтов хранится в кэше на диске. Кэш устаревает, когда меняется
+# время изменения каталогов шрифтов или кэша fontconfig (fc-cache после
+# установки шрифтов), и тогда обновляется в фоне
+FONT_CACHE_FILE = "text_editor_fonts.json"
+FONT_DIRS = ("/usr/share/fonts", "/usr/local/share/fonts", "~/.local/share/fonts", "~/.fonts",
+             "/etc/fonts", "/var/cache/fontconfig", "~/.cache/fontconfig",
+             "/Library/Fonts", "/System/Library/Fonts", "~/Library/Fonts",
+             os.path.join(os.environ.get("WINDIR", "C:\\Windows"), "Fonts"))
+FONT_POLL_MS = 100
+FONT_PREVIEW_TEXT = "АаБб Aa Bb 0123"
+FONT_PREVIEW_SIZE = 11
+
+# Журнал правок для восстановления после сбоя: сбрасывается на диск
+# фоновым потоком, при превышении размера сжимается в снимок документа.
+# У каждого процесса свой журнал и своя блокировка рядом с ним: журнал со
+# свободной блокировкой остался от процесса, завершившегося со сбоем
+JOURNAL_FILE = "text_editor_journal.{pid}.mipj"
+JOURNAL_PATTERN = "text_editor_journal.*.mipj"
+JOURNAL_LOCK_SUFFIX = ".lock"
+JOURNAL_FLUSH_MS = 1000
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024
+
+# Поиск: совпадения приходят из фонового потока пачками, за один такт
+# в виджет добавляется не больше SEARCH_TICK_LIMIT подсветок
+SEARCH_DELAY_MS = 150
+SEARCH_POLL_MS = 30
+SEARCH_BATCH = 2000
+SEARCH_TICK_LIMIT = 20000
+# До этого числа замен правки идут по совпадениям, дальше - одной заменой
+# участка от первого до последнего совпадения с восстановлением стилей
+REPLACE_INLINE_LIMIT = 10000
+
+# Вставка из буфера обмена длиннее порога идет частями по одной за такт after
+PASTE_CHUNK_THRESHOLD = 1024 * 1024
+PASTE_CHUNK_SIZE = 256 * 1024
+PASTE_MARK = "paste_point"
+
+# Таблица фрагментов: шаг разреженного индекса переводов строк и предельный
+# размер одного буфера добавлений
+PIECE_BLOCK = 4096
+PIECE_ADD_LIMIT = 64 * 1024
+
+# История отмены: бюджет памяти по умолчанию, оценка накладных расходов
+# на одну запись и предел склейки посимвольного ввода
+UNDO_BUDGET_MB = 64
+UNDO_RECORD_OVERHEAD = 96
+UNDO_COALESCE_LIMIT = 256
+
+# Подсветка синтаксиса: бюджет одного такта и размеры порций строк
+HIGHLIGHT_BUDGET_MS = 8
+HIGHLIGHT_CHUNK = 200
+HIGHLIGHT_DIRTY_CHUNK = 50
+SYNTAX_COLORS = {
+    "keyword": "#f57900",
+    "constant": "#729fcf",
+    "string": "#8ae234",
+    "comment": "#888a85",
+    "number": "#ad7fa8",
+    "name": "#fce94f",
+    "decorator": "#ad7fa8",
+    "key": "#729fcf",
+    "section": "#fce94f",
+}
+
+# Tcl-обертка над командой виджета: insert/delete/replace сообщаются в Python
+# до и после выполнения, остальные команды проходят напрямую
+EDIT_PROXY_PROC = """
+proc %(widget)s args {
+    switch -exact -- [lindex $args 0] {
+        insert - delete - replace {
+            %(before)s {*}$args
+            set code [catch {%(orig)s {*}$args} result options]
+            %(after)s $code
+            return -options $options $result
+        }
+    }
+    %(orig)s {*}$args
+}
+"""
+
+
+class EditInterceptor:
+    # Перехватывает правки виджета Text (с клавиатуры, из кода и из undo)
+    # и раздает слушателям дельты: (kind, index, text), kind - insert/delete/reset
+    def __init__(self, widget):
+        self.widget = widget
+        self.listeners = []
+        self.pending = []
+        self.orig = widget._w + "_orig"
+        self.tk.call("rename", widget._w, self.orig)
+        self.tk.eval(EDIT_PROXY_PROC % {
+            "widget": widget._w,
+            "orig": self.orig,
+            "before": widget.register(self._before),
+            "after": widget.register(self._after),
+        })
+        widget.bind("<Destroy>", self._on_destroy, add="+")
+
+    @property
+    def tk(self):
+        # Берется при каждом вызове: профилировщик подменяет tk виджета
+        return self.widget.tk
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def call(self, *args):
+        # Прямой вызов исходной команды виджета, минуя перехват
+        return self.tk.call((self.orig,) + args)
+
+    def _index(self, index):
+        return str(self.call("index", index))
+
+    def _clamp(self, index):
+        # Последний перевод строки виджета нельзя ни удалить, ни вставить за ним
+        last = self._index("end-1c")
+        if self.tk.getboolean(self.call("compare", index, ">", last)):
+            return last
+        return index
+
+    def _before(self, operation, *args):
+        try:
+            self.pending.append(self._describe(operation, args))
+        except (tk.TclError, IndexError):
+            self.pending.append(None)
+
+    def _describe(self, operation, args):
+        if str(self.call("cget", "-state")) == tk.DISABLED:
+            return None
+        if operation == "insert":
+            index = self._clamp(self._index(args[0]))
+            return [("insert", index, "".join(args[1::2]))]
+        if operation == "delete":
+            if len(args) > 2:
+                return [("reset", None, "")]
+            return self._describe_delete(args[0], args[1] if len(args) > 1 else None)
+        if operation == "replace":
+            events = self._describe_delete(args[0], args[1])
+            return events + [("insert", self._index(args[0]), "".join(args[2::2]))]
+        return None
+
+    def _describe_delete(self, first, last):
+        first = self._index(first)
+        if last is None:
+            last = self._index(first + "+1c")
+        last = self._clamp(self._index(last))
+        if not self.tk.getboolean(self.call("compare", first, "<", last)):
+            return []
+        return [("delete", first, str(self.call("get", first, last)))]
+
+    def _after(self, code):
+        events = self.pending.pop() if self.pending else None
+        if code != "0" or not events:
+            return
+        for kind, index, text in events:
+            for listener in list(self.listeners):
+                listener(kind, index, text)
+
+    def _on_destroy(self, event):
+        if event.widget is self.widget:
+            self.listeners = []
+
+
+class DocumentStats:
+    # Счетчики символов и строк, обновляемые по дельтам правок, без полного
+    # копирования документа. char_count совпадает с len(get(1.0, END)) - 1
+    def __init__(self):
+        self.char_count = 0
+        self.line_count = 1
+        # Символы вне BMP: Tk считает их двумя символами, Python - одним
+        self.astral_count = 0
+        self.stale = False
+
+    @staticmethod
+    def _astral(text):
+        return len(text.encode("utf-16-le", "surrogatepass")) // 2 - len(text)
+
+    def recount(self, text):
+        # text - содержимое без завершающего перевода строки виджета
+        self.char_count = len(text)
+        self.line_count = text.count("\n") + 1
+        self.astral_count = self._astral(text)
+        self.stale = False
+
+    def on_edit(self, kind, index, text):
+        if kind == "reset":
+            self.stale = True
+            return
+        sign = 1 if kind == "insert" else -1
+        self.char_count += sign * len(text)
+        self.line_count += sign * text.count("\n")
+        if not text.isascii():
+            self.astral_count += sign * self._astral(text)
+
+    def selection_count(self, text_widget):
+        try:
+            if not text_widget.tag_ranges(tk.SEL):
+                return 0
+            if self.astral_count:
+                return len(text_widget.get(tk.SEL_FIRST, tk.SEL_LAST))
+            return int(text_widget.tk.call(text_widget._w, "count", "-chars",
+                                           tk.SEL_FIRST, tk.SEL_LAST))
+        except tk.TclError:
+            return 0
+
+
+class TextStatistics:
+    # Слова, строки, абзацы и средняя длина строки. Фоновый поток хранит по
+    # каждой строке число символов и слов, главный поток только отмечает
+    # отрезок правленых строк и присылает их текст, поэтому пересчитываются
+    # лишь изменившиеся строки. Абзац - непустая строка после пустой
+    def __init__(self, model):
+        self.model = model
+        # Отрезок правленых строк [first, last) в текущей нумерации;
+        # в нем на delta строк больше, чем в копии потока
+        self.first = None
+        self.last = None
+        self.delta = 0
+        self.full = True
+        self.commands = queue.Queue()
+        self.result = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    @property
+    def dirty(self):
+        return self.full or self.first is not None
+    
+    @property
+    def busy(self):
+        return self.commands.unfinished_tasks > 0
+    
+    def on_edit(self, kind, index, text):
+        if kind == "reset":
+            self.full = True
+            self.first = None
+            return
+        line = parse_index(index)[0] - 1
+        count = text.count("\n")
+        if kind == "insert":
+            first, last, delta = line, line + count + 1, count
+            if self.first is not None:
+                shifted = self.last + count if self.last > line else self.last
+                first, last, delta = min(self.first, line), max(shifted, last), self.delta + count
+        else:
+            first, last, delta = line, line + 1, -count
+            if self.first is not None:
+                if self.last > line + count:
+                    shifted = self.last - count
+                else:
+                    shifted = min(self.last, line + 1)
+                first, last, delta = min(self.first, line), max(shifted, last), self.delta - count
+        self.first, self.last, self.delta = first, last, delta
+    
+    def flush(self):
+        # Текст правленых строк уходит в поток; стоимость пропорциональна правке
+        if self.full:
+            command = (0, None, self.model.get())
+        elif self.first is not None:
+            command = (self.first, self.last - self.first - self.delta,
+                       self.model.line_text(self.first, self.last))
+        else:
+            return
+        self.full = False
+        self.first = None
+        self.delta = 0
+        self.commands.put(command)
+    
+    def _run(self):
+        self.chars = array('I', [0])
+        self.words = array('I', [0])
+        self.char_total = 0
+        self.word_total = 0
+        self.nonblank = 0
+        self.paragraphs = 0
+        while True:
+            start, old, text = self.commands.get()
+            self.apply(start, len(self.words) if old is None else old, text)
+            if self.commands.qsize() == 0:
+                self.result = (len(self.words), self.char_total, self.word_total,
+                               self.nonblank, self.paragraphs)
+            self.commands.task_done()
+    
+    def apply(self, start, old, text):
+        lines = text.split("\n")
+        chars = array('I', map(len, lines))
+        words = array('I', map(len, map(str.split, lines)))
+        end = start + old
+        removed = self.words[start:end]
+        self.char_total += sum(chars) - sum(self.chars[start:end])
+        self.word_total += sum(words) - sum(removed)
+        self.nonblank += len(words) - words.count(0) - (len(removed) - removed.count(0))
+        self.paragraphs -= self.paragraph_starts(start, min(end + 1, len(self.words)))
+        self.chars[start:end] = chars
+        self.words[start:end] = words
+        self.paragraphs += self.paragraph_starts(start, min(start + len(words) + 1, len(self.words)))
+    
+    def paragraph_starts(self, first, last):
+        count = 0
+        previous = self.words[first - 1] if first > 0 else 0
+        for current in self.words[first:last]:
+            if current and not previous:
+                count += 1
+            previous = current
+        return count
+
+
+class ChangedLines:
+    # Строки, измененные после сохранения, - непересекающиеся отрезки
+    # [start, end) в текущей нумерации. Правка сдвигает отрезки ниже себя
+    # на разницу переводов строк и отмечает строки, которых коснулась
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+    
+    def __bool__(self):
+        return bool(self.starts)
+    
+    def clear(self):
+        self.starts = []
+        self.ends = []
+    
+    def __contains__(self, line):
+        index = bisect_right(self.starts, line) - 1
+        return index >= 0 and line < self.ends[index]
+    
+    def mark(self, first, last):
+        # Пересекающиеся и смежные отрезки сливаются
+        i = bisect_left(self.ends, first)
+        j = bisect_right(self.starts, last)
+        if i < j:
+            first = min(first, self.starts[i])
+            last = max(last, self.ends[j - 1])
+        self.starts[i:j] = [first]
+        self.ends[i:j] = [last]
+    
+    def remap(self, line, removed, added):
+        # Строки line+1..line+removed слиты со строкой line, после нее
+        # вставлено added новых; затронутые строки - line..line+added
+        # Отрезки за удаленными строками просто сдвигаются, без переводов
+        # строк в правке (обычный набор текста) сдвига нет вовсе
+        i = bisect_right(self.ends, line)
+        j = bisect_right(self.starts, line + removed)
+        delta = added - removed
+        starts = []
+        ends = []
+        for start, end in zip(self.starts[i:j], self.ends[i:j]):
+            if start > line:
+                start = max(start - removed, line + 1) + added
+            end = max(end - removed, line + 1) + added
+            if start < end:
+                starts.append(start)
+                ends.append(end)
+        self.starts[i:j] = starts
+        self.ends[i:j] = ends
+        if delta:
+            k = i + len(starts)
+            self.starts[k:] = [start + delta for start in self.starts[k:]]
+            self.ends[k:] = [end + delta for end in self.ends[k:]]
+        self.mark(line, line + added + 1)
+    
+    def on_edit(self, kind, index, text):
+        if kind == "reset":
+            self.mark(1, sys.maxsize)
+            return
+        line = int(index.split('.')[0])
+        if kind == "insert":
+            self.remap(line, 0, text.count("\n"))
+        else:
+            self.remap(line, text.count("\n"), 0)
+
+
+class RefreshScheduler:
+    # Обработчики событий только помечают области интерфейса грязными, а
+    # один проход за кадр обновляет каждую из них один раз, в порядке
+    # регистрации. Остаток после исчерпания бюджета ждет следующего кадра
+    def __init__(self, root, budget_ms=REFRESH_BUDGET_MS):
+        self.root = root
+        self.budget = budget_ms / 1000
+        self.regions = {}
+        self.dirty = set()
+        self.job = None
+    
+    def add_region(self, name, callback):
+        self.regions[name] = callback
+    
+    def mark(self, *names):
+        self.dirty.update(names)
+        if self.job is None:
+            self.job = self.root.after(FRAME_MS, self.run)
+    
+    def discard(self, name):
+        self.dirty.discard(name)
+    
+    def cancel(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+        self.dirty.clear()
+    
+    def run(self):
+        self.job = None
+        deadline = time.perf_counter() + self.budget
+        try:
+            for name, callback in self.regions.items():
+                if name not in self.dirty:
+                    continue
+                if time.perf_counter() >= deadline:
+                    break
+                self.dirty.discard(name)
+                callback()
+        finally:
+            # Области, помеченные во время прохода, тоже ждут следующего кадра
+            if self.dirty and self.job is None:
+                self.job = self.root.after(FRAME_MS, self.run)
+
+
+# UTF-32 проверяется раньше UTF-16: их BOM начинаются одинаково
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+
+
+def sniff_encoding(sample, final):
+    # В UTF-16 без BOM пробелы, цифры и переводы строк дают нулевые байты
+    # на одной четности; в однобайтовых кодировках и UTF-8 нулей нет
+    if sample.count(0):
+        even = sample[0::2].count(0)
+        odd = sample[1::2].count(0)
+        if odd > even * 4:
+            return "utf-16-le"
+        if even > odd * 4:
+            return "utf-16-be"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=final)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+
+
+def detect_newline(text):
+    crlf = text.count("\r\n")
+    lf = text.count("\n") - crlf
+    cr = text.count("\r") - crlf
+    if crlf > lf and crlf >= cr:
+        return "\r\n"
+    if cr > lf:
+        return "\r"
+    return "\n"
+
+
+def detect_text_format(path):
+    # Читается только образец начала файла, поэтому стоимость не зависит
+    # от размера; сам файл потом декодируется один раз при загрузке
+    with open(path, "rb") as file:
+        sample = file.read(ENCODING_SAMPLE_SIZE)
+    final = len(sample) < ENCODING_SAMPLE_SIZE
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            break
+    else:
+        bom = b""
+        encoding = sniff_encoding(sample, final)
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    return encoding, bom, detect_newline(decoder.decode(sample[len(bom):], final=final))
+
+
+def text_format_label(text_format):
+    encoding, bom, newline = text_format
+    return f"{encoding.upper()}{' BOM' if bom else ''} {NEWLINE_NAMES[newline]}"
+
+
+def is_wide_encoding(encoding):
+    # В UTF-16/32 байт \n не означает перевод строки
+    return encoding.startswith(("utf-16", "utf-32"))
+
+
+class FileLoader:
+    # Читает файл частями через инкрементальный декодер (многобайтовые
+    # символы и \r\n на стыке частей не разрываются) и вставляет их в
+    # виджет из after-срезов, чтобы окно оставалось отзывчивым
+    def __init__(self, root, text_area, path, on_progress, on_finish, encoding="utf-8", skip=0):
+        self.root = root
+        self.text_area = text_area
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.total = max(os.path.getsize(path) - skip, 1)
+        self.loaded = 0
+        self.chunk_size = LOAD_FIRST_CHUNK
+        self.decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(encoding)(), translate=True)
+        self.file = open(path, "rb")
+        self.file.seek(skip)
+        stat = os.fstat(self.file.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.offset = skip
+        self.job = None
+    
+    def start(self):
+        self.job = self.root.after(0, self._step)
+    
+    def cancel(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+        self.file.close()
+    
+    def _step(self):
+        self.job = None
+        try:
+            data = self.file.read(self.chunk_size)
+            text = self.decoder.decode(data, final=not data)
+        except Exception as e:
+            self.file.close()
+            self.on_finish(e)
+            return
+        
+        self.loaded += len(data)
+        self.offset += len(data)
+        if text:
+            self.text_area.configure(state=tk.NORMAL)
+            self.text_area.insert(tk.END, text)
+            self.text_area.configure(state=tk.DISABLED)
+        
+        if not data:
+            self.file.close()
+            self.on_finish(None)
+            return
+        
+        self.on_progress(self.loaded * 100 // self.total)
+        self.chunk_size = LOAD_CHUNK_SIZE
+        self.job = self.root.after(1, self._step)
+
+
+class FileFollower:
+    # Дочитывает файл, который дописывается другим процессом. Раз в
+    # FOLLOW_POLL_MS - один os.stat: если вырос размер, читаются только
+    # новые байты (частями, без stat между ними); если сменился inode
+    # (ротация) или размер стал меньше прочитанного (усечение), файл
+    # открывается заново и читается с начала
+    def __init__(self, root, path, on_data, on_reset, on_missing, encoding="utf-8", skip=0, offset=0, identity=None):
+        self.root = root
+        self.path = path
+        self.on_data = on_data
+        self.on_reset = on_reset
+        self.on_missing = on_missing
+        self.encoding = encoding
+        self.skip = skip
+        self.offset = offset
+        self.identity = identity
+        self.size = offset
+        self.missing = False
+        self.file = None
+        self.decoder = None
+        self.job = None
+    
+    @property
+    def position(self):
+        # Байты неполного символа на конце еще не попали в текст
+        if self.decoder is None:
+            return self.offset
+        return self.offset - len(self.decoder.getstate()[0])
+    
+    def start(self):
+        self.job = self.root.after(0, self.poll)
+    
+    def cancel(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+        self.close()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def open(self, offset):
+        self.close()
+        self.file = open(self.path, "rb")
+        stat = os.fstat(self.file.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.file.seek(offset)
+        self.offset = offset
+        self.decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(self.encoding)(errors="replace"), translate=True)
+    
+    def poll(self):
+        self.job = None
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_dev, stat.st_ino) != self.identity or stat.st_size < self.offset:
+                self.open(self.skip)
+                self.on_reset()
+            elif self.file is None:
+                self.open(self.offset)
+        except OSError:
+            # Между ротацией и созданием нового файла его может не быть
+            self.close()
+            if not self.missing:
+                self.missing = True
+                self.on_missing()
+            self.job = self.root.after(FOLLOW_POLL_MS, self.poll)
+            return
+        self.missing = False
+        self.size = stat.st_size
+        self._read()
+    
+    def _read(self):
+        self.job = None
+        try:
+            data = self.file.read(min(FOLLOW_CHUNK_SIZE, self.size - self.offset))
+        except OSError:
+            data = b""
+        self.offset += len(data)
+        text = self.decoder.decode(data)
+        if text:
+            self.on_data(text)
+        if data and self.offset < self.size:
+            self.job = self.root.after(1, self._read)
+        else:
+            self.job = self.root.after(FOLLOW_POLL_MS, self.poll)
+
+
+class PasteInserter:
+    # Вставляет длинный текст частями из after-срезов. Как и при загрузке
+    # файла, виджет на это время закрыт для ввода; flush дописывает остаток
+    # сразу, если вставку нужно завершить раньше
+    def __init__(self, root, text_area, text, on_progress, on_finish):
+        self.root = root
+        self.text_area = text_area
+        self.text = text
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.position = 0
+        self.job = None
+        text_area.mark_set(PASTE_MARK, tk.INSERT)
+        text_area.mark_gravity(PASTE_MARK, tk.RIGHT)
+        text_area.configure(state=tk.DISABLED)
+    
+    def start(self):
+        self.job = self.root.after(0, self._step)
+    
+    def cancel(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+        self.on_finish(False)
+    
+    def flush(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+        self.insert(len(self.text))
+        self.on_finish(True)
+    
+    def insert(self, end):
+        self.text_area.configure(state=tk.NORMAL)
+        self.text_area.insert(PASTE_MARK, self.text[self.position:end])
+        self.text_area.configure(state=tk.DISABLED)
+        self.position = end
+    
+    def _step(self):
+        self.job = None
+        self.insert(min(self.position + PASTE_CHUNK_SIZE, len(self.text)))
+        if self.position >= len(self.text):
+            self.on_finish(True)
+            return
+        self.on_progress(self.position * 100 // len(self.text))
+        self.job = self.root.after(1, self._step)
+
+
+def has_long_line(path, limit):
+    # rfind по окну в limit + 1 байт перескакивает сразу через все короткие
+    # строки окна, поэтому проход стоит порядка size / limit вызовов в C
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size <= limit:
+            return False
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while size - pos > limit:
+                newline = mm.rfind(b"\n", pos, pos + limit + 1)
+                if newline < 0:
+                    return True
+                pos = newline + 1
+    return False
+
+
+class LineIndex:
+    # Разреженный индекс начал строк файла, строится в фоновом потоке.
+    # Хранится только смещение каждой stride-й строки, поэтому память
+    # ограничена, а до любой строки не больше stride поисков вперед
+    def __init__(self, mm, stride=LINE_INDEX_STRIDE, encoding="utf-8"):
+        self.mm = mm
+        self.encoding = encoding
+        self.size = len(mm)
+        self.stride = stride
+        self.checkpoints = array('Q', [0])
+        self.scanned = 0
+        self.line_count = None
+        self.cancelled = False
+        self.thread = threading.Thread(target=self._build, daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def cancel(self):
+        self.cancelled = True
+        self.thread.join()
+    
+    @property
+    def done(self):
+        return self.line_count is not None
+    
+    def _build(self):
+        # Регулярное выражение пропускает stride строк за один вызов в C;
+        # окно поиска ограничено, чтобы не держать GIL на гигантских строках
+        pattern = re.compile(rb"(?:[^\n]*+\n){%d}" % self.stride)
+        mm = self.mm
+        pos = 0
+        since = 0
+        while pos < self.size:
+            if self.cancelled:
+                return
+            end = min(pos + LINE_INDEX_WINDOW, self.size)
+            if since == 0:
+                match = pattern.match(mm, pos, end)
+                if match:
+                    pos = match.end()
+                    self.checkpoints.append(pos)
+                    self.scanned = pos
+                    continue
+            newline = mm.find(b"\n", pos, end)
+            if newline < 0:
+                pos = end
+            else:
+                pos = newline + 1
+                since += 1
+                if since == self.stride:
+                    self.checkpoints.append(pos)
+                    since = 0
+            self.scanned = pos
+        self.line_count = (len(self.checkpoints) - 1) * self.stride + since + 1
+    
+    def known_lines(self):
+        if self.line_count is not None:
+            return self.line_count
+        return len(self.checkpoints) * self.stride
+    
+    def line_offset(self, line):
+        checkpoint, rest = divmod(line - 1, self.stride)
+        if line < 1 or checkpoint >= len(self.checkpoints):
+            return None
+        pos = self.checkpoints[checkpoint]
+        for _ in range(rest):
+            newline = self.mm.find(b"\n", pos)
+            if newline < 0:
+                return None
+            pos = newline + 1
+        return pos
+    
+    def read_window(self, first, count, left, limit=LARGE_VIEW_LINE_LIMIT):
+        # Отрезки строк с байта left длиной до limit и полные длины строк в байтах
+        pos = self.line_offset(first)
+        lines = []
+        lengths = []
+        while pos is not None and len(lines) < count:
+            newline = self.mm.find(b"\n", pos)
+            end = self.size if newline < 0 else newline
+            start = min(pos + left, end)
+            if self.encoding == "utf-8":
+                # Отрезок не начинается с середины многобайтового символа
+                while start < end and self.mm[start] & 0xC0 == 0x80:
+                    start += 1
+            line = self.mm[start:min(end, start + limit)].decode(self.encoding, "replace").rstrip("\r")
+            if end - start > limit:
+                line += " …"
+            lines.append(line)
+            lengths.append(end - pos)
+            if newline < 0:
+                break
+            pos = newline + 1
+        return lines, lengths
+
+
+class LargeFileView:
+    # Просмотр больших файлов только для чтения: файл отображается через mmap,
+    # в виджете находятся лишь видимые строки и запас LARGE_VIEW_MARGIN, а от
+    # длинных строк - отрезок с байта left. Колонки окна считаются в байтах
+    def __init__(self, root, text_area, path, on_change, encoding="utf-8"):
+        self.root = root
+        self.text_area = text_area
+        self.on_change = on_change
+        self.file = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        self.index = LineIndex(self.mm, encoding=encoding)
+        self.index.start()
+        
+        self.top = 1
+        self.window_start = 1
+        self.window_end = 1
+        self.left = 0
+        self.lengths = []
+        
+        self.scrollbar = tk.Scrollbar(root, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y, before=text_area)
+        self.xscrollbar = tk.Scrollbar(root, orient=tk.HORIZONTAL, command=self.on_xscrollbar)
+        self.xscrollbar.pack(fill=tk.X, after=text_area)
+        text_area.configure(wrap=tk.NONE)
+        
+        self.bindings = {
+            '<MouseWheel>': self.on_mousewheel,
+            '<Button-4>': self.on_mousewheel,
+            '<Button-5>': self.on_mousewheel,
+            '<Prior>': lambda e: self.scroll_page(-1),
+            '<Next>': lambda e: self.scroll_page(1),
+            '<Up>': lambda e: self.on_arrow(-1),
+            '<Down>': lambda e: self.on_arrow(1),
+            '<Control-Home>': lambda e: self.goto_line(1),
+            '<Control-End>': lambda e: self.goto_line(self.index.known_lines()),
+            '<Left>': lambda e: self.on_horizontal(-1),
+            '<Right>': lambda e: self.on_horizontal(1),
+            '<Home>': lambda e: self.goto_column(0),
+            '<End>': lambda e: self.goto_column(None),
+            '<Shift-MouseWheel>': self.on_shift_mousewheel,
+            '<Shift-Button-4>': self.on_shift_mousewheel,
+            '<Shift-Button-5>': self.on_shift_mousewheel,
+        }
+        for sequence, handler in self.bindings.items():
+            text_area.bind(sequence, handler)
+        
+        self.render(1)
+        self.poll_job = root.after(INDEX_POLL_MS, self.poll)
+    
+    def close(self):
+        if self.poll_job is not None:
+            self.root.after_cancel(self.poll_job)
+            self.poll_job = None
+        self.index.cancel()
+        for sequence in self.bindings:
+            self.text_area.unbind(sequence)
+        self.scrollbar.destroy()
+        self.xscrollbar.destroy()
+        self.text_area.configure(state=tk.NORMAL)
+        self.text_area.delete(1.0, tk.END)
+        self.text_area.configure(wrap=tk.WORD)
+        self.mm.close()
+        self.file.close()
+    
+    def poll(self):
+        self.update_scrollbar()
+        self.on_change()
+        if self.index.done:
+            self.poll_job = None
+        else:
+            self.poll_job = self.root.after(INDEX_POLL_MS, self.poll)
+    
+    def rows(self):
+        linespace = font_metrics(self.text_area, self.text_area.cget("font"))[0]
+        return max(1, self.text_area.winfo_height() // max(1, linespace))
+    
+    def cursor_position(self):
+        line, column = map(int, self.text_area.index(tk.INSERT).split('.'))
+        return self.window_start + line - 1, self.left + column
+    
+    def render(self, top, cursor=None):
+        rows = self.rows()
+        cursor_line, cursor_column = cursor or self.cursor_position()
+        first = max(1, top - LARGE_VIEW_MARGIN)
+        lines, self.lengths = self.index.read_window(first, rows + 2 * LARGE_VIEW_MARGIN, self.left)
+        
+        self.text_area.configure(state=tk.NORMAL)
+        self.text_area.delete(1.0, tk.END)
+        self.text_area.insert(1.0, "\n".join(lines))
+        self.text_area.configure(state=tk.DISABLED)
+        
+        self.window_start = first
+        self.window_end = first + len(lines)
+        if not first <= cursor_line < self.window_end:
+            cursor_line, cursor_column = top, self.left
+        self.text_area.mark_set(tk.INSERT, f"{cursor_line - first + 1}.{max(0, cursor_column - self.left)}")
+        self.text_area.yview(f"{top - first + 1}.0")
+        self.top = top
+        self.update_xscrollbar()
+    
+    def scroll_to(self, top):
+        rows = self.rows()
+        top = max(1, min(top, self.index.known_lines() - rows + 1))
+        if self.window_start <= top and top + rows <= self.window_end:
+            self.text_area.yview(f"{top - self.window_start + 1}.0")
+            self.top = top
+        else:
+            self.render(top)
+        self.update_scrollbar()
+        self.on_change()
+    
+    def goto_line(self, line):
+        line = max(1, min(line, self.index.known_lines()))
+        self.scroll_to(line)
+        if self.window_start <= line < self.window_end:
+            self.text_area.mark_set(tk.INSERT, f"{line - self.window_start + 1}.0")
+        self.on_change()
+        return "break"
+    
+    def update_scrollbar(self):
+        total = max(1, self.index.known_lines())
+        self.scrollbar.set((self.top - 1) / total, min(1.0, (self.top - 1 + self.rows()) / total))
+    
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == tk.MOVETO:
+            self.scroll_to(int(float(amount) * self.index.known_lines()) + 1)
+        elif unit == tk.PAGES:
+            self.scroll_to(self.top + int(amount) * self.rows())
+        else:
+            self.scroll_to(self.top + int(amount))
+    
+    def on_mousewheel(self, event):
+        if event.num == 4 or getattr(event, 'delta', 0) > 0:
+            self.scroll_to(self.top - 3)
+        else:
+            self.scroll_to(self.top + 3)
+        return "break"
+    
+    def scroll_page(self, direction):
+        self.scroll_to(self.top + direction * self.rows())
+        self.text_area.mark_set(tk.INSERT, f"{self.top - self.window_start + 1}.0")
+        self.on_change()
+        return "break"
+    
+    def on_arrow(self, direction):
+        # Курсор у края экрана сдвигает окно, дальше работает обычная привязка
+        line = self.cursor_position()[0]
+        if direction < 0 and line <= self.top:
+            self.scroll_to(self.top - 1)
+        elif direction > 0 and line >= self.top + self.rows() - 1:
+            self.scroll_to(self.top + 1)
+    
+    def on_configure(self, event=None):
+        self.render(self.top)
+        self.update_scrollbar()
+    
+    def restore(self, top, left):
+        self.left = left
+        self.render(top)
+        self.update_scrollbar()
+        self.on_change()
+    
+    def line_length(self, line):
+        if self.window_start <= line < self.window_end:
+            return self.lengths[line - self.window_start]
+        return 0
+    
+    def shift(self, left, cursor=None):
+        # Окно по горизонтали сдвигается перерисовкой, курсор остается на месте в строке
+        longest = max(self.lengths, default=0)
+        left = max(0, min(left, longest - LARGE_VIEW_LINE_LIMIT // 2))
+        if left == self.left:
+            return
+        cursor = cursor or self.cursor_position()
+        self.left = left
+        self.render(self.top, cursor)
+        self.text_area.see(tk.INSERT)
+        self.on_change()
+    
+    def on_horizontal(self, direction):
+        # У края отрезка окно сдвигается на половину, дальше работает обычная привязка
+        row, row_column = map(int, self.text_area.index(tk.INSERT).split('.'))
+        if direction < 0 and row_column == 0 and self.left > 0:
+            self.shift(self.left - LARGE_VIEW_LINE_LIMIT // 2)
+        elif direction > 0 and self.text_area.get(f"{row}.end-2c", f"{row}.end") == " …":
+            if row_column >= int(self.text_area.index(f"{row}.end").split('.')[1]) - 2:
+                self.shift(self.left + LARGE_VIEW_LINE_LIMIT // 2)
+    
+    def goto_column(self, column):
+        # Home и End на строке в десятки мегабайт переносят окно к ее началу или концу
+        line = self.cursor_position()[0]
+        if column is None:
+            column = self.line_length(line)
+        self.shift(column - LARGE_VIEW_LINE_LIMIT // 2, (line, column))
+        self.text_area.mark_set(tk.INSERT, f"{line - self.window_start + 1}.{max(0, column - self.left)}")
+        self.text_area.see(tk.INSERT)
+        self.on_change()
+        return "break"
+    
+    def update_xscrollbar(self):
+        longest = max(self.lengths, default=0)
+        if longest <= LARGE_VIEW_LINE_LIMIT:
+            self.xscrollbar.set(0, 1)
+        else:
+            self.xscrollbar.set(self.left / longest, min(1.0, (self.left + LARGE_VIEW_LINE_LIMIT) / longest))
+    
+    def on_xscrollbar(self, action, amount, unit=None):
+        if action == tk.MOVETO:
+            self.shift(int(float(amount) * max(self.lengths, default=0)))
+        elif unit == tk.PAGES:
+            self.shift(self.left + int(amount) * LARGE_VIEW_LINE_LIMIT // 2)
+        else:
+            self.shift(self.left + int(amount) * LARGE_VIEW_LINE_LIMIT // 16)
+    
+    def on_shift_mousewheel(self, event):
+        if event.num == 4 or getattr(event, 'delta', 0) > 0:
+            self.shift(self.left - LARGE_VIEW_LINE_LIMIT // 16)
+        else:
+            self.shift(self.left + LARGE_VIEW_LINE_LIMIT // 16)
+        return "break"
+
+
+class LineNumberGutter:
+    # Полоса номеров строк слева от текста. Рисуются только строки, видимые
+    # сейчас (по dlineinfo), поэтому перерисовка стоит пропорционально высоте
+    # окна, а не длине документа; вызывается она не чаще раза за кадр
+    def __init__(self, root, text_area, bg, fg, marker_color):
+        self.text_area = text_area
+        self.fg = fg
+        self.marker_color = marker_color
+        self.width = 0
+        self.canvas = tk.Canvas(root, bg=bg, bd=0, highlightthickness=0, width=1)
+    
+    def redraw(self, total, offset=0, changes=None):
+        # offset - номер строки перед первой строкой виджета (окно большого
+        # файла), changes - ChangedLines документа
+        text_area = self.text_area
+        canvas = self.canvas
+        font_spec = text_area.cget("font")
+        linespace, ascent, digit_width = font_metrics(text_area, font_spec)
+        width = len(str(total)) * digit_width + 2 * GUTTER_PADDING + GUTTER_MARKER_WIDTH
+        if width != self.width:
+            self.width = width
+            canvas.configure(width=width)
+        canvas.delete("all")
+        
+        height = text_area.winfo_height()
+        first = int(text_area.index("@0,0").split('.')[0])
+        last = int(text_area.index(f"@0,{height}").split('.')[0])
+        right = width - GUTTER_PADDING - GUTTER_MARKER_WIDTH
+        for line in range(first, last + 1):
+            # Начало строки может быть выше окна - тогда видна только метка
+            info = text_area.dlineinfo(f"{line}.0")
+            if info is not None:
+                x, y, line_width, line_height, baseline = info
+                canvas.create_text(right, y + baseline - ascent, text=str(line + offset),
+                                   anchor=tk.NE, font=font_spec, fill=self.fg)
+            if changes and line in changes:
+                top = info[1] if info is not None else 0
+                end = text_area.dlineinfo(f"{line}.end")
+                bottom = end[1] + end[3] if end is not None else height
+                canvas.create_rectangle(width - GUTTER_MARKER_WIDTH, top, width, bottom,
+                                        fill=self.marker_color, width=0)
+
+
+class BackgroundSaver:
+    # Пишет снимки текста в фоновом потоке: временный файл в той же папке,
+    # fsync по политике и os.replace поверх цели, поэтому сбой посреди записи
+    # не портит файл. Несколько сохранений подряд сводятся к последнему
+    def __init__(self, fsync_policy="file"):
+        self.fsync_policy = fsync_policy
+        self.condition = threading.Condition()
+        self.pending = None
+        self.writing = False
+        self.results = queue.Queue()
+        # umask читается один раз в главном потоке: os.umask меняет его для всего процесса
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def submit(self, path, content, message, token=None, text_format=DEFAULT_TEXT_FORMAT):
+        with self.condition:
+            self.pending = (path, content, message, token, text_format)
+            self.condition.notify()
+    
+    @property
+    def busy(self):
+        with self.condition:
+            return self.pending is not None or self.writing
+    
+    def flush(self):
+        with self.condition:
+            while self.pending is not None or self.writing:
+                self.condition.wait()
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                path, content, message, token, text_format = self.pending
+                self.pending = None
+                self.writing = True
+            try:
+                self.write(path, content, text_format)
+                self.results.put((path, message, None, token))
+            except Exception as e:
+                self.results.put((path, message, e, token))
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+    
+    def write(self, path, content, text_format=DEFAULT_TEXT_FORMAT):
+        chunks = (content[start:start + SAVE_CHUNK_SIZE] for start in range(0, len(content), SAVE_CHUNK_SIZE))
+        write_text_file(path, chunks, text_format, self.fsync_policy, self.umask)
+
+
+def read_text_chunks(path, text_format, chunk_size=LOAD_CHUNK_SIZE):
+    # Текст файла частями, с переводами строк, приведенными к \n, как при загрузке
+    encoding, bom, newline = text_format
+    decoder = io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder(encoding)(), translate=True)
+    with open(path, "rb") as file:
+        file.seek(len(bom))
+        while True:
+            data = file.read(chunk_size)
+            text = decoder.decode(data, final=not data)
+            if text:
+                yield text
+            if not data:
+                return
+
+
+def write_text_file(path, chunks, text_format=DEFAULT_TEXT_FORMAT, fsync_policy="file", umask=0o022):
+    # Временный файл в той же папке, fsync по политике и os.replace поверх
+    # цели. Части текста кодируются по одной, полная копия в байтах не создается
+    path = os.path.realpath(path)
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    encoding, bom, newline = text_format
+    encoder = codecs.getincrementalencoder(encoding)()
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(bom)
+            for chunk in chunks:
+                if newline != "\n":
+                    chunk = chunk.replace("\n", newline)
+                file.write(encoder.encode(chunk))
+            file.write(encoder.encode("", True))
+            file.flush()
+            if fsync_policy != "none":
+                os.fsync(file.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        else:
+            os.chmod(temp_path, 0o666 & ~umask)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    if fsync_policy == "full" and hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def parse_font(font_spec, family, size):
+    # Разбирает шрифт тега (список или строку Tk) на составляющие
+    weight = "normal"
+    slant = "roman"
+    underline = False
+    
+    if isinstance(font_spec, (list, tuple)):
+        family = font_spec[0] if len(font_spec) > 0 else family
+        size = font_spec[1] if len(font_spec) > 1 else size
+        if len(font_spec) > 2:
+            for style in font_spec[2:]:
+                if "bold" in str(style).lower():
+                    weight = "bold"
+                elif "italic" in str(style).lower():
+                    slant = "italic"
+                elif "underline" in str(style).lower():
+                    underline = True
+    elif isinstance(font_spec, str):
+        parts = font_spec.split()
+        if parts:
+            family = parts[0]
+            for part in parts[1:]:
+                if part.isdigit():
+                    size = int(part)
+                elif "bold" in part.lower():
+                    weight = "bold"
+                elif "italic" in part.lower():
+                    slant = "italic"
+                elif "underline" in part.lower():
+                    underline = True
+    
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        pass
+    return family, size, weight, slant, underline
+
+
+# Метрики шрифтов по описанию шрифта: (linespace, ascent, ширина "0")
+FONT_METRICS = {}
+
+
+def font_metrics(widget, font_spec):
+    # Tk меряет шрифт один раз, а не на каждый кадр прокрутки или смену шрифта
+    key = str(font_spec)
+    if key not in FONT_METRICS:
+        tk_font = font.Font(root=widget, font=font_spec)
+        FONT_METRICS[key] = (tk_font.metrics("linespace"), tk_font.metrics("ascent"), tk_font.measure("0"))
+    return FONT_METRICS[key]
+
+
+def list_font_families():
+    # Семейства из fontconfig; None - fc-list нет (Windows, macOS), и список
+    # берется у Tk в главном потоке
+    try:
+        output = subprocess.run(["fc-list", ":", "family"], capture_output=True, text=True,
+                                errors="replace", check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    families = set()
+    for line in output.splitlines():
+        # Первое из имен через запятую, без экранирования \- \, \:
+        name = re.split(r"(?<!\\),", line, 1)[0].replace("\\", "").strip()
+        if name:
+            families.add(name)
+    return sorted(families, key=str.casefold)
+
+
+class FontCatalog:
+    # Установленные семейства шрифтов. Список читается из кэша на диске;
+    # если каталоги шрифтов изменились, он обновляется в фоновом потоке,
+    # а до тех пор показывается прежний
+    def __init__(self, path):
+        self.path = path
+        self.families = []
+        self.folded = []
+        self.signature = None
+        self.refreshing = False
+        self.results = queue.Queue()
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                cache = json.load(file)
+            self.set_families(cache["families"])
+            self.signature = cache["signature"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    
+    @staticmethod
+    def current_signature():
+        signature = []
+        for directory in FONT_DIRS:
+            directory = os.path.expanduser(directory)
+            try:
+                signature.append([directory, os.stat(directory).st_mtime_ns])
+            except OSError:
+                pass
+        return signature
+    
+    @property
+    def stale(self):
+        return self.signature != self.current_signature()
+    
+    def set_families(self, families):
+        self.families = list(families)
+        self.folded = [name.casefold() for name in self.families]
+    
+    def matching(self, query):
+        query = query.strip().casefold()
+        if not query:
+            return self.families
+        return [name for name, folded in zip(self.families, self.folded) if query in folded]
+    
+    def refresh(self):
+        # True - обновление запущено, результат забирает poll
+        if self.refreshing or not self.stale:
+            return False
+        self.refreshing = True
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+    
+    def _run(self):
+        # Подпись снимается до перечисления: изменения во время него
+        # сделают кэш устаревшим при следующей проверке
+        signature = self.current_signature()
+        self.results.put((signature, list_font_families()))
+    
+    def poll(self, root):
+        # None - обновление еще идет, иначе True, если список изменился
+        try:
+            signature, families = self.results.get_nowait()
+        except queue.Empty:
+            return None
+        self.refreshing = False
+        if families is None:
+            families = sorted(set(font.families(root)), key=str.casefold)
+        changed = families != self.families
+        self.set_families(families)
+        self.signature = signature
+        try:
+            write_text_file(self.path, [json.dumps({"signature": signature, "families": families}, ensure_ascii=False)],
+                            fsync_policy="none")
+        except OSError:
+            pass
+        return changed
+
+
+def style_key(style):
+    # Канонический ключ стиля для интернирования тегов
+    if 'font' in style:
+        font_key = parse_font(style['font'], None, None)
+    else:
+        font_key = (None, None, None, None, None)
+    return font_key + (style.get('foreground'), style.get('background'))
+
+
+def parse_index(index):
+    line, column = str(index).split('.')
+    return int(line), int(column)
+
+
+def format_index(position):
+    return f"{position[0]}.{position[1]}"
+
+
+def tk_length(text):
+    # Длина в единицах индексов Tk: символы вне BMP занимают две позиции
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le", "surrogatepass")) // 2
+
+
+def text_end(position, text):
+    # Позиция сразу за text, вставленным в position
+    newlines = text.count("\n")
+    if not newlines:
+        return position[0], position[1] + tk_length(text)
+    return position[0] + newlines, tk_length(text[text.rfind("\n") + 1:])
+
+
+class StyleRuns:
+    # Индекс отрезков стилей документа: непересекающиеся [start, end) с одним
+    # тегом, отсортированные по началу. Позиции - кортежи (строка, колонка),
+    # поиск по позиции и по диапазону двоичный. Правки без переводов строк
+    # сдвигают только отрезки той же строки
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.tags = []
+    
+    def __len__(self):
+        return len(self.starts)
+    
+    def clear(self):
+        self.starts = []
+        self.ends = []
+        self.tags = []
+    
+    def tag_at(self, position):
+        i = bisect_right(self.starts, position) - 1
+        if i >= 0 and position < self.ends[i]:
+            return self.tags[i]
+        return None
+    
+    def _first_overlap(self, start):
+        i = bisect_right(self.starts, start) - 1
+        if i < 0 or self.ends[i] <= start:
+            i += 1
+        return i
+    
+    def runs(self, start, end):
+        # Отрезки, пересекающие [start, end), обрезанные по диапазону
+        result = []
+        i = self._first_overlap(start)
+        while i < len(self.starts) and self.starts[i] < end:
+            result.append((max(self.starts[i], start), min(self.ends[i], end), self.tags[i]))
+            i += 1
+        return result
+    
+    def segments(self, start, end):
+        # Полное покрытие [start, end): промежутки без стиля идут с тегом None
+        result = []
+        position = start
+        for run_start, run_end, tag in self.runs(start, end):
+            if position < run_start:
+                result.append((position, run_start, None))
+            result.append((run_start, run_end, tag))
+            position = run_end
+        if position < end:
+            result.append((position, end, None))
+        return result
+    
+    def assign(self, start, end, tag):
+        # Назначает [start, end) тег (None - снять стиль)
+        if start >= end:
+            return
+        i = self._first_overlap(start)
+        j = i
+        while j < len(self.starts) and self.starts[j] < end:
+            j += 1
+        
+        pieces = []
+        if i < j and self.starts[i] < start:
+            pieces.append((self.starts[i], start, self.tags[i]))
+        if tag is not None:
+            pieces.append((start, end, tag))
+        if i < j and self.ends[j - 1] > end:
+            pieces.append((end, self.ends[j - 1], self.tags[j - 1]))
+        
+        self.starts[i:j] = [piece[0] for piece in pieces]
+        self.ends[i:j] = [piece[1] for piece in pieces]
+        self.tags[i:j] = [piece[2] for piece in pieces]
+        self._merge(max(0, i - 1), i + len(pieces))
+    
+    def append(self, start, end, tag):
+        # Быстрое добавление отрезка, лежащего после всех существующих
+        if self.starts and self.ends[-1] == start and self.tags[-1] == tag:
+            self.ends[-1] = end
+            return
+        self.starts.append(start)
+        self.ends.append(end)
+        self.tags.append(tag)
+    
+    def _merge(self, first, last):
+        # Склеивает соседние отрезки с одинаковым тегом в окрестности правки
+        k = min(last, len(self.starts) - 1)
+        while k > first:
+            if self.ends[k - 1] == self.starts[k] and self.tags[k - 1] == self.tags[k]:
+                self.ends[k - 1] = self.ends[k]
+                del self.starts[k], self.ends[k], self.tags[k]
+            k -= 1
+    
+    def insert(self, position, text):
+        # Как в Tk: вставка внутри отрезка наследует его тег, на границе - нет
+        if not self.starts or not text:
+            return
+        line, column = position
+        end = text_end(position, text)
+        newlines = end[0] - line
+        
+        def shift(point):
+            if point[0] == line:
+                return end[0], end[1] + point[1] - column
+            return point[0] + newlines, point[1]
+        
+        i = bisect_left(self.starts, position)
+        if i > 0 and self.ends[i - 1] > position:
+            self.ends[i - 1] = shift(self.ends[i - 1])
+        for k in range(i, len(self.starts)):
+            if not newlines and self.starts[k][0] != line:
+                break
+            self.starts[k] = shift(self.starts[k])
+            self.ends[k] = shift(self.ends[k])
+    
+    def delete(self, position, text):
+        if not self.starts or not text:
+            return
+        end = text_end(position, text)
+        newlines = end[0] - position[0]
+        
+        def shift(point):
+            if point <= position:
+                return point
+            if point <= end:
+                return position
+            if point[0] == end[0]:
+                return position[0], position[1] + point[1] - end[1]
+            return point[0] - newlines, point[1]
+        
+        i = bisect_right(self.ends, position)
+        k = i
+        while k < len(self.starts):
+            if k > i and not newlines and self.starts[k][0] != position[0]:
+                break
+            self.starts[k] = shift(self.starts[k])
+            self.ends[k] = shift(self.ends[k])
+            k += 1
+        
+        # Отрезки, целиком попавшие в удаленный текст, схлопнулись
+        for j in range(min(k, len(self.starts)) - 1, i - 1, -1):
+            if self.starts[j] >= self.ends[j]:
+                del self.starts[j], self.ends[j], self.tags[j]
+        self._merge(max(0, i - 1), i + 1)
+
+
+def encode_rich_document(text, styles, runs):
+    # runs - плоский список [длина, номер стиля, ...], -1 - без стиля
+    header = json.dumps({"styles": styles, "runs": runs}, ensure_ascii=False, separators=(",", ":"))
+    return RICH_MAGIC + header + "\n" + text
+
+
+def decode_rich_document(data):
+    if not data.startswith(RICH_MAGIC):
+        raise ValueError("Неизвестный формат документа")
+    header_end = data.index("\n", len(RICH_MAGIC))
+    header = json.loads(data[len(RICH_MAGIC):header_end])
+    return data[header_end + 1:], header["styles"], header["runs"]
+
+
+class EscapeTable(dict):
+    # Таблица для str.translate: замена каждого символа вычисляется один раз
+    def __init__(self, escape):
+        super().__init__()
+        self.escape = escape
+    
+    def __missing__(self, code):
+        value = self[code] = self.escape(chr(code))
+        return value
+
+
+def html_escape(char):
+    return {"&": "&amp;", "<": "&lt;", ">": "&gt;"}.get(char, char)
+
+
+def rtf_escape(char):
+    if char in "\\{}":
+        return "\\" + char
+    if char == "\n":
+        return "\\par\n"
+    if char == "\t":
+        return "\\tab "
+    if char.isascii():
+        return char
+    # \uN? - знаковое 16-битное число, символы вне BMP - суррогатной парой
+    units = char.encode("utf-16-le", "surrogatepass")
+    codes = [int.from_bytes(units[k:k + 2], "little", signed=True) for k in range(0, len(units), 2)]
+    return "".join(f"\\u{code}?" for code in codes)
+
+
+class DocumentWriter:
+    # Потоковый экспорт снимка документа (текст, стили, RLE-отрезки):
+    # каждый стиль переводится в разметку один раз - описание в заголовке и
+    # открывающая и закрывающая строки для отрезков; на диск уходят части
+    # по EXPORT_CHUNK_SIZE. Стили уже разобраны: family, size, bold,
+    # italic, underline, fg, bg
+    encoding = "utf-8"
+    escapes = {}
+    
+    def __init__(self, styles, base, title=""):
+        self.styles = styles
+        self.base = base
+        self.title = title
+        self.openings = {-1: ""}
+        self.closings = {-1: ""}
+    
+    def run(self, path, text, runs, results):
+        # Выполняется в фоновом потоке, итог - (путь, ошибка или None)
+        try:
+            self.write(path, text, runs)
+            results.put((path, None))
+        except Exception as e:
+            results.put((path, e))
+    
+    def write(self, path, text, runs):
+        escapes = self.escapes
+        openings = self.openings
+        closings = self.closings
+        with open(path, "w", encoding=self.encoding, newline="") as file:
+            file.write(self.header())
+            chunks = []
+            size = 0
+            offset = 0
+            for k in range(0, len(runs), 2):
+                length, style = runs[k], runs[k + 1]
+                if length < EXPORT_CHUNK_SIZE:
+                    chunks += (openings[style], text[offset:offset + length].translate(escapes), closings[style])
+                    offset += length
+                    size += length
+                    if size >= EXPORT_CHUNK_SIZE:
+                        file.write("".join(chunks))
+                        chunks = []
+                        size = 0
+                    continue
+                # Длинный отрезок делится, чтобы не держать в памяти его разметку целиком
+                for start in range(offset, offset + length, EXPORT_CHUNK_SIZE):
+                    chunks.append(openings[style])
+                    chunks.append(text[start:min(start + EXPORT_CHUNK_SIZE, offset + length)].translate(escapes))
+                    chunks.append(closings[style])
+                    size += min(EXPORT_CHUNK_SIZE, offset + length - start)
+                    if size >= EXPORT_CHUNK_SIZE:
+                        file.write("".join(chunks))
+                        chunks = []
+                        size = 0
+                offset += length
+            file.write("".join(chunks))
+            file.write(self.footer())
+    
+    def header(self):
+        return ""
+    
+    def footer(self):
+        return ""
+
+
+class HtmlWriter(DocumentWriter):
+    escapes = EscapeTable(html_escape)
+    
+    def __init__(self, styles, base, title=""):
+        super().__init__(styles, base, title)
+        for number in range(len(styles)):
+            self.openings[number] = f"<span class=\"s{number}\">"
+            self.closings[number] = "</span>"
+    
+    @staticmethod
+    def css(style):
+        rules = []
+        if style.get("family"):
+            rules.append(f"font-family: '{style['family']}', monospace")
+        if style.get("size"):
+            rules.append(f"font-size: {style['size']}pt")
+        if style.get("bold"):
+            rules.append("font-weight: bold")
+        if style.get("italic"):
+            rules.append("font-style: italic")
+        if style.get("underline"):
+            rules.append("text-decoration: underline")
+        if style.get("fg"):
+            rules.append("color: #%02x%02x%02x" % style["fg"])
+        if style.get("bg"):
+            rules.append("background-color: #%02x%02x%02x" % style["bg"])
+        return "; ".join(rules)
+    
+    def header(self):
+        rules = [f"body {{ white-space: pre-wrap; margin: 15px; {self.css(self.base)} }}"]
+        rules.extend(f".s{number} {{ {self.css(style)} }}" for number, style in enumerate(self.styles))
+        title = self.title.translate(self.escapes)
+        return ("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+                f"<title>{title}</title>\n<style>\n" + "\n".join(rules) + "\n</style>\n</head>\n<body>")
+    
+    def footer(self):
+        return "</body>\n</html>\n"
+
+
+class RtfWriter(DocumentWriter):
+    # Стили попадают в \stylesheet как символьные стили \csN; их свойства
+    # собираются в строку один раз и повторяются у отрезка, как требует RTF.
+    # Цвета темы редактора в документ не переносятся
+    encoding = "ascii"
+    escapes = EscapeTable(rtf_escape)
+    
+    def __init__(self, styles, base, title=""):
+        super().__init__(styles, base, title)
+        self.fonts = []
+        self.colors = []
+        self.base_properties = self.properties({**base, "fg": None, "bg": None})
+        self.style_properties = [self.properties(style) for style in styles]
+        for number, properties in enumerate(self.style_properties):
+            self.openings[number] = f"{{\\cs{number + 1}{properties} "
+            self.closings[number] = "}"
+    
+    def font_number(self, family):
+        if family not in self.fonts:
+            self.fonts.append(family)
+        return self.fonts.index(family)
+    
+    def color_number(self, color):
+        # Цвет 0 в \colortbl - цвет по умолчанию
+        if color not in self.colors:
+            self.colors.append(color)
+        return self.colors.index(color) + 1
+    
+    def properties(self, style):
+        parts = []
+        if style.get("family"):
+            parts.append(f"\\f{self.font_number(style['family'])}")
+        if style.get("size"):
+            parts.append(f"\\fs{int(style['size']) * 2}")
+        if style.get("bold"):
+            parts.append("\\b")
+        if style.get("italic"):
+            parts.append("\\i")
+        if style.get("underline"):
+            parts.append("\\ul")
+        if style.get("fg"):
+            parts.append(f"\\cf{self.color_number(style['fg'])}")
+        if style.get("bg"):
+            parts.append(f"\\highlight{self.color_number(style['bg'])}")
+        return "".join(parts)
+    
+    def header(self):
+        fonts = "".join(f"{{\\f{number}\\fnil {family.translate(self.escapes)};}}"
+                        for number, family in enumerate(self.fonts))
+        colors = "".join("\\red%d\\green%d\\blue%d;" % color for color in self.colors)
+        styles = "".join(f"{{\\*\\cs{number + 1} \\additive{properties} Style {number + 1};}}"
+                         for number, properties in enumerate(self.style_properties))
+        return (f"{{\\rtf1\\ansi\\deff0\\uc1\n{{\\fonttbl{fonts}}}\n{{\\colortbl;{colors}}}\n"
+                f"{{\\stylesheet{{\\s0 Normal;}}{styles}}}\n\\pard\\plain{self.base_properties} ")
+    
+    def footer(self):
+        return "\n}\n"
+
+
+EXPORT_WRITERS = {
+    ".html": HtmlWriter,
+    ".htm": HtmlWriter,
+    ".rtf": RtfWriter,
+}
+
+
+def hex_rgb(color):
+    # Цвет вида #rgb, #rrggbb или #rrrrggggbbbb без Tk; имена цветов - None
+    digits = color[1:] if color.startswith("#") else ""
+    if len(digits) not in (3, 6, 12) or not all(c in "0123456789abcdefABCDEF" for c in digits):
+        return None
+    width = len(digits) // 3
+    return tuple(int(digits[k * width:(k + 1) * width], 16) * 255 // (16 ** width - 1) for k in range(3))
+
+
+def export_properties(style, family, size, rgb):
+    # Стиль тега -> свойства для писателей экспорта; rgb переводит цвет Tk
+    # в (r, g, b). Без шрифта в стиле шрифт наследуется от основного текста
+    if 'font' in style:
+        family, size, weight, slant, underline = parse_font(style['font'], family, size)
+    else:
+        family, size, weight, slant, underline = None, None, "normal", "roman", False
+    return {
+        "family": family,
+        "size": abs(size) if isinstance(size, int) else None,
+        "bold": weight == "bold",
+        "italic": slant == "italic",
+        "underline": underline,
+        "fg": rgb(style['foreground']) if style.get('foreground') else None,
+        "bg": rgb(style['background']) if style.get('background') else None,
+    }
+
+
+def rich_spans(text, runs):
+    # RLE-отрезки -> (начало, конец, номер стиля) в позициях Tk за один проход
+    spans = []
+    ascii_text = text.isascii()
+    offset = 0
+    line, column = 1, 0
+    for k in range(0, len(runs), 2):
+        length, style = runs[k], runs[k + 1]
+        end = offset + length
+        newlines = text.count("\n", offset, end)
+        if newlines:
+            line_start = text.rfind("\n", offset, end) + 1
+            end_line = line + newlines
+            end_column = end - line_start if ascii_text else tk_length(text[line_start:end])
+        else:
+            end_line = line
+            end_column = column + (length if ascii_text else tk_length(text[offset:end]))
+        if style >= 0:
+            spans.append(((line, column), (end_line, end_column), style))
+        offset, line, column = end, end_line, end_column
+    return spans
+
+
+class PieceNode:
+    # Узел декартова дерева: фрагмент буфера и суммы по поддереву; astral -
+    # символы вне BMP во фрагменте, units - длина поддерева в единицах Tk
+    __slots__ = ("buffer", "start", "length", "newlines", "astral", "priority", "left", "right", "size", "lines", "units")
+    
+    def __init__(self, buffer, start, length, newlines, astral, priority):
+        self.buffer = buffer
+        self.start = start
+        self.length = length
+        self.newlines = newlines
+        self.astral = astral
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.size = length
+        self.lines = newlines
+        self.units = length + astral
+
+
+class PieceTable:
+    # Текст как последовательность фрагментов неизменяемых буферов в
+    # декартовом дереве (treap) с суммами длин и переводов строк по
+    # поддеревьям: вставка, удаление и поиск строки за O(log n) без
+    # копирования текста. Для каждого буфера хранятся разреженные индексы
+    # переводов строк и символов вне BMP, чтобы разрезать фрагмент и
+    # переводить колонки Tk в смещения, не пересчитывая его целиком
+    def __init__(self, text=""):
+        self.buffers = []
+        self.marks = []
+        self.astral_marks = []
+        self.random = random.Random(0)
+        self.add_buffer = None
+        self.root = None
+        if text:
+            buffer = self.store(text)
+            self.root = self.node(buffer, 0, len(text))
+    
+    def store(self, text):
+        marks = array('Q', [0])
+        astral_marks = array('Q', [0])
+        total = 0
+        astral = 0
+        for start in range(0, len(text), PIECE_BLOCK):
+            block = text[start:start + PIECE_BLOCK]
+            total += block.count("\n")
+            astral += tk_length(block) - len(block)
+            marks.append(total)
+            astral_marks.append(astral)
+        self.buffers.append(text)
+        self.marks.append(marks)
+        self.astral_marks.append(astral_marks)
+        return len(self.buffers) - 1
+    
+    def append(self, text):
+        # Вставки дописываются в общий буфер добавлений ограниченного размера
+        buffer = self.add_buffer
+        if buffer is None or len(self.buffers[buffer]) + len(text) > PIECE_ADD_LIMIT:
+            self.add_buffer = buffer = self.store("")
+        old = self.buffers[buffer]
+        new = old + text
+        marks = self.marks[buffer]
+        astral_marks = self.astral_marks[buffer]
+        del marks[len(old) // PIECE_BLOCK + 1:]
+        del astral_marks[len(old) // PIECE_BLOCK + 1:]
+        total = marks[-1]
+        astral = astral_marks[-1]
+        for start in range(len(old) // PIECE_BLOCK * PIECE_BLOCK, len(new), PIECE_BLOCK):
+            block = new[start:start + PIECE_BLOCK]
+            total += block.count("\n")
+            astral += tk_length(block) - len(block)
+            marks.append(total)
+            astral_marks.append(astral)
+        self.buffers[buffer] = new
+        return buffer, len(old)
+    
+    def rank(self, buffer, position):
+        # Число переводов строк в буфере до позиции
+        block = position // PIECE_BLOCK
+        return self.marks[buffer][block] + self.buffers[buffer].count("\n", block * PIECE_BLOCK, position)
+    
+    def astral_rank(self, buffer, position):
+        # Число символов вне BMP в буфере до позиции
+        block = position // PIECE_BLOCK
+        head = self.buffers[buffer][block * PIECE_BLOCK:position]
+        return self.astral_marks[buffer][block] + tk_length(head) - len(head)
+    
+    def count_astral(self, buffer, start, end):
+        if end - start <= 2 * PIECE_BLOCK:
+            text = self.buffers[buffer][start:end]
+            return tk_length(text) - len(text)
+        return self.astral_rank(buffer, end) - self.astral_rank(buffer, start)
+    
+    def unit_position(self, buffer, start, units):
+        # Наименьшее смещение от start, на котором набирается units единиц Tk:
+        # блоки пропускаются по индексу, внутри блока - отрезками
+        text = self.buffers[buffer]
+        marks = self.astral_marks[buffer]
+        target = start + self.astral_rank(buffer, start) + units
+        low = start // PIECE_BLOCK + 1
+        high = len(marks) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            if middle * PIECE_BLOCK + marks[middle] <= target:
+                low = middle + 1
+            else:
+                high = middle - 1
+        position = max(start, high * PIECE_BLOCK)
+        need = target - position - self.astral_rank(buffer, position)
+        while need > 0 and position < len(text):
+            # Ни первые need // 2, ни первые need - astral символов отрезка
+            # не переходят цель: символ занимает не больше двух единиц
+            chunk = text[position:position + need]
+            step = max(1, need // 2, 2 * len(chunk) - tk_length(chunk))
+            need -= tk_length(chunk[:step])
+            position += step
+        return position - start
+    
+    def count_newlines(self, buffer, start, end):
+        if end - start <= 2 * PIECE_BLOCK:
+            return self.buffers[buffer].count("\n", start, end)
+        return self.rank(buffer, end) - self.rank(buffer, start)
+    
+    def find_newline(self, buffer, start, k):
+        # Позиция k-го (с нуля) перевода строки буфера, начиная с start
+        text = self.buffers[buffer]
+        marks = self.marks[buffer]
+        target = self.rank(buffer, start) + k
+        block = bisect_right(marks, target) - 1
+        position = max(start, block * PIECE_BLOCK)
+        skip = target - self.rank(buffer, position)
+        position = text.index("\n", position)
+        for _ in range(skip):
+            position = text.index("\n", position + 1)
+        return position
+    
+    def node(self, buffer, start, length):
+        return PieceNode(buffer, start, length, self.count_newlines(buffer, start, start + length),
+                         self.count_astral(buffer, start, start + length), self.random.random())
+    
+    @staticmethod
+    def update(node):
+        node.size = node.length
+        node.lines = node.newlines
+        node.units = node.length + node.astral
+        if node.left is not None:
+            node.size += node.left.size
+            node.lines += node.left.lines
+            node.units += node.left.units
+        if node.right is not None:
+            node.size += node.right.size
+            node.lines += node.right.lines
+            node.units += node.right.units
+    
+    def split(self, node, offset):
+        # Делит дерево на первые offset символов и остаток
+        if node is None:
+            return None, None
+        left_size = node.left.size if node.left is not None else 0
+        if offset <= left_size:
+            left, node.left = self.split(node.left, offset)
+            self.update(node)
+            return left, node
+        offset -= left_size
+        if offset >= node.length:
+            node.right, right = self.split(node.right, offset - node.length)
+            self.update(node)
+            return node, right
+        
+        tail = self.node(node.buffer, node.start + offset, node.length - offset)
+        node.length = offset
+        node.newlines -= tail.newlines
+        node.astral -= tail.astral
+        right = self.merge(tail, node.right)
+        node.right = None
+        self.update(node)
+        return node, right
+    
+    def merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self.merge(left.right, right)
+            self.update(left)
+            return left
+        right.left = self.merge(left, right.left)
+        self.update(right)
+        return right
+    
+    def __len__(self):
+        return self.root.size if self.root is not None else 0
+    
+    @property
+    def newline_count(self):
+        return self.root.lines if self.root is not None else 0
+    
+    @property
+    def astral_count(self):
+        return self.root.units - self.root.size if self.root is not None else 0
+    
+    def extend(self, offset, text):
+        # Ввод подряд удлиняет последний фрагмент буфера добавлений,
+        # не создавая новых узлов
+        buffer = self.add_buffer
+        if buffer is None or len(self.buffers[buffer]) + len(text) > PIECE_ADD_LIMIT:
+            return False
+        path = []
+        node = self.root
+        position = offset
+        while node is not None:
+            left_size = node.left.size if node.left is not None else 0
+            if position <= left_size:
+                path.append(node)
+                node = node.left
+            elif position <= left_size + node.length:
+                if position != left_size + node.length:
+                    return False
+                break
+            else:
+                position -= left_size + node.length
+                path.append(node)
+                node = node.right
+        if node is None or node.buffer != buffer or node.start + node.length != len(self.buffers[buffer]):
+            return False
+        
+        self.append(text)
+        newlines = text.count("\n")
+        units = tk_length(text)
+        node.length += len(text)
+        node.newlines += newlines
+        node.astral += units - len(text)
+        for changed in path + [node]:
+            changed.size += len(text)
+            changed.lines += newlines
+            changed.units += units
+        return True
+    
+    def insert(self, offset, text):
+        if not text:
+            return
+        if offset > 0 and self.extend(offset, text):
+            return
+        buffer, start = self.append(text)
+        left, right = self.split(self.root, offset)
+        self.root = self.merge(self.merge(left, self.node(buffer, start, len(text))), right)
+    
+    def delete(self, start, end):
+        left, rest = self.split(self.root, start)
+        middle, right = self.split(rest, end - start)
+        self.root = self.merge(left, right)
+        chunks = []
+        self.collect(middle, 0, 0, end - start, chunks)
+        return "".join(chunks)
+    
+    def collect(self, node, base, start, end, chunks):
+        # Обход по порядку только тех поддеревьев, что пересекают [start, end)
+        while node is not None and base < end and base + node.size > start:
+            left_size = node.left.size if node.left is not None else 0
+            self.collect(node.left, base, start, end, chunks)
+            piece = base + left_size
+            first = max(start, piece)
+            last = min(end, piece + node.length)
+            if first < last:
+                chunks.append(self.buffers[node.buffer][node.start + first - piece:node.start + last - piece])
+            base = piece + node.length
+            node = node.right
+    
+    def get(self, start=0, end=None):
+        if end is None:
+            end = len(self)
+        chunks = []
+        self.collect(self.root, 0, start, end, chunks)
+        return "".join(chunks)
+    
+    def line_start(self, line):
+        # Смещение начала строки line (с нуля)
+        if line <= 0:
+            return 0
+        if line > self.newline_count:
+            raise IndexError(line)
+        node = self.root
+        base = 0
+        k = line
+        while node is not None:
+            left_lines = node.left.lines if node.left is not None else 0
+            if k <= left_lines:
+                node = node.left
+                continue
+            k -= left_lines
+            base += node.left.size if node.left is not None else 0
+            if k <= node.newlines:
+                return base + self.find_newline(node.buffer, node.start, k - 1) - node.start + 1
+            k -= node.newlines
+            base += node.length
+            node = node.right
+        raise IndexError(line)
+    
+    def units_before(self, offset):
+        # Длина текста до смещения в единицах Tk
+        node = self.root
+        units = 0
+        while node is not None:
+            left_size = node.left.size if node.left is not None else 0
+            if offset <= left_size:
+                node = node.left
+                continue
+            units += node.left.units if node.left is not None else 0
+            offset -= left_size
+            if offset <= node.length:
+                return units + offset + self.count_astral(node.buffer, node.start, node.start + offset)
+            units += node.length + node.astral
+            offset -= node.length
+            node = node.right
+        return units
+    
+    def unit_offset(self, units):
+        # Наименьшее смещение, до которого набирается units единиц Tk
+        node = self.root
+        base = 0
+        while node is not None:
+            left_units = node.left.units if node.left is not None else 0
+            if units <= left_units:
+                node = node.left
+                continue
+            units -= left_units
+            base += node.left.size if node.left is not None else 0
+            if units <= node.length + node.astral:
+                return base + self.unit_position(node.buffer, node.start, units)
+            units -= node.length + node.astral
+            base += node.length
+            node = node.right
+        return base
+    
+    def line_of(self, offset):
+        # Номер строки (с нуля), в которой лежит смещение
+        node = self.root
+        count = 0
+        while node is not None:
+            left_size = node.left.size if node.left is not None else 0
+            if offset <= left_size:
+                node = node.left
+                continue
+            count += node.left.lines if node.left is not None else 0
+            offset -= left_size
+            if offset <= node.length:
+                return count + self.count_newlines(node.buffer, node.start, node.start + offset)
+            count += node.newlines
+            offset -= node.length
+            node = node.right
+        return count
+
+
+class DocumentModel:
+    # Документ без Tk: текст в PieceTable, индекс стилей и уведомления о
+    # правках в том же виде (kind, index, text), что и у EditInterceptor.
+    # Позиции - пары (строка, колонка) в единицах Tk
+    def __init__(self, text=""):
+        self.pieces = PieceTable(text)
+        self.styles = StyleRuns()
+        self.listeners = []
+    
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+    
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+    
+    def notify(self, kind, index, text):
+        for listener in list(self.listeners):
+            listener(kind, index, text)
+    
+    @property
+    def char_count(self):
+        return len(self.pieces)
+    
+    @property
+    def line_count(self):
+        return self.pieces.newline_count + 1
+    
+    def offset(self, position):
+        line, column = position
+        start = self.pieces.line_start(line - 1)
+        if line - 1 < self.pieces.newline_count:
+            end = self.pieces.line_start(line) - 1
+        else:
+            end = len(self.pieces)
+        # Символы вне BMP Tk считает за два; если их в тексте нет, колонка
+        # и есть смещение от начала строки, иначе она ищется по дереву
+        if not column or not self.pieces.astral_count:
+            return min(end, start + column)
+        return min(end, self.pieces.unit_offset(self.pieces.units_before(start) + column))
+    
+    def position(self, offset):
+        line = self.pieces.line_of(offset)
+        start = self.pieces.line_start(line)
+        if not self.pieces.astral_count:
+            return line + 1, offset - start
+        return line + 1, self.pieces.units_before(offset) - self.pieces.units_before(start)
+    
+    def line_text(self, first, last):
+        # Текст строк [first, last) (с нуля) без завершающего перевода строки
+        start = self.pieces.line_start(first)
+        if last <= self.pieces.newline_count:
+            end = self.pieces.line_start(last) - 1
+        else:
+            end = len(self.pieces)
+        return self.pieces.get(start, end)
+    
+    def get(self, start=None, end=None):
+        first = self.offset(start) if start is not None else 0
+        last = self.offset(end) if end is not None else len(self.pieces)
+        return self.pieces.get(first, last)
+    
+    def insert(self, position, text):
+        self.pieces.insert(self.offset(position), text)
+        self.styles.insert(position, text)
+        self.notify("insert", format_index(position), text)
+    
+    def delete(self, start, end):
+        text = self.pieces.delete(self.offset(start), self.offset(end))
+        self.styles.delete(start, text)
+        self.notify("delete", format_index(start), text)
+        return text
+    
+    def reset(self, text=""):
+        self.pieces = PieceTable(text)
+        self.styles.clear()
+        self.notify("reset", None, "")
+
+
+def lock_file(path):
+    # Эксклюзивная блокировка без ожидания; None - файл заблокирован другим
+    # процессом. Блокировку снимает ОС, когда процесс завершается, даже при сбое
+    file = open(path, "a+b")
+    try:
+        if os.name == "nt":
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+
+class EditJournal:
+    # Журнал правок: компактные записи вставок, удалений и форматирования
+    # дописываются в файл фоновым потоком пачками по таймеру, поэтому объем
+    # ввода-вывода зависит от размера правок, а не документа. Первая запись -
+    # заголовок: исходный файл ("b") или снимок документа ("s")
+    def __init__(self, path):
+        self.path = path
+        self.lock = lock_file(path + JOURNAL_LOCK_SUFFIX)
+        self.condition = threading.Condition()
+        self.pending = []
+        self.written = []
+        self.rewrite = None
+        self.size = 0
+        self.seq = 0
+        self.generation = 0
+        self.active = False
+        self.needs_snapshot = False
+        self.closing = False
+        # Ошибки записи забирает главный поток и показывает в строке состояния
+        self.errors = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    @staticmethod
+    def read(path):
+        # Оборванная при сбое последняя строка отбрасывается
+        records = []
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        except OSError:
+            pass
+        return records
+    
+    @staticmethod
+    def orphans():
+        # Журналы процессов, завершившихся со сбоем: пары (путь, удерживаемая
+        # блокировка), блокировка берется по мере перебора. Журналы работающих
+        # процессов пропускаются
+        paths = set()
+        for name in os.listdir(os.curdir):
+            if name.endswith(JOURNAL_LOCK_SUFFIX):
+                name = name[:-len(JOURNAL_LOCK_SUFFIX)]
+            if fnmatch.fnmatch(name, JOURNAL_PATTERN):
+                paths.add(name)
+        for path in sorted(paths):
+            try:
+                lock = lock_file(path + JOURNAL_LOCK_SUFFIX)
+            except OSError:
+                continue
+            if lock is not None:
+                yield path, lock
+    
+    @staticmethod
+    def discard(path, lock):
+        for name in (path, path + JOURNAL_LOCK_SUFFIX):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        lock.close()
+    
+    def start(self, header):
+        # Новая точка отсчета: все прежние записи больше не нужны
+        with self.condition:
+            self.generation += 1
+            self.rewrite = (header, self.seq)
+            self.active = True
+            self.needs_snapshot = False
+            self.condition.notify()
+    
+    def rebase(self, header, after_seq, generation):
+        # Документ сохранен на момент after_seq: записи до него уже на диске
+        with self.condition:
+            if generation != self.generation:
+                return
+            self.rewrite = (header, after_seq)
+            self.condition.notify()
+    
+    def stop(self):
+        with self.condition:
+            self.generation += 1
+            self.active = False
+            self.rewrite = (None, self.seq)
+            self.condition.notify()
+    
+    def record(self, record):
+        if not self.active:
+            return
+        with self.condition:
+            self.seq += 1
+            self.pending.append((self.seq, record))
+    
+    def close(self):
+        self.stop()
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+        if self.lock is not None:
+            self.discard(self.path, self.lock)
+            self.lock = None
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                if self.rewrite is None and not self.closing:
+                    self.condition.wait(JOURNAL_FLUSH_MS / 1000)
+                pending, self.pending = self.pending, []
+                rewrite, self.rewrite = self.rewrite, None
+                closing = self.closing
+            try:
+                lines = [(seq, json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+                         for seq, record in pending]
+                if rewrite is not None:
+                    self._rewrite(rewrite, lines)
+                elif lines:
+                    with open(self.path, 'a', encoding='utf-8') as file:
+                        file.writelines(line for seq, line in lines)
+                    self.written.extend(lines)
+                    self.size += sum(len(line) for seq, line in lines)
+                if self.size > JOURNAL_COMPACT_BYTES:
+                    self.needs_snapshot = True
+            except Exception as e:
+                # Часть записей не попала в файл: следующий заголовок -
+                # полный снимок, иначе журнал разойдется с документом
+                self.needs_snapshot = True
+                self.errors.put(e)
+            if closing:
+                return
+    
+    def _rewrite(self, rewrite, lines):
+        header, after_seq = rewrite
+        self.written = [(seq, line) for seq, line in self.written + lines if seq > after_seq]
+        self.size = sum(len(line) for seq, line in self.written)
+        if header is None:
+            self.written = []
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".journal.", suffix=".tmp", dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(header, ensure_ascii=False, separators=(",", ":")) + "\n")
+            file.writelines(line for seq, line in self.written)
+        os.replace(temp_path, self.path)
+
+
+class UndoHistory:
+    # История отмены редактора: группы компактных записей
+    # ("i", index, text) - вставка, ("d", index, text, styles) - удаление
+    # (styles - отрезки стилей удаленного текста или None),
+    # ("f", start, end, old_style, new_style) - смена стиля отрезка.
+    # Посимвольный ввод склеивается в группы по словам, при превышении
+    # бюджета памяти вытесняются самые старые группы
+    def __init__(self, budget):
+        self.budget = budget
+        # Элемент стека - [размер в байтах, список записей]
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0
+        self.depth = 0
+        self.group = None
+        self.typing = False
+        self.applying = False
+    
+    @staticmethod
+    def record_size(record):
+        size = UNDO_RECORD_OVERHEAD
+        for item in record[1:]:
+            if isinstance(item, str):
+                size += sys.getsizeof(item)
+            elif item:
+                size += UNDO_RECORD_OVERHEAD * len(item)
+        return size
+    
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.size = 0
+        self.group = [0, []] if self.depth else None
+        self.typing = False
+    
+    def begin(self):
+        # Все записи между begin и end - один шаг отмены
+        self.depth += 1
+        if self.depth == 1:
+            self.group = [0, []]
+            self.typing = False
+    
+    def end(self):
+        self.depth -= 1
+        if self.depth == 0:
+            group, self.group = self.group, None
+            if group[1]:
+                self.undo_stack.append(group)
+                self.evict()
+    
+    def add(self, record):
+        if self.applying:
+            return
+        if self.redo_stack:
+            self.size -= sum(entry[0] for entry in self.redo_stack)
+            self.redo_stack = []
+        size = self.record_size(record)
+        self.size += size
+        if self.group is not None:
+            self.group[0] += size
+            self.group[1].append(record)
+            return
+        
+        if self.typing and self.undo_stack and self.coalesce(record, size):
+            self.evict()
+            return
+        self.undo_stack.append([size, [record]])
+        self.typing = record[0] in "id" and len(record[2]) == 1 and not (record[0] == "d" and record[3])
+        self.evict()
+    
+    def coalesce(self, record, size):
+        # Продолжение ввода или удаления по одному символу дописывается
+        # в последнюю запись; новое слово начинает новую группу
+        entry = self.undo_stack[-1]
+        last = entry[1][-1]
+        if record[0] != last[0] or len(record[2]) != 1 or len(last[2]) >= UNDO_COALESCE_LIMIT:
+            return False
+        if record[0] == "i":
+            if text_end(parse_index(last[1]), last[2]) != parse_index(record[1]):
+                return False
+            if last[2][-1].isspace() and not record[2].isspace():
+                return False
+            merged = ("i", last[1], last[2] + record[2])
+        else:
+            if record[3] or last[3]:
+                return False
+            if record[1] == last[1]:
+                merged = ("d", last[1], last[2] + record[2], None)
+            elif text_end(parse_index(record[1]), record[2]) == parse_index(last[1]):
+                merged = ("d", record[1], record[2] + last[2], None)
+            else:
+                return False
+        merged_size = self.record_size(merged)
+        self.size += merged_size - self.record_size(last) - size
+        entry[0] += merged_size - self.record_size(last)
+        entry[1][-1] = merged
+        return True
+    
+    def evict(self):
+        # Самая новая группа остается, даже если одна не влезает в бюджет
+        while self.size > self.budget and len(self.undo_stack) > 1:
+            self.size -= self.undo_stack.popleft()[0]
+        if self.size > self.budget and self.redo_stack:
+            self.size -= sum(entry[0] for entry in self.redo_stack)
+            self.redo_stack = []
+    
+    def undo(self):
+        self.typing = False
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        return entry[1]
+    
+    def redo(self):
+        self.typing = False
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return entry[1]
+
+
+class Document:
+    # Вкладка редактора. Пока вкладка неактивна, документ хранится компактно:
+    # текст и отрезки стилей (как в формате .mip) вместо живого виджета,
+    # плюс позиция курсора, прокрутка и своя история отмены
+    def __init__(self, path, undo_budget):
+        self.path = path
+        self.text = ""
+        self.styles = []
+        self.runs = []
+        self.cursor = "1.0"
+        self.view = "1.0"
+        self.large = False
+        self.modified = False
+        self.saved = False
+        self.edits = 0
+        self.wrap = True
+        self.text_format = DEFAULT_TEXT_FORMAT
+        # Слежение за файлом и (прочитано байт, (st_dev, st_ino)), пока
+        # текст совпадает с началом файла на диске
+        self.follow = False
+        self.disk_state = None
+        self.changes = ChangedLines()
+        self.history = UndoHistory(undo_budget)
+
+
+class OffsetMapper:
+    # Переводит неубывающие смещения в строке в индексы Tk за один проход
+    def __init__(self, text):
+        self.text = text
+        self.ascii = text.isascii()
+        self.pos = 0
+        self.line = 1
+        self.column = 0
+    
+    def index(self, offset):
+        text = self.text
+        newlines = text.count("\n", self.pos, offset)
+        if newlines:
+            self.line += newlines
+            line_start = text.rfind("\n", self.pos, offset) + 1
+            self.column = offset - line_start if self.ascii else tk_length(text[line_start:offset])
+        else:
+            self.column += offset - self.pos if self.ascii else tk_length(text[self.pos:offset])
+        self.pos = offset
+        return f"{self.line}.{self.column}"
+
+
+class SearchWorker:
+    # Поиск по снимку текста в фоновом потоке. Результаты кладутся в очередь
+    # с номером поколения: новый запрос делает все прежние устаревшими
+    def __init__(self):
+        self.results = queue.Queue()
+        self.generation = 0
+    
+    def cancel(self):
+        self.generation += 1
+    
+    def search(self, text, pattern):
+        self.generation += 1
+        threading.Thread(target=self._search, args=(self.generation, text, pattern), daemon=True).start()
+        return self.generation
+    
+    def replace(self, text, pattern, replacement):
+        self.generation += 1
+        threading.Thread(target=self._replace, args=(self.generation, text, pattern, replacement),
+                         daemon=True).start()
+        return self.generation
+    
+    def _search(self, generation, text, pattern):
+        mapper = OffsetMapper(text)
+        batch = []
+        total = 0
+        for match in pattern.finditer(text):
+            if self.generation != generation:
+                return
+            start, end = match.span()
+            if start == end:
+                continue
+            batch.append(mapper.index(start))
+            batch.append(mapper.index(end))
+            total += 1
+            if len(batch) >= 2 * SEARCH_BATCH:
+                self.results.put(("matches", generation, batch))
+                batch = []
+        if batch:
+            self.results.put(("matches", generation, batch))
+        self.results.put(("done", generation, total))
+    
+    def _replace(self, generation, text, pattern, replacement):
+        try:
+            matches = [match for match in pattern.finditer(text) if match.start() != match.end()]
+            if self.generation != generation:
+                return
+            mapper = OffsetMapper(text)
+            if len(matches) <= REPLACE_INLINE_LIMIT:
+                edits = [(mapper.index(match.start()), mapper.index(match.end()), match.expand(replacement))
+                         for match in matches]
+                edits.reverse()
+                self.results.put(("replace", generation, (len(matches), edits, None)))
+                return
+            
+            # spans - смещения каждого совпадения до замены и его замены после
+            # нее: по ним восстанавливаются стили текста между совпадениями
+            pieces = []
+            spans = []
+            position = matches[0].start()
+            shift = 0
+            for match in matches:
+                pieces.append(text[position:match.start()])
+                expanded = match.expand(replacement)
+                pieces.append(expanded)
+                position = match.end()
+                spans.append((match.start(), match.end(), match.start() + shift,
+                              match.start() + shift + len(expanded)))
+                shift += len(expanded) - (match.end() - match.start())
+            first = mapper.index(matches[0].start())
+            last = mapper.index(matches[-1].end())
+            self.results.put(("replace", generation,
+                              (len(matches), [(first, last, "".join(pieces))], spans)))
+        except (re.error, IndexError) as e:
+            self.results.put(("error", generation, e))
+
+
+class Lexer:
+    # Построчный лексер: lex_line получает строку и состояние на ее начало и
+    # возвращает токены (начало, конец, тип) и состояние на начало следующей
+    initial_state = None
+    
+    def lex_line(self, line, state):
+        return [], state
+
+
+class PythonLexer(Lexer):
+    TOKEN = re.compile(r"""
+        (?P<comment>\#.*)
+      | (?P<triple>[rRbBuUfF]{0,2}(?:'{3}|"{3}))
+      | (?P<string>[rRbBuUfF]{0,2}(?:"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?))
+      | (?P<decorator>@[\w.]+)
+      | (?P<number>\b(?:0[xXoObB][0-9a-fA-F_]+|\d[\d_]*\.?\d*(?:[eE][+-]?\d+)?j?)|\.\d+(?:[eE][+-]?\d+)?j?)
+      | (?P<name>[^\W\d]\w*)
+    """, re.VERBOSE)
+    TRIPLE_END = {
+        "'" * 3: re.compile(r"(?:\\.|[^\\])*?'{3}"),
+        '"' * 3: re.compile(r'(?:\\.|[^\\])*?"{3}'),
+    }
+    CONSTANTS = {"True", "False", "None"}
+    KEYWORDS = set(keyword.kwlist) - CONSTANTS
+    
+    def lex_line(self, line, state):
+        # Состояние - открытая тройная кавычка многострочной строки
+        tokens = []
+        pos = 0
+        if state is not None:
+            match = self.TRIPLE_END[state].match(line)
+            if match is None:
+                return [(0, len(line), "string")], state
+            tokens.append((0, match.end(), "string"))
+            pos = match.end()
+        
+        definition = False
+        while True:
+            match = self.TOKEN.search(line, pos)
+            if match is None:
+                break
+            kind = match.lastgroup
+            start, end = match.span()
+            pos = end
+            if kind == "triple":
+                delimiter = line[end - 3:end]
+                closing = self.TRIPLE_END[delimiter].match(line, end)
+                if closing is None:
+                    tokens.append((start, len(line), "string"))
+                    return tokens, delimiter
+                tokens.append((start, closing.end(), "string"))
+                pos = closing.end()
+                continue
+            if kind == "name":
+                word = match.group()
+                if word in self.KEYWORDS:
+                    kind = "keyword"
+                elif word in self.CONSTANTS:
+                    kind = "constant"
+                elif not definition:
+                    continue
+                definition = word in ("def", "class")
+            tokens.append((start, end, kind))
+        return tokens, None
+
+
+class JsonLexer(Lexer):
+    TOKEN = re.compile(r'(?P<string>"(?:[^"\\]|\\.)*"?)(?P<colon>\s*:)?'
+                       r'|(?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)'
+                       r'|(?P<constant>\b(?:true|false|null)\b)')
+    
+    def lex_line(self, line, state):
+        tokens = []
+        for match in self.TOKEN.finditer(line):
+            if match.group("string") is not None:
+                kind = "key" if match.group("colon") else "string"
+                tokens.append((match.start(), match.end("string"), kind))
+            else:
+                tokens.append((match.start(), match.end(), match.lastgroup))
+        return tokens, None
+
+
+class IniLexer(Lexer):
+    KEY = re.compile(r"\s*([^=:\s;#\[][^=:]*?)\s*[=:]")
+    
+    def lex_line(self, line, state):
+        stripped = line.lstrip()
+        start = len(line) - len(stripped)
+        if stripped.startswith((";", "#")):
+            return [(start, len(line), "comment")], None
+        if stripped.startswith("["):
+            return [(start, len(line.rstrip()), "section")], None
+        match = self.KEY.match(line)
+        if not match:
+            return [], None
+        tokens = [(match.start(1), match.end(1), "key")]
+        value = len(line) - len(line[match.end():].lstrip())
+        if value < len(line):
+            tokens.append((value, len(line), "string"))
+        return tokens, None
+
+
+LEXERS = {
+    ".py": PythonLexer,
+    ".pyw": PythonLexer,
+    ".json": JsonLexer,
+    ".ini": IniLexer,
+    ".cfg": IniLexer,
+    ".conf": IniLexer,
+}
+
+
+def lexer_for_path(path):
+    if not path:
+        return None
+    lexer_class = LEXERS.get(os.path.splitext(path)[1].lower())
+    return lexer_class() if lexer_class else None
+
+
+class SyntaxHighlighter:
+    # Инкрементальная подсветка. states[i] - состояние лексера на начало
+    # строки i (с нуля) для уже разобранного префикса [0, frontier). После
+    # правки разбираются только грязные строки, пока состояние не сойдется
+    # с прежним; сначала видимая область, остальное - порциями в простое.
+    # Теги подсветки лежат ниже пользовательских тегов tag_styles
+    def __init__(self, root, text_area, lexer):
+        self.root = root
+        self.text_area = text_area
+        self.lexer = lexer
+        self.tags = {kind: "syntax_" + kind for kind in SYNTAX_COLORS}
+        for kind, tag in self.tags.items():
+            text_area.tag_configure(tag, foreground=SYNTAX_COLORS[kind])
+            text_area.tag_lower(tag)
+        self.states = [lexer.initial_state]
+        self.frontier = 0
+        self.dirty = set()
+        self.provisional = None
+        self.job = None
+        self.schedule()
+    
+    def close(self):
+        if self.job is not None:
+            self.root.after_cancel(self.job)
+            self.job = None
+        self.text_area.tag_delete(*self.tags.values())
+    
+    def reset(self):
+        self.states = [self.lexer.initial_state]
+        self.frontier = 0
+        self.dirty = set()
+        self.provisional = None
+        self.schedule()
+    
+    def schedule(self, delay=None):
+        if self.job is None:
+            if delay is None:
+                self.job = self.root.after_idle(self.run)
+            else:
+                self.job = self.root.after(delay, self.run)
+    
+    def on_edit(self, kind, index, text):
+        if kind == "reset":
+            self.reset()
+            return
+        line = parse_index(index)[0] - 1
+        count = text.count("\n")
+        self.provisional = None
+        if line >= self.frontier:
+            self.schedule()
+            return
+        
+        if kind == "insert":
+            self.states[line + 1:line + 1] = [None] * count
+            self.frontier += count
+            self.dirty = {d + count if d > line else d for d in self.dirty}
+            self.dirty.update(range(line, line + count + 1))
+        elif line + count >= self.frontier:
+            del self.states[line + 1:]
+            self.frontier = line
+            self.dirty = {d for d in self.dirty if d < line}
+        else:
+            del self.states[line + 1:line + 1 + count]
+            self.frontier -= count
+            self.dirty = {d - count if d > line + count else d
+                          for d in self.dirty if not line < d <= line + count}
+            self.dirty.add(line)
+        self.dirty.discard(self.frontier)
+        self.schedule()
+    
+    def visible_lines(self):
+        first = parse_index(self.text_area.index("@0,0"))[0] - 1
+        last = parse_index(self.text_area.index(f"@0,{self.text_area.winfo_height()}"))[0] - 1
+        return first, last
+    
+    def run(self):
+        self.job = None
+        deadline = time.perf_counter() + HIGHLIGHT_BUDGET_MS / 1000
+        total = parse_index(self.text_area.index("end-1c"))[0]
+        
+        while self.dirty and time.perf_counter() < deadline:
+            self.lex(min(self.dirty), HIGHLIGHT_DIRTY_CHUNK, total)
+        
+        # Видимая область дальше разобранного префикса подсвечивается сразу
+        # с начальным состоянием, точный разбор дойдет до нее позже
+        first, last = self.visible_lines()
+        if not self.dirty and first > self.frontier and self.provisional != (first, last):
+            self.provisional = (first, last)
+            self.lex(first, last - first + 1, total, store=False)
+        
+        while not self.dirty and self.frontier < total and time.perf_counter() < deadline:
+            self.lex(self.frontier, HIGHLIGHT_CHUNK, total)
+        
+        if self.dirty or self.frontier < total:
+            self.schedule(1)
+    
+    def lex(self, start, count, total, store=True):
+        end = min(start + count, total)
+        if end <= start:
+            self.dirty.discard(start)
+            return
+        lines = self.text_area.get(f"{start + 1}.0", f"{end}.end").split("\n")
+        state = self.states[start] if store else self.lexer.initial_state
+        ranges = defaultdict(list)
+        line_number = start
+        for line in lines:
+            tokens, state = self.lexer.lex_line(line, state)
+            astral = not line.isascii() and tk_length(line) != len(line)
+            for token_start, token_end, kind in tokens:
+                if astral:
+                    token_start = tk_length(line[:token_start])
+                    token_end = tk_length(line[:token_end])
+                ranges[kind].extend((f"{line_number + 1}.{token_start}", f"{line_number + 1}.{token_end}"))
+            line_number += 1
+            if not store:
+                continue
+            self.dirty.discard(line_number - 1)
+            if line_number > self.frontier:
+                self.states.append(state)
+                self.frontier = line_number
+            elif self.states[line_number] == state and line_number not in self.dirty:
+                break
+            else:
+                self.states[line_number] = state
+                if line_number < self.frontier and line_number == start + len(lines):
+                    self.dirty.add(line_number)
+        
+        for tag in self.tags.values():
+            self.text_area.tag_remove(tag, f"{start + 1}.0", f"{line_number + 1}.0")
+        for kind, indices in ranges.items():
+            self.text_area.tag_add(self.tags[kind], *indices)
+
+
+class CountingTk:
+    # Обертка интерпретатора Tcl, которая считает обращения к Tk
+    def __init__(self, tkapp, profiler):
+        self.tkapp = tkapp
+        self.profiler = profiler
+    
+    def call(self, *args):
+        self.profiler.tk_calls += 1
+        return self.tkapp.call(*args)
+    
+    def eval(self, script):
+        self.profiler.tk_calls += 1
+        return self.tkapp.eval(script)
+    
+    def __getattr__(self, name):
+        return getattr(self.tkapp, name)
+
+
+class Profiler:
+    # Время и число обращений к Tk по каждой операции. Пока профилирование
+    # выключено, обертка методов сводится к проверке флага, а виджеты
+    # работают с интерпретатором Tcl напрямую
+    def __init__(self):
+        self.enabled = False
+        self.samples = defaultdict(lambda: deque(maxlen=PROFILE_RING_SIZE))
+        self.counts = defaultdict(int)
+        self.tk_calls = 0
+        self.tkapp = None
+    
+    def enable(self, root):
+        if self.enabled:
+            return
+        self.tkapp = root.tk
+        self.install(root, CountingTk(self.tkapp, self))
+        self.enabled = True
+    
+    def disable(self, root):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.install(root, self.tkapp)
+    
+    def install(self, widget, tk_object):
+        # Виджеты, созданные позже, наследуют tk от родителя
+        widget.tk = tk_object
+        for child in widget.winfo_children():
+            self.install(child, tk_object)
+    
+    def clear(self):
+        self.samples.clear()
+        self.counts.clear()
+    
+    def record(self, name, seconds, calls):
+        self.samples[name].append((seconds * 1000, calls))
+        self.counts[name] += 1
+    
+    def report(self):
+        report = {}
+        for name, samples in self.samples.items():
+            times = sorted(ms for ms, calls in samples)
+            
+            def percentile(fraction):
+                return times[min(len(times) - 1, int(fraction * len(times)))]
+            
+            report[name] = {
+                "count": self.counts[name],
+                "samples": len(times),
+                "total_ms": sum(times),
+                "p50_ms": percentile(0.5),
+                "p90_ms": percentile(0.9),
+                "p99_ms": percentile(0.99),
+                "max_ms": times[-1],
+                "tk_calls": sum(calls for ms, calls in samples) / len(samples),
+            }
+        return report
+
+
+PROFILER = Profiler()
+
+
+def profiled(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = PROFILER
+        if not profiler.enabled:
+            return func(*args, **kwargs)
+        calls = profiler.tk_calls
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.record(name, time.perf_counter() - started, profiler.tk_calls - calls)
+    return wrapper
+
+
+def instrument(cls, names=None):
+    # Оборачивает методы класса (по умолчанию все, кроме служебных и
+    # методов самого профилирования) один раз при загрузке модуля
+    for name, value in list(vars(cls).items()):
+        if names is not None and name not in names:
+            continue
+        if not callable(value) or isinstance(value, (staticmethod, classmethod, type)):
+            continue
+        if name.startswith("__") or "profil" in name:
+            continue
+        setattr(cls, name, profiled(f"{cls.__name__}.{name}", value))
+
+
+def batch_rewrite(path, target, source_format, options):
+    encoding, bom, newline = source_format
+    if options["encoding"]:
+        encoding = options["encoding"]
+        bom = options["bom"]
+    newline = options["newline"] or newline
+    chunks = read_text_chunks(path, source_format)
+    count = 0
+    if options["pattern"] is not None:
+        pattern = options["pattern"]
+        replacement = options["replacement"]
+        # Шаблон без обратных косых черт подставляется как есть, без разбора
+        # на каждом совпадении
+        literal = "\\" not in replacement
+        
+        # Совпадения, кончающиеся ближе BATCH_MATCH_LIMIT к концу прочитанного,
+        # откладываются до следующей части. Перед необработанным хвостом
+        # остается столько же обработанного текста для ^, \b и ретроспективных
+        # проверок; пустые совпадения, как и в редакторе, пропускаются
+        def replaced(chunks):
+            nonlocal count
+            chunks = iter(chunks)
+            buffer = ""
+            context = 0
+            final = False
+            while not final:
+                chunk = next(chunks, None)
+                final = chunk is None
+                if not final:
+                    buffer += chunk
+                limit = len(buffer) if final else len(buffer) - BATCH_MATCH_LIMIT
+                if limit <= context:
+                    continue
+                pieces = []
+                position = context
+                cut = limit
+                for match in pattern.finditer(buffer, context):
+                    if not final and match.end() - match.start() > BATCH_MATCH_LIMIT:
+                        raise ValueError(f"совпадение длиннее {BATCH_MATCH_LIMIT} символов")
+                    if match.end() > limit:
+                        cut = max(position, min(limit, match.start()))
+                        break
+                    if match.start() == match.end():
+                        continue
+                    pieces.append(buffer[position:match.start()])
+                    pieces.append(replacement if literal else match.expand(replacement))
+                    position = match.end()
+                    count += 1
+                pieces.append(buffer[position:cut])
+                yield "".join(pieces)
+                keep = max(0, cut - BATCH_MATCH_LIMIT)
+                buffer = buffer[keep:]
+                context = cut - keep
+        
+        chunks = replaced(chunks)
+    write_text_file(target, chunks, (encoding, bom, newline), options["fsync"], options["umask"])
+    return count
+
+
+def batch_convert(path, target, options):
+    source_format = detect_text_format(path)
+    try:
+        return batch_rewrite(path, target, source_format, options)
+    except UnicodeDecodeError:
+        # Как при открытии в редакторе: образец был в UTF-8, а дальше нет
+        if source_format[:2] != ("utf-8", b""):
+            raise
+        return batch_rewrite(path, target, (FALLBACK_ENCODING, b"", source_format[2]), options)
+
+
+def batch_export(path, target, options):
+    if path.lower().endswith(RICH_EXTENSION):
+        with open(path, 'r', encoding='utf-8') as file:
+            text, styles, runs = decode_rich_document(file.read())
+    else:
+        text_format = detect_text_format(path)
+        try:
+            text = "".join(read_text_chunks(path, text_format))
+        except UnicodeDecodeError:
+            if text_format[:2] != ("utf-8", b""):
+                raise
+            text = "".join(read_text_chunks(path, (FALLBACK_ENCODING, b"", text_format[2])))
+        styles, runs = [], [len(text), -1] if text else []
+    family, size = options["font"]
+    writer = EXPORT_WRITERS[options["export"]](
+        [export_properties(style, family, size, hex_rgb) for style in styles],
+        {"family": family, "size": size}, os.path.basename(path))
+    writer.write(target, text, runs)
+    return 0
+
+
+def batch_process(task):
+    # Выполняется в процессе пула, одна задача - один файл. Итог:
+    # (путь, ошибка или None, байт прочитано, байт записано, замен, секунд)
+    path, target, options = task
+    start = time.perf_counter()
+    try:
+        size = os.path.getsize(path)
+        if options["export"]:
+            count = batch_export(path, target, options)
+        else:
+            count = batch_convert(path, target, options)
+        return path, None, size, os.path.getsize(target), count, time.perf_counter() - start
+    except Exception as e:
+        return path, f"{type(e).__name__}: {e}", 0, 0, 0, time.perf_counter() - start
+
+
+def batch_tasks(paths, output, include, export):
+    # Папки обходятся рекурсивно; с --output структура папок повторяется там
+    for root_path in paths:
+        if os.path.isdir(root_path):
+            files = []
+            for directory, dirnames, filenames in os.walk(root_path):
+                dirnames.sort()
+                files.extend(os.path.join(directory, name) for name in sorted(filenames)
+                             if fnmatch.fnmatch(name, include))
+            base = root_path
+        else:
+            files = [root_path]
+            base = os.path.dirname(root_path)
+        for path in files:
+            target = os.path.join(output, os.path.relpath(path, base)) if output else path
+            if export:
+                target = os.path.splitext(target)[0] + export
+            yield path, target
+
+
+def run_batch(argv):
+    # Пакетная обработка без окна: каждый файл - отдельная задача в пуле
+    # процессов, так что тысячи файлов распределяются по всем ядрам
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]),
+        description="Пакетная обработка файлов без запуска окна редактора")
+    parser.add_argument("paths", nargs="+", help="файлы и папки (обходятся рекурсивно)")
+    parser.add_argument("--include", default="*", help="маска имен файлов в папках, например *.log")
+    parser.add_argument("-o", "--output", help="папка для результатов (по умолчанию файлы меняются на месте)")
+    parser.add_argument("--encoding", help="перекодировать в заданную кодировку")
+    parser.add_argument("--bom", action="store_true", help="записать BOM (для UTF-8/16/32)")
+    parser.add_argument("--newline", choices=("lf", "crlf", "cr"), help="привести переводы строк")
+    parser.add_argument("--find", help="что найти")
+    parser.add_argument("--replace", default="", help="на что заменить")
+    parser.add_argument("--regex", action="store_true", help="--find - регулярное выражение")
+    parser.add_argument("--ignore-case", action="store_true", help="без учета регистра")
+    parser.add_argument("--export", choices=("html", "rtf"), help="экспорт (в том числе .mip с форматированием)")
+    parser.add_argument("--font", default="Ubuntu Mono", help="шрифт текста при экспорте")
+    parser.add_argument("--font-size", type=int, default=12, help="размер шрифта при экспорте")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="none", help="политика fsync при записи")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="число процессов")
+    parser.add_argument("-q", "--quiet", action="store_true", help="только итоговая сводка")
+    args = parser.parse_args(argv)
+    
+    if args.export and (args.encoding or args.newline or args.find):
+        parser.error("--export не сочетается с перекодированием и заменой")
+    if not (args.export or args.encoding or args.newline or args.find):
+        parser.error("не задано ни одного действия: --encoding, --newline, --find или --export")
+    encoding = None
+    bom = b""
+    if args.encoding:
+        try:
+            encoding = codecs.lookup(args.encoding).name
+        except LookupError:
+            parser.error(f"неизвестная кодировка: {args.encoding}")
+        # utf-16, utf-32 и utf-8-sig пишут BOM сами
+        if args.bom and encoding not in ("utf-16", "utf-32", "utf-8-sig"):
+            bom = next((mark for mark, name in BOMS if name == encoding), None)
+            if bom is None:
+                parser.error(f"у кодировки {encoding} нет BOM")
+    pattern = None
+    replacement = args.replace
+    if args.find:
+        query = args.find if args.regex else re.escape(args.find)
+        try:
+            pattern = re.compile(query, (re.IGNORECASE if args.ignore_case else 0) | re.MULTILINE)
+        except re.error as e:
+            parser.error(f"ошибка в выражении: {e}")
+        if not args.regex:
+            replacement = replacement.replace("\\", "\\\\")
+    
+    umask = os.umask(0)
+    os.umask(umask)
+    options = {
+        "encoding": encoding,
+        "bom": bom,
+        "newline": {"lf": "\n", "crlf": "\r\n", "cr": "\r"}.get(args.newline),
+        "pattern": pattern,
+        "replacement": replacement,
+        "export": f".{args.export}" if args.export else None,
+        "font": (args.font, args.font_size),
+        "fsync": args.fsync,
+        "umask": umask,
+    }
+    tasks = list(batch_tasks(args.paths, args.output, args.include, options["export"]))
+    for directory in {os.path.dirname(target) for path, target in tasks}:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    
+    started = time.perf_counter()
+    errors = 0
+    total_in = total_out = total_count = 0
+    busy = 0.0
+    jobs = max(1, args.jobs)
+    # Задачи уходят в процессы пачками: на мелких файлах пересылка по одной
+    # дороже самой обработки, а на крупных пачка из одного-двух файлов
+    chunksize = max(1, min(BATCH_MAX_CHUNK, len(tasks) // (jobs * 8)))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(batch_process, [(path, target, options) for path, target in tasks], chunksize=chunksize)
+        for path, error, size_in, size_out, count, seconds in results:
+            busy += seconds
+            if error is not None:
+                errors += 1
+                print(f"ОШИБКА {path}: {error}", file=sys.stderr)
+                continue
+            total_in += size_in
+            total_out += size_out
+            total_count += count
+            if not args.quiet:
+                replaced = f"  замен: {count}" if pattern is not None else ""
+                print(f"{seconds * 1000:10.1f} мс {size_in / 1048576:10.2f} МБ  {path}{replaced}")
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    
+    replaced = f", замен: {total_count}" if pattern is not None else ""
+    print(f"Файлов: {len(tasks)}, ошибок: {errors}{replaced}")
+    print(f"Прочитано {total_in / 1048576:.1f} МБ, записано {total_out / 1048576:.1f} МБ за {elapsed:.2f} с: "
+          f"{total_in / 1048576 / elapsed:.1f} МБ/с, {len(tasks) / elapsed:.0f} файлов/с")
+    print(f"Процессов: {jobs}, загрузка пула: {busy / elapsed / jobs * 100:.0f}%")
+    return 1 if errors else 0
+
 
 class TextEditor:
     def __init__(self, root):
@@ -10,7 +3301,19 @@ class TextEditor:
         self.root.title("Текстовый редактор")
         self.root.geometry("1000x600")
         
-        self.current_file = None
+        self.loader = None
+        self.paster = None
+        self.follower = None
+        self.large_view = None
+        self.highlighter = None
+        self.switching = False
+        self.save_job = None
+        self.export_results = queue.Queue()
+        self.export_job = None
+        self.export_count = 0
+        self.fsync_policy = "file"
+        self.undo_budget_mb = UNDO_BUDGET_MB
+        self.show_line_numbers = True
         self.default_font_family = "Ubuntu Mono"
         self.default_font_size = 12
         self.default_bg_color = "#300a24"
@@ -19,14 +3322,145 @@ class TextEditor:
         self.set_dark_theme()
         
         self.load_settings()
+        self.saver = BackgroundSaver(self.fsync_policy)
         self.setup_tags()
         self.create_menu()
         self.create_toolbar()
+        self.create_tab_bar()
         self.create_text_area()
         self.create_status_bar()
         
         self.bind_events()
+        self.setup_journal()
+        
+        self.font_window = None
+        self.font_job = None
+        self.font_preview_job = None
+        self.font_catalog = FontCatalog(FONT_CACHE_FILE)
+        self.refresh_font_catalog()
+        
+        self.profile_window = None
+        self.profile_job = None
+        if os.environ.get(PROFILE_ENV):
+            self.profiling_var.set(True)
+            self.toggle_profiling()
+        
+    @property
+    def current_file(self):
+        return self.document.path
+    
+    @current_file.setter
+    def current_file(self, file_path):
+        self.document.path = file_path
+        self.update_tab_bar()
+    
+    def setup_journal(self):
+        # Свой журнал блокируется до поиска чужих, поэтому второй экземпляр
+        # редактора в той же папке не примет его за журнал упавшего процесса
+        self.journal = EditJournal(JOURNAL_FILE.format(pid=os.getpid()))
+        self.edit_hook.add_listener(self.on_journal_edit)
+        
+        # Восстанавливается один журнал за запуск, остальные ждут следующего
+        for path, lock in EditJournal.orphans():
+            records = EditJournal.read(path)
+            if len(records) > 1 and messagebox.askyesno(
+                    "Восстановление", "Найдены несохраненные правки прошлого сеанса.\nВосстановить их?"):
+                try:
+                    self.replay_journal(records)
+                    return
+                except Exception as e:
+                    self.text_area.delete(1.0, tk.END)
+                    messagebox.showerror("Ошибка", f"Не удалось восстановить правки:\n{str(e)}")
+                    break
+                finally:
+                    EditJournal.discard(path, lock)
+            EditJournal.discard(path, lock)
+        self.journal.start(["b", None, 0, 0, False])
+        self.root.after(JOURNAL_FLUSH_MS, self.poll_journal)
+    
+    def journal_baseline(self, file_path, saved=False):
+        # Обычное сохранение дописывает завершающий перевод строки виджета,
+        # при восстановлении он отрезается
+        stat = os.stat(file_path)
+        strip = saved and not file_path.lower().endswith(RICH_EXTENSION)
+        return ["b", file_path, stat.st_size, stat.st_mtime_ns, strip]
+    
+    def journal_snapshot(self):
+        return ["s", self.current_file, encode_rich_document(*self.rich_document_snapshot())]
+    
+    def on_journal_edit(self, kind, index, text):
+        if kind == "insert":
+            self.journal.record(["i", index, text])
+        elif kind == "delete":
+            self.journal.record(["d", index, format_index(text_end(parse_index(index), text))])
+        elif self.journal.active:
+            self.journal.needs_snapshot = True
+    
+    def poll_journal(self):
+        error = None
+        while True:
+            try:
+                error = self.journal.errors.get_nowait()
+            except queue.Empty:
+                break
+        if error is not None:
+            self.status_bar.config(text=f"Ошибка записи журнала правок: {error}")
+        if self.journal.needs_snapshot and self.journal.active:
+            self.journal.start(self.journal_snapshot())
+        self.root.after(JOURNAL_FLUSH_MS, self.poll_journal)
+    
+    def replay_journal(self, records):
+        header = records[0]
+        if header[0] == "s":
+            file_path = header[1]
+            self.load_rich_text(*decode_rich_document(header[2]))
+        else:
+            file_path, size, mtime, strip = header[1:5]
+            if file_path:
+                stat = os.stat(file_path)
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                    raise ValueError(f"Файл изменился после начала журнала: {file_path}")
+                self.load_document(file_path, strip)
+        
+        for record in records[1:]:
+            if record[0] == "i":
+                self.text_area.insert(record[1], record[2])
+            elif record[0] == "d":
+                self.text_area.delete(record[1], record[2])
+            elif record[0] == "f":
+                style = record[3]
+                self.restyle_range(parse_index(record[1]), parse_index(record[2]),
+                                   lambda current: dict(style) if style else {})
         
+        self.history.clear()
+        self.current_file = file_path
+        if header[0] == "s" and file_path and os.path.exists(file_path) and not file_path.lower().endswith(RICH_EXTENSION):
+            self.document.text_format = detect_text_format(file_path)
+        self.set_highlighting(file_path)
+        name = os.path.basename(file_path) if file_path else "Новый файл"
+        self.root.title(f"Текстовый редактор - {name}")
+        self.status_bar.config(text=f"Восстановлено правок: {len(records) - 1}")
+        self.journal.start(self.journal_snapshot())
+        self.root.after(JOURNAL_FLUSH_MS, self.poll_journal)
+    
+    def load_document(self, file_path, strip_newline=False):
+        # Синхронная загрузка целиком - для восстановления журнала
+        if file_path.lower().endswith(RICH_EXTENSION):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                self.load_rich_text(*decode_rich_document(file.read()))
+            return
+        text_format = detect_text_format(file_path)
+        with open(file_path, 'r', encoding=text_format[0]) as file:
+            content = file.read()
+        if text_format[1]:
+            content = content[1:]
+        self.document.text_format = text_format
+        self.set_wrap(not has_long_line(file_path, LONG_LINE_WRAP_LIMIT))
+        if strip_newline and content.endswith("\n"):
+            content = content[:-1]
+        self.text_area.delete(1.0, tk.END)
+        self.text_area.insert(1.0, content)
+    
     def load_settings(self):
         self.settings_file = "text_editor_settings.json"
         default_settings = {
@@ -34,6 +3468,9 @@ class TextEditor:
             "font_size": 12,
             "bg_color": "#300a24",
             "fg_color": "#ffffff",
+            "fsync_policy": "file",
+            "undo_budget_mb": UNDO_BUDGET_MB,
+            "line_numbers": True,
             "recent_files": []
         }
         
@@ -45,6 +3482,11 @@ class TextEditor:
                     self.default_font_size = settings.get('font_size', self.default_font_size)
                     self.default_bg_color = settings.get('bg_color', self.default_bg_color)
                     self.default_fg_color = settings.get('fg_color', self.default_fg_color)
+                    if settings.get('fsync_policy') in FSYNC_POLICIES:
+                        self.fsync_policy = settings['fsync_policy']
+                    if isinstance(settings.get('undo_budget_mb'), (int, float)) and settings['undo_budget_mb'] > 0:
+                        self.undo_budget_mb = settings['undo_budget_mb']
+                    self.show_line_numbers = bool(settings.get('line_numbers', self.show_line_numbers))
         except Exception as e:
             print(f"Ошибка загрузки настроек: {e}")
     
@@ -54,6 +3496,9 @@ class TextEditor:
             "font_size": self.default_font_size,
             "bg_color": self.default_bg_color,
             "fg_color": self.default_fg_color,
+            "fsync_policy": self.fsync_policy,
+            "undo_budget_mb": self.undo_budget_mb,
+            "line_numbers": self.show_line_numbers,
             "recent_files": []
         }
         
@@ -66,6 +3511,12 @@ class TextEditor:
     def setup_tags(self):
         self.tag_counter = 0
         self.tag_styles = {}
+        # Канонический стиль -> тег, одинаковые стили делят один тег
+        self.style_tags = {}
+        # Модель документа повторяет виджет и ведет индекс стилей
+        self.model = DocumentModel()
+        self.style_runs = self.model.styles
+        self.tags_dirty = False
         
     def set_dark_theme(self):
         self.bg_color = self.default_bg_color
@@ -75,6 +3526,7 @@ class TextEditor:
         self.highlight_color = "#4a1e3d"
         self.accent_color = "#e95420"
         self.button_bg = "#4a1e3d"
+        self.gutter_fg = "#9c7b90"
         
         self.root.configure(bg=self.bg_color)
         
@@ -86,6 +3538,12 @@ class TextEditor:
         file_menu.add_command(label="Открыть", command=self.open_file, accelerator="Ctrl+O")
         file_menu.add_command(label="Сохранить", command=self.save_file, accelerator="Ctrl+S")
         file_menu.add_command(label="Сохранить как...", command=self.save_as_file)
+        file_menu.add_command(label="Экспорт в HTML/RTF...", command=self.export_document)
+        self.follow_var = tk.BooleanVar(value=False)
+        file_menu.add_checkbutton(label="Следить за файлом", variable=self.follow_var, command=self.toggle_follow)
+        file_menu.add_separator()
+        file_menu.add_command(label="Закрыть вкладку", command=lambda: self.close_document(self.document), accelerator="Ctrl+W")
+        file_menu.add_command(label="Следующая вкладка", command=lambda: self.cycle_document(1), accelerator="Ctrl+Tab")
         file_menu.add_separator()
         file_menu.add_command(label="Выход", command=self.exit_app)
         menubar.add_cascade(label="Файл", menu=file_menu)
@@ -99,6 +3557,13 @@ class TextEditor:
         edit_menu.add_command(label="Вырезать", command=self.cut_text, accelerator="Ctrl+X")
         edit_menu.add_command(label="Копировать", command=self.copy_text, accelerator="Ctrl+C")
         edit_menu.add_command(label="Вставить", command=self.paste_text, accelerator="Ctrl+V")
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Найти и заменить...", command=self.show_search_bar, accelerator="Ctrl+F")
+        edit_menu.add_command(label="Перейти к строке...", command=self.goto_line_dialog, accelerator="Ctrl+G")
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Статистика", command=self.toggle_stats_panel)
+        self.line_numbers_var = tk.BooleanVar(value=self.show_line_numbers)
+        edit_menu.add_checkbutton(label="Номера строк", variable=self.line_numbers_var, command=self.toggle_line_numbers)
         menubar.add_cascade(label="Правка", menu=edit_menu)
         
         format_menu = tk.Menu(menubar, tearoff=0, bg=self.menu_bg, fg=self.menu_fg, bd=0)
@@ -114,6 +3579,14 @@ class TextEditor:
         format_menu.add_command(label="Очистить форматирование", command=self.clear_formatting)
         menubar.add_cascade(label="Формат", menu=format_menu)
         
+        tools_menu = tk.Menu(menubar, tearoff=0, bg=self.menu_bg, fg=self.menu_fg, bd=0)
+        self.profiling_var = tk.BooleanVar(value=False)
+        tools_menu.add_checkbutton(label="Профилирование", variable=self.profiling_var, command=self.toggle_profiling)
+        tools_menu.add_command(label="Окно профиля", command=self.show_profile_window)
+        tools_menu.add_command(label="Экспорт профиля в JSON...", command=self.export_profile)
+        tools_menu.add_command(label="Сбросить профиль", command=PROFILER.clear)
+        menubar.add_cascade(label="Сервис", menu=tools_menu)
+        
         help_menu = tk.Menu(menubar, tearoff=0, bg=self.menu_bg, fg=self.menu_fg, bd=0)
         help_menu.add_command(label="О программе", command=self.about_program)
         help_menu.add_command(label="От разработчика", command=self.about_developer)
@@ -134,10 +3607,21 @@ class TextEditor:
         self.root.bind('<Control-b>', lambda e: self.apply_formatting('bold'))
         self.root.bind('<Control-i>', lambda e: self.apply_formatting('italic'))
         self.root.bind('<Control-u>', lambda e: self.apply_formatting('underline'))
+        self.root.bind('<Escape>', lambda e: self.cancel_loading())
+        self.root.bind('<Control-g>', lambda e: self.goto_line_dialog())
+        self.root.bind('<Control-f>', lambda e: self.show_search_bar())
+        self.root.bind('<Control-w>', lambda e: self.close_document(self.document))
+        # Класс Text сам вставляет буфер по <<Paste>> (на X11 это и Ctrl+V)
+        # одним синхронным insert и раньше привязок окна - перехватываем
+        self.text_area.bind('<<Paste>>', lambda e: self.paste_text())
+        self.text_area.bind('<<Cut>>', lambda e: self.cut_text())
+        self.text_area.bind('<Control-Tab>', lambda e: self.cycle_document(1))
+        self.text_area.bind('<Control-Shift-Tab>', lambda e: self.cycle_document(-1))
+        self.text_area.bind('<Control-ISO_Left_Tab>', lambda e: self.cycle_document(-1))
         
         self.text_area.bind('<ButtonRelease-1>', self.on_selection_change)
         self.text_area.bind('<KeyRelease>', self.on_selection_change)
-        self.text_area.bind('<Configure>', self.on_selection_change)
+        self.text_area.bind('<Configure>', self.on_text_configure)
     
     def create_toolbar(self):
         toolbar = tk.Frame(self.root, bg=self.bg_color, bd=0, relief=tk.FLAT, height=35)
@@ -197,6 +3681,158 @@ class TextEditor:
         toolbar.pack(side=tk.TOP, fill=tk.X)
         toolbar.pack_propagate(False)
     
+    def create_tab_bar(self):
+        self.tab_bar = tk.Frame(self.root, bg=self.menu_bg, bd=0, height=26)
+        self.tab_bar.pack(side=tk.TOP, fill=tk.X)
+        self.tab_bar.pack_propagate(False)
+        self.document = self.create_document()
+        self.documents = [self.document]
+        self.history = self.document.history
+        self.update_tab_bar()
+    
+    def create_document(self, file_path=None):
+        return Document(file_path, int(self.undo_budget_mb * 1024 * 1024))
+    
+    def update_tab_bar(self):
+        # Вкладки перерисовываются целиком: их немного и меняются они редко
+        for child in self.tab_bar.winfo_children():
+            child.destroy()
+        for document in self.documents:
+            bg = self.highlight_color if document is self.document else self.menu_bg
+            name = os.path.basename(document.path) if document.path else "Новый файл"
+            if document.modified:
+                name += " *"
+            tab = tk.Frame(self.tab_bar, bg=bg)
+            tab.pack(side=tk.LEFT, fill=tk.Y, padx=(0, 1))
+            label = tk.Label(tab, text=name, bg=bg, fg=self.menu_fg, font=("Ubuntu", 9), padx=8)
+            label.pack(side=tk.LEFT, fill=tk.Y)
+            close_label = tk.Label(tab, text="×", bg=bg, fg=self.menu_fg, font=("Ubuntu", 9), padx=4)
+            close_label.pack(side=tk.LEFT, fill=tk.Y)
+            for widget in (tab, label):
+                widget.bind('<Button-1>', lambda e, d=document: self.switch_document(d))
+                widget.bind('<Button-2>', lambda e, d=document: self.close_document(d))
+            close_label.bind('<Button-1>', lambda e, d=document: self.close_document(d))
+    
+    def set_modified(self, modified):
+        if self.document.modified != modified:
+            self.document.modified = modified
+            self.update_tab_bar()
+    
+    def mark_loaded(self):
+        # Документ совпадает с файлом на диске: истории и изменений нет
+        self.history.clear()
+        self.document.changes.clear()
+        self.document.saved = False
+        self.set_modified(False)
+    
+    def switch_document(self, document):
+        if document is self.document:
+            return
+        if self.loader is not None:
+            self.status_bar.config(text="Файл еще загружается")
+            return
+        self.stash_document()
+        self.show_document(document)
+    
+    def cycle_document(self, step):
+        index = self.documents.index(self.document)
+        self.switch_document(self.documents[(index + step) % len(self.documents)])
+        return "break"
+    
+    def open_document(self, document):
+        # Новая вкладка открывается справа от активной
+        self.stash_document()
+        self.documents.insert(self.documents.index(self.document) + 1, document)
+        self.show_document(document)
+    
+    def close_document(self, document):
+        if self.loader is not None:
+            self.status_bar.config(text="Файл еще загружается")
+            return
+        self.finish_paste()
+        name = os.path.basename(document.path) if document.path else "Новый файл"
+        if document.modified and not messagebox.askokcancel(
+                "Закрыть вкладку", f"Изменения в «{name}» не сохранены.\nЗакрыть вкладку?"):
+            return
+        index = self.documents.index(document)
+        self.documents.remove(document)
+        if document is not self.document:
+            self.update_tab_bar()
+            return
+        
+        self.journal.stop()
+        self.clear_document()
+        if not self.documents:
+            self.documents.append(self.create_document())
+        self.show_document(self.documents[min(index, len(self.documents) - 1)])
+    
+    def stash_document(self):
+        # Активный документ сворачивается в буфер, виджет освобождается
+        self.finish_paste()
+        document = self.document
+        document.large = self.large_view is not None
+        if document.large:
+            document.view = (self.large_view.top, self.large_view.left)
+        else:
+            document.cursor = self.text_area.index(tk.INSERT)
+            document.view = self.text_area.index("@0,0")
+            document.text, document.styles, document.runs = self.rich_document_snapshot()
+        self.journal.stop()
+        self.clear_document()
+    
+    def clear_document(self):
+        self.close_follower()
+        self.close_large_view()
+        self.set_highlighting(None)
+        self.search_worker.cancel()
+        self.search_generation = None
+        self.search_backlog = []
+        self.switching = True
+        try:
+            self.text_area.delete(1.0, tk.END)
+        finally:
+            self.switching = False
+        if self.tag_styles:
+            self.text_area.tag_delete(*self.tag_styles)
+        self.tag_styles.clear()
+        self.style_tags.clear()
+        self.style_runs.clear()
+        self.tag_counter = 0
+    
+    def show_document(self, document):
+        # Буфер переносится в виджет одной пакетной вставкой текста и стилей
+        self.document = document
+        self.history = document.history
+        if document.large:
+            self.open_large_file(document.path)
+            self.large_view.restore(*document.view)
+            self.update_tab_bar()
+            return
+        
+        self.set_wrap(document.wrap)
+        self.switching = True
+        try:
+            self.load_rich_text(document.text, document.styles, document.runs)
+        finally:
+            self.switching = False
+        header = ["b", None, 0, 0, False]
+        if document.modified or (document.path and not os.path.exists(document.path)):
+            header = ["s", document.path, encode_rich_document(document.text, document.styles, document.runs)]
+        elif document.path:
+            header = self.journal_baseline(document.path, document.saved)
+        document.text, document.styles, document.runs = "", [], []
+        
+        self.text_area.mark_set(tk.INSERT, document.cursor)
+        self.text_area.yview(document.view)
+        self.set_highlighting(document.path)
+        self.journal.start(header)
+        if document.follow:
+            self.start_following()
+        name = os.path.basename(document.path) if document.path else "Новый файл"
+        self.root.title(f"Текстовый редактор - {name}")
+        self.update_tab_bar()
+        self.schedule_status_update()
+    
     def create_text_area(self):
         self.text_area = tk.Text(self.root, 
                                 wrap=tk.WORD,
@@ -205,16 +3841,95 @@ class TextEditor:
                                 fg=self.default_fg_color,
                                 insertbackground=self.default_fg_color,
                                 selectbackground=self.accent_color,
-                                undo=True,
+                                undo=False,
                                 relief=tk.FLAT,
                                 bd=0,
                                 padx=15,
                                 pady=15,
-                                highlightthickness=0)
+                                highlightthickness=0,
+                                yscrollcommand=self.on_text_scroll)
         
         self.text_area.pack(fill=tk.BOTH, expand=True)
+        self.gutter = LineNumberGutter(self.root, self.text_area, self.menu_bg, self.gutter_fg, self.accent_color)
+        if self.show_line_numbers:
+            self.gutter.canvas.pack(side=tk.LEFT, fill=tk.Y, before=self.text_area)
+        # Горизонтальная прокрутка видна, только когда перенос строк отключен
+        self.xscrollbar = tk.Scrollbar(self.root, orient=tk.HORIZONTAL, command=self.text_area.xview)
+        self.text_area.configure(xscrollcommand=self.xscrollbar.set)
+        
+        self.edit_hook = EditInterceptor(self.text_area)
+        self.doc_stats = DocumentStats()
+        self.edit_hook.add_listener(self.doc_stats.on_edit)
+        # История читает стили удаленного текста до того, как индекс стилей сдвинется
+        self.edit_hook.add_listener(self.on_history_edit)
+        self.edit_hook.add_listener(self.on_model_edit)
+        self.edit_hook.add_listener(self.on_syntax_edit)
+        self.edit_hook.add_listener(self.on_gutter_edit)
+        self.root.after(TAG_GC_INTERVAL_MS, self.schedule_tag_gc)
+        
+        # Порядок областей - порядок обновления за проход
+        self.refresh = RefreshScheduler(self.root)
+        self.refresh.add_region("large_view", self.refresh_large_view)
+        self.refresh.add_region("syntax", self.refresh_syntax)
+        self.refresh.add_region("gutter", self.refresh_gutter)
+        self.refresh.add_region("status", self.update_status)
+        
         self.create_context_menu()
     
+    def set_wrap(self, wrap):
+        # Раскладка с переносом по словам на строках в сотни килобайт
+        # пересчитывается при каждом движении курсора
+        self.document.wrap = wrap
+        self.text_area.configure(wrap=tk.WORD if wrap else tk.NONE)
+        if wrap:
+            self.xscrollbar.pack_forget()
+        elif not self.xscrollbar.winfo_ismapped():
+            self.xscrollbar.pack(fill=tk.X, after=self.text_area)
+    
+    def set_highlighting(self, file_path):
+        # Лексер выбирается по расширению файла
+        lexer = lexer_for_path(file_path)
+        if self.highlighter is not None:
+            if lexer is not None and type(lexer) is type(self.highlighter.lexer):
+                return
+            self.highlighter.close()
+            self.highlighter = None
+        if lexer is not None:
+            self.highlighter = SyntaxHighlighter(self.root, self.text_area, lexer)
+    
+    def on_syntax_edit(self, kind, index, text):
+        if self.highlighter is not None:
+            self.highlighter.on_edit(kind, index, text)
+    
+    def on_text_scroll(self, first, last):
+        self.refresh.mark("gutter")
+        if self.highlighter is not None:
+            self.refresh.mark("syntax")
+    
+    def on_gutter_edit(self, kind, index, text):
+        self.refresh.mark("gutter")
+    
+    def refresh_gutter(self):
+        if not self.show_line_numbers:
+            return
+        if self.large_view is not None:
+            self.gutter.redraw(self.large_view.index.known_lines(), self.large_view.window_start - 1)
+        else:
+            self.gutter.redraw(self.model.line_count, 0, self.document.changes)
+    
+    def toggle_line_numbers(self):
+        self.show_line_numbers = self.line_numbers_var.get()
+        if self.show_line_numbers:
+            self.gutter.canvas.pack(side=tk.LEFT, fill=tk.Y, before=self.text_area)
+            self.refresh.mark("gutter")
+        else:
+            self.gutter.canvas.pack_forget()
+        self.save_settings()
+    
+    def refresh_syntax(self):
+        if self.highlighter is not None:
+            self.highlighter.schedule()
+    
     def create_context_menu(self):
         self.context_menu = tk.Menu(self.text_area, tearoff=0, bg=self.menu_bg, fg=self.menu_fg, bd=0)
         
@@ -269,112 +3984,575 @@ class TextEditor:
                                   padx=10,
                                   pady=3,
                                   highlightthickness=0)
-        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        # Строка состояния - во всю ширину окна, под полосой номеров строк
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X, after=self.tab_bar)
+        self.create_search_bar()
+        self.create_stats_panel()
+    
+    def create_search_bar(self):
+        self.search_bar = tk.Frame(self.root, bg=self.menu_bg, padx=10, pady=4)
+        self.search_worker = SearchWorker()
+        self.search_job = None
+        self.search_poll_job = None
+        self.search_generation = None
+        self.search_backlog = []
+        self.search_count = 0
+        self.search_edit_count = 0
+        self.edit_count = 0
+        self.edit_hook.add_listener(self.on_search_edit)
+        
+        label_style = {'bg': self.menu_bg, 'fg': self.menu_fg, 'font': ("Ubuntu", 9)}
+        entry_style = {'bg': self.bg_color, 'fg': self.fg_color, 'insertbackground': self.fg_color,
+                       'relief': tk.FLAT, 'font': ("Ubuntu", 10), 'highlightthickness': 0, 'width': 25}
+        check_style = {'bg': self.menu_bg, 'fg': self.menu_fg, 'selectcolor': self.bg_color,
+                       'activebackground': self.menu_bg, 'activeforeground': self.menu_fg,
+                       'font': ("Ubuntu", 9), 'highlightthickness': 0, 'bd': 0}
+        button_style = {'bg': self.button_bg, 'fg': self.fg_color, 'relief': tk.FLAT, 'bd': 0,
+                        'font': ("Ubuntu", 9), 'highlightthickness': 0, 'padx': 8,
+                        'activebackground': self.accent_color, 'activeforeground': self.fg_color}
+        
+        self.search_var = tk.StringVar()
+        self.replace_var = tk.StringVar()
+        self.search_regex = tk.BooleanVar(value=False)
+        self.search_case = tk.BooleanVar(value=False)
+        
+        tk.Label(self.search_bar, text="Найти:", **label_style).pack(side=tk.LEFT)
+        self.search_entry = tk.Entry(self.search_bar, textvariable=self.search_var, **entry_style)
+        self.search_entry.pack(side=tk.LEFT, padx=(5, 10))
+        tk.Label(self.search_bar, text="Заменить:", **label_style).pack(side=tk.LEFT)
+        tk.Entry(self.search_bar, textvariable=self.replace_var, **entry_style).pack(side=tk.LEFT, padx=(5, 10))
+        tk.Checkbutton(self.search_bar, text="Регулярное выражение", variable=self.search_regex,
+                       command=self.schedule_search, **check_style).pack(side=tk.LEFT, padx=5)
+        tk.Checkbutton(self.search_bar, text="Учитывать регистр", variable=self.search_case,
+                       command=self.schedule_search, **check_style).pack(side=tk.LEFT, padx=5)
+        tk.Button(self.search_bar, text="Заменить все", command=self.replace_all, **button_style).pack(side=tk.LEFT, padx=5)
+        tk.Button(self.search_bar, text="✕", command=self.hide_search_bar, **button_style).pack(side=tk.RIGHT)
+        
+        self.search_entry.bind('<KeyRelease>', lambda e: self.schedule_search())
+        self.search_entry.bind('<Return>', lambda e: self.find_next())
+        self.search_entry.bind('<Escape>', lambda e: self.hide_search_bar())
+        self.text_area.tag_configure("search_match", background="#6a4a00")
+        self.text_area.tag_raise(tk.SEL, "search_match")
+    
+    def create_stats_panel(self):
+        self.stats_panel = tk.Frame(self.root, bg=self.menu_bg, padx=10, pady=8)
+        self.text_stats = TextStatistics(self.model)
+        self.model.add_listener(self.on_stats_edit)
+        self.stats_poll_job = None
+        self.refresh.add_region("stats", self.refresh_stats)
+        
+        header = tk.Frame(self.stats_panel, bg=self.menu_bg)
+        header.pack(fill=tk.X)
+        tk.Label(header, text="Статистика", bg=self.menu_bg, fg=self.accent_color,
+                 font=("Ubuntu", 10, "bold")).pack(side=tk.LEFT)
+        tk.Button(header, text="✕", command=self.hide_stats_panel, bg=self.button_bg, fg=self.fg_color,
+                  relief=tk.FLAT, bd=0, font=("Ubuntu", 9), highlightthickness=0, padx=6,
+                  activebackground=self.accent_color, activeforeground=self.fg_color).pack(side=tk.RIGHT)
+        self.stats_label = tk.Label(self.stats_panel, text="", bg=self.menu_bg, fg=self.menu_fg,
+                                    font=("Ubuntu", 9), justify=tk.LEFT, anchor=tk.NW)
+        self.stats_label.pack(fill=tk.BOTH, expand=True, pady=(8, 0))
     
     def on_selection_change(self, event=None):
-        self.update_status()
+        self.schedule_status_update()
+    
+    def on_text_configure(self, event=None):
+        # При перетаскивании окна Configure приходит много раз за кадр
+        if self.large_view is not None:
+            self.refresh.mark("large_view", "gutter", "status")
+        else:
+            self.refresh.mark("gutter", "status")
+    
+    def refresh_large_view(self):
+        if self.large_view is not None:
+            self.large_view.on_configure()
+    
+    def schedule_status_update(self):
+        # Серия событий за один кадр сводится к одному обновлению
+        self.refresh.mark("status")
     
     def update_status(self):
+        self.refresh.discard("status")
+        
+        if self.large_view is not None:
+            self.update_large_status()
+            return
+        
         cursor_pos = self.text_area.index(tk.INSERT)
         line, column = map(int, cursor_pos.split('.'))
         
-        content = self.text_area.get(1.0, tk.END)
-        char_count = len(content) - 1
+        if self.doc_stats.stale:
+            self.doc_stats.recount(self.model.get())
+        char_count = self.doc_stats.char_count
+        line_count = self.doc_stats.line_count
         
-        try:
-            if self.text_area.tag_ranges(tk.SEL):
-                selected_text = self.text_area.get(tk.SEL_FIRST, tk.SEL_LAST)
-                selected_count = len(selected_text)
-                selection_info = f" | Выделено: {selected_count}"
-            else:
-                selection_info = ""
-        except tk.TclError:
+        selected_count = self.doc_stats.selection_count(self.text_area)
+        if selected_count:
+            selection_info = f" | Выделено: {selected_count}"
+        else:
             selection_info = ""
         
-        self.status_bar.config(text=f"Строка: {line}, Колонка: {column} | Символов: {char_count}{selection_info}")
+        history_info = f" | Отмена: {self.history.size / (1024 * 1024):.1f} МБ"
+        format_info = f" | {text_format_label(self.document.text_format)}"
+        follow_info = " | Слежение" if self.follower is not None else ""
+        self.status_bar.config(text=f"Строка: {line}, Колонка: {column} | Строк: {line_count} | Символов: {char_count}{selection_info}{history_info}{format_info}{follow_info}")
     
-    def new_file(self):
+    def update_large_status(self):
+        # Позиция и число строк берутся из индекса, а не из виджета
+        index = self.large_view.index
+        line, column = self.large_view.cursor_position()
+        if index.done:
+            lines_info = f"Строк: {index.line_count}"
+        else:
+            lines_info = f"Индексация: {index.scanned * 100 // max(1, index.size)}%"
+        self.status_bar.config(text=f"Строка: {line}, Колонка: {column} | {lines_info} | Байт: {index.size} | {text_format_label(self.document.text_format)} | Только чтение")
+    
+    def toggle_follow(self):
+        if self.follower is not None:
+            self.document.follow = False
+            self.close_follower()
+            self.journal.start(self.journal_snapshot())
+            self.status_bar.config(text="Слежение за файлом остановлено")
+            return
+        self.follow_var.set(False)
+        if self.loader is not None:
+            self.status_bar.config(text="Файл еще загружается")
+        elif self.large_view is not None:
+            self.status_bar.config(text="Большой файл открыт в окне просмотра, слежение недоступно")
+        elif not self.current_file or self.current_file.lower().endswith(RICH_EXTENSION):
+            self.status_bar.config(text="Следить можно только за открытым текстовым файлом")
+        elif self.document.modified:
+            self.status_bar.config(text="Сначала сохраните изменения")
+        else:
+            self.document.follow = True
+            self.start_following()
+            self.status_bar.config(text=f"Слежение за файлом: {self.current_file}")
+    
+    def start_following(self):
+        # Текст совпадает с файлом до disk_state - дочитывается только
+        # дописанное; без него файл перечитывается с начала
+        self.finish_paste()
+        encoding, bom, newline = self.document.text_format
+        offset, identity = self.document.disk_state or (len(bom), None)
+        self.follower = FileFollower(self.root, self.current_file, self.on_follow_data,
+                                     self.on_follow_reset, self.on_follow_missing,
+                                     encoding, len(bom), offset, identity)
+        # Документ повторяет файл: правки, отмена и журнал не нужны
+        self.journal.stop()
+        self.history.clear()
+        self.text_area.configure(state=tk.DISABLED)
+        self.follow_var.set(True)
+        self.follower.start()
+        self.schedule_status_update()
+    
+    def close_follower(self):
+        if self.follower is None:
+            return
+        self.follower.cancel()
+        self.document.disk_state = (self.follower.position, self.follower.identity)
+        self.follower = None
+        self.text_area.configure(state=tk.NORMAL)
+        self.follow_var.set(False)
+        self.schedule_status_update()
+    
+    def on_follow_data(self, text):
+        # Прокрутка следует за концом, только если конец и был виден
+        at_bottom = self.text_area.yview()[1] >= 1.0
+        self.text_area.configure(state=tk.NORMAL)
+        self.text_area.insert("end-1c", text)
+        self.text_area.configure(state=tk.DISABLED)
+        if at_bottom:
+            self.text_area.see("end-1c")
+        self.schedule_status_update()
+    
+    def on_follow_reset(self):
+        self.text_area.configure(state=tk.NORMAL)
         self.text_area.delete(1.0, tk.END)
-        self.current_file = None
-        self.root.title("Текстовый редактор - Новый файл")
+        self.text_area.configure(state=tk.DISABLED)
+        self.status_bar.config(text=f"Файл заменен или усечен, чтение с начала: {self.current_file}")
+    
+    def on_follow_missing(self):
+        self.status_bar.config(text=f"Файл недоступен, слежение продолжается: {self.current_file}")
+    
+    def close_large_view(self):
+        if self.large_view is not None:
+            self.large_view.close()
+            self.large_view = None
+    
+    def new_file(self):
+        if self.loader is not None:
+            self.status_bar.config(text="Файл еще загружается")
+            return
+        self.open_document(self.create_document())
         self.status_bar.config(text="Создан новый файл")
-        self.tag_styles.clear()
-        self.tag_counter = 0
     
     def open_file(self):
         file_path = filedialog.askopenfilename(
             defaultextension=".txt",
-            filetypes=[("Текстовые файлы", "*.txt"), ("Все файлы", "*.*")]
+            filetypes=[("Текстовые файлы", "*.txt"), ("Документы с форматированием", f"*{RICH_EXTENSION}"), ("Все файлы", "*.*")]
         )
         
         if file_path:
+            for document in self.documents:
+                if document.path and os.path.abspath(document.path) == os.path.abspath(file_path):
+                    self.switch_document(document)
+                    return
+            
+            # Файл открывается в новой вкладке, если текущая не пустая
+            if self.loader is None and (self.current_file or self.document.modified or self.large_view is not None):
+                self.open_document(self.create_document())
+            self.stop_loading()
+            self.close_large_view()
             try:
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    content = file.read()
-                    self.text_area.delete(1.0, tk.END)
-                    self.text_area.insert(1.0, content)
-                
-                self.current_file = file_path
-                self.root.title(f"Текстовый редактор - {os.path.basename(file_path)}")
-                self.status_bar.config(text=f"Открыт файл: {file_path}")
-                
+                if file_path.lower().endswith(RICH_EXTENSION):
+                    self.open_rich_file(file_path)
+                    return
+                self.document.text_format = detect_text_format(file_path)
+                # Окно большого файла ищет строки по байту \n, UTF-16/32 грузятся целиком
+                if not is_wide_encoding(self.document.text_format[0]) and (
+                        os.path.getsize(file_path) >= LARGE_FILE_THRESHOLD
+                        or has_long_line(file_path, LONG_LINE_LIMIT)):
+                    self.open_large_file(file_path)
+                    return
+                self.set_wrap(not has_long_line(file_path, LONG_LINE_WRAP_LIMIT))
+                self.start_loader(file_path)
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Не удалось открыть файл:\n{str(e)}")
+                return
+            
+            # Пока файл грузится, текст только для чтения, а загрузка не попадает в историю и журнал
+            self.journal.stop()
+            self.set_highlighting(None)
+            self.text_area.delete(1.0, tk.END)
+            self.history.clear()
+            self.text_area.configure(state=tk.DISABLED)
+            self.root.title(f"Текстовый редактор - {os.path.basename(file_path)}")
+            self.loader.start()
+    
+    def start_loader(self, file_path):
+        encoding, bom, newline = self.document.text_format
+        self.loader = FileLoader(self.root, self.text_area, file_path,
+                                 self.on_load_progress,
+                                 lambda error: self.on_load_finished(file_path, error),
+                                 encoding, len(bom))
+    
+    def open_rich_file(self, file_path):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            text, styles, runs = decode_rich_document(file.read())
+        
+        self.journal.stop()
+        self.set_highlighting(None)
+        self.load_rich_text(text, styles, runs)
+        
+        self.mark_loaded()
+        self.text_area.mark_set(tk.INSERT, 1.0)
+        self.current_file = file_path
+        self.root.title(f"Текстовый редактор - {os.path.basename(file_path)}")
+        self.status_bar.config(text=f"Открыт файл: {file_path}")
+        self.journal.start(self.journal_baseline(file_path))
+    
+    def load_rich_text(self, text, styles, runs):
+        self.text_area.delete(1.0, tk.END)
+        self.text_area.insert(1.0, text)
+        
+        # Диапазоны группируются по стилю: один tag add на стиль со всеми парами индексов
+        tags = [self.create_tag(style) for style in styles]
+        grouped = defaultdict(list)
+        for start, end, style in rich_spans(text, runs):
+            tag = tags[style]
+            self.style_runs.append(start, end, tag)
+            grouped[tag].extend((format_index(start), format_index(end)))
+        for tag, indices in grouped.items():
+            self.text_area.tag_add(tag, *indices)
+    
+    def rich_document_snapshot(self):
+        # Текст и отрезки стилей за один проход text_area.dump
+        items = self.text_area.tk.splitlist(self.text_area.tk.call(
+            self.text_area._w, "dump", "-text", "-tag", "1.0", "end-1c"))
+        chunks = []
+        styles = []
+        style_numbers = {}
+        active_numbers = {(): -1}
+        active = []
+        runs = []
+        current = -1
+        for k in range(0, len(items), 3):
+            key, value = items[k], items[k + 1]
+            if key == "text":
+                chunks.append(value)
+                if runs and runs[-1] == current:
+                    runs[-2] += len(value)
+                else:
+                    runs.extend((len(value), current))
+                continue
+            if value not in self.tag_styles:
+                continue
+            if key == "tagon":
+                active.append(value)
+            elif value in active:
+                active.remove(value)
+            
+            combination = tuple(active)
+            if combination not in active_numbers:
+                style = {}
+                for tag in combination:
+                    style.update(self.tag_styles[tag])
+                key_of_style = style_key(style)
+                if key_of_style not in style_numbers:
+                    style_numbers[key_of_style] = len(styles)
+                    styles.append(style)
+                active_numbers[combination] = style_numbers[key_of_style]
+            current = active_numbers[combination]
+        return "".join(chunks), styles, runs
+    
+    def open_large_file(self, file_path):
+        # Файл только для чтения - восстанавливать нечего
+        self.journal.stop()
+        self.set_highlighting(None)
+        self.set_wrap(True)
+        self.text_area.delete(1.0, tk.END)
+        self.large_view = LargeFileView(self.root, self.text_area, file_path, self.schedule_status_update,
+                                        self.document.text_format[0])
+        self.mark_loaded()
+        self.current_file = file_path
+        self.root.title(f"Текстовый редактор - {os.path.basename(file_path)} [только чтение]")
+        if os.path.getsize(file_path) >= LARGE_FILE_THRESHOLD:
+            self.status_bar.config(text=f"Открыт большой файл: {file_path}")
+        else:
+            self.status_bar.config(text=f"Открыт файл с очень длинными строками: {file_path}")
+    
+    def goto_line_dialog(self):
+        line = simpledialog.askinteger("Перейти к строке", "Номер строки:", parent=self.root, minvalue=1)
+        if line is None:
+            return
+        if self.large_view is not None:
+            self.large_view.goto_line(line)
+        else:
+            self.text_area.mark_set(tk.INSERT, f"{line}.0")
+            self.text_area.see(tk.INSERT)
+        self.schedule_status_update()
+    
+    def on_load_progress(self, percent):
+        self.status_bar.config(text=f"Загрузка: {percent}% (Esc - отмена)")
+    
+    def on_load_finished(self, file_path, error):
+        loader = self.loader
+        self.loader = None
+        self.refresh.mark("stats")
+        encoding, bom, newline = self.document.text_format
+        if isinstance(error, UnicodeDecodeError) and (encoding, bom) == ("utf-8", b""):
+            # Образец был в UTF-8, а дальше в файле другая кодировка:
+            # загрузка начинается заново в запасной
+            self.document.text_format = (FALLBACK_ENCODING, b"", newline)
+            self.text_area.configure(state=tk.NORMAL)
+            self.text_area.delete(1.0, tk.END)
+            self.text_area.configure(state=tk.DISABLED)
+            try:
+                self.start_loader(file_path)
+                self.loader.start()
+                return
+            except OSError as e:
+                error = e
+        self.text_area.configure(state=tk.NORMAL)
+        self.mark_loaded()
+        
+        if error is not None:
+            self.text_area.delete(1.0, tk.END)
+            self.current_file = None
+            self.root.title("Текстовый редактор - Новый файл")
+            self.status_bar.config(text="Файл не открыт")
+            self.journal.start(["b", None, 0, 0, False])
+            messagebox.showerror("Ошибка", f"Не удалось открыть файл:\n{str(error)}")
+            return
+        
+        self.text_area.mark_set(tk.INSERT, 1.0)
+        self.current_file = file_path
+        self.document.disk_state = (loader.offset, loader.identity)
+        self.set_highlighting(file_path)
+        self.status_bar.config(text=f"Открыт файл: {file_path}")
+        self.journal.start(self.journal_baseline(file_path))
+    
+    def stop_loading(self):
+        if self.loader is None:
+            return False
+        self.loader.cancel()
+        self.loader = None
+        self.text_area.configure(state=tk.NORMAL)
+        self.text_area.delete(1.0, tk.END)
+        self.mark_loaded()
+        return True
+    
+    def cancel_loading(self):
+        if self.paster is not None:
+            self.paster.cancel()
+            return
+        if self.stop_loading():
+            self.journal.start(["b", None, 0, 0, False])
+            self.current_file = None
+            self.root.title("Текстовый редактор - Новый файл")
+            self.status_bar.config(text="Открытие файла отменено")
     
     def save_file(self):
+        if self.loader is not None:
+            self.status_bar.config(text="Файл еще загружается")
+            return
+        if self.follower is not None:
+            self.status_bar.config(text="Во время слежения файл только для чтения")
+            return
+        if self.large_view is not None:
+            self.status_bar.config(text="Большой файл открыт только для чтения")
+            return
         if self.current_file:
-            try:
-                content = self.text_area.get(1.0, tk.END)
-                with open(self.current_file, 'w', encoding='utf-8') as file:
-                    file.write(content)
-                self.status_bar.config(text=f"Файл сохранен: {self.current_file}")
-            except Exception as e:
-                messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{str(e)}")
+            self.start_save(self.current_file, f"Файл сохранен: {self.current_file}")
         else:
             self.save_as_file()
     
     def save_as_file(self):
+        if self.loader is not None:
+            self.status_bar.config(text="Файл еще загружается")
+            return
+        if self.follower is not None:
+            self.status_bar.config(text="Во время слежения файл только для чтения")
+            return
+        if self.large_view is not None:
+            self.status_bar.config(text="Большой файл открыт только для чтения")
+            return
         file_path = filedialog.asksaveasfilename(
             defaultextension=".txt",
-            filetypes=[("Текстовые файлы", "*.txt"), ("Все файлы", "*.*")]
+            filetypes=[("Текстовые файлы", "*.txt"), ("Документы с форматированием", f"*{RICH_EXTENSION}"), ("Все файлы", "*.*")]
         )
         
         if file_path:
+            self.current_file = file_path
+            self.set_highlighting(file_path)
+            self.root.title(f"Текстовый редактор - {os.path.basename(file_path)}")
+            self.start_save(file_path, f"Файл сохранен как: {file_path}")
+    
+    def start_save(self, file_path, message):
+        # Снимок текста берется сразу, запись идет в фоне - редактировать можно дальше
+        self.finish_paste()
+        if file_path.lower().endswith(RICH_EXTENSION):
+            content = encode_rich_document(*self.rich_document_snapshot())
+            text_format = DEFAULT_TEXT_FORMAT
+        else:
+            content = self.model.get() + "\n"
+            text_format = self.document.text_format
+        token = (self.journal.generation, self.journal.seq, self.document, self.document.edits)
+        self.saver.submit(file_path, content, message, token, text_format)
+        self.status_bar.config(text=f"Сохранение: {file_path}...")
+        if self.save_job is None:
+            self.save_job = self.root.after(SAVE_POLL_MS, self.poll_saves)
+    
+    def poll_saves(self):
+        self.save_job = None
+        while True:
             try:
-                content = self.text_area.get(1.0, tk.END)
-                with open(file_path, 'w', encoding='utf-8') as file:
-                    file.write(content)
-                
-                self.current_file = file_path
-                self.root.title(f"Текстовый редактор - {os.path.basename(file_path)}")
-                self.status_bar.config(text=f"Файл сохранен как: {file_path}")
-                
-            except Exception as e:
-                messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{str(e)}")
+                file_path, message, error, token = self.saver.results.get_nowait()
+            except queue.Empty:
+                break
+            if error is not None:
+                self.status_bar.config(text=f"Ошибка сохранения: {file_path}")
+                messagebox.showerror("Ошибка", f"Не удалось сохранить файл:\n{str(error)}")
+            else:
+                self.status_bar.config(text=message)
+                generation, seq, document, edits = token
+                document.saved = True
+                document.disk_state = None
+                if document.edits == edits:
+                    document.modified = False
+                    document.changes.clear()
+                    self.refresh.mark("gutter")
+                    self.update_tab_bar()
+                try:
+                    self.journal.rebase(self.journal_baseline(file_path, saved=True), seq, generation)
+                except OSError:
+                    pass
+        if self.saver.busy or not self.saver.results.empty():
+            self.save_job = self.root.after(SAVE_POLL_MS, self.poll_saves)
+    
+    def export_style(self, style):
+        # Цвета переводятся в RGB здесь, в главном потоке, потому что для
+        # этого нужен Tk (имена цветов понимает только он)
+        def rgb(color):
+            red, green, blue = self.root.winfo_rgb(color)
+            return red // 256, green // 256, blue // 256
+        
+        return export_properties(style, self.default_font_family, self.default_font_size, rgb)
+    
+    def export_document(self):
+        if self.loader is not None:
+            self.status_bar.config(text="Файл еще загружается")
+            return
+        if self.large_view is not None:
+            self.status_bar.config(text="Экспорт недоступен в режиме просмотра большого файла")
+            return
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".html",
+            filetypes=[("HTML", "*.html"), ("RTF", "*.rtf")]
+        )
+        if not file_path:
+            return
+        writer_class = EXPORT_WRITERS.get(os.path.splitext(file_path)[1].lower())
+        if writer_class is None:
+            messagebox.showerror("Ошибка", "Экспорт возможен только в HTML (.html) и RTF (.rtf)")
+            return
+        
+        # Снимок берется одним проходом dump, разметка и запись идут в фоне
+        self.finish_paste()
+        text, styles, runs = self.rich_document_snapshot()
+        base = self.export_style({'font': (self.default_font_family, self.default_font_size),
+                                  'foreground': self.text_area.cget("fg"),
+                                  'background': self.text_area.cget("bg")})
+        title = os.path.basename(self.current_file) if self.current_file else "Новый файл"
+        writer = writer_class([self.export_style(style) for style in styles], base, title)
+        threading.Thread(target=writer.run, args=(file_path, text, runs, self.export_results), daemon=True).start()
+        self.export_count += 1
+        self.status_bar.config(text=f"Экспорт: {file_path}...")
+        if self.export_job is None:
+            self.export_job = self.root.after(SAVE_POLL_MS, self.poll_exports)
+    
+    def poll_exports(self):
+        self.export_job = None
+        while True:
+            try:
+                file_path, error = self.export_results.get_nowait()
+            except queue.Empty:
+                break
+            self.export_count -= 1
+            if error is not None:
+                self.status_bar.config(text=f"Ошибка экспорта: {file_path}")
+                messagebox.showerror("Ошибка", f"Не удалось экспортировать документ:\n{str(error)}")
+            else:
+                self.status_bar.config(text=f"Документ экспортирован: {file_path}")
+        if self.export_count > 0:
+            self.export_job = self.root.after(SAVE_POLL_MS, self.poll_exports)
     
     def exit_app(self):
         self.save_settings()
         if messagebox.askokcancel("Выход", "Вы уверены, что хотите выйти?"):
+            self.finish_paste()
+            self.saver.flush()
+            self.journal.close()
             self.root.quit()
     
     def select_all(self, event=None):
         self.text_area.tag_add(tk.SEL, "1.0", tk.END)
         self.text_area.mark_set(tk.INSERT, "1.0")
         self.text_area.see(tk.INSERT)
-        self.update_status()
+        self.schedule_status_update()
         return "break"
     
     def cut_text(self, event=None):
         try:
+            self.finish_paste()
             if self.text_area.tag_ranges(tk.SEL):
                 # Сохраняем выделенный текст в буфер обмена
-                selected_text = self.text_area.get(tk.SEL_FIRST, tk.SEL_LAST)
+                selected_text = self.model.get(*self.selection_range())
                 self.root.clipboard_clear()
                 self.root.clipboard_append(selected_text)
                 
                 # Удаляем выделенный текст
                 self.text_area.delete(tk.SEL_FIRST, tk.SEL_LAST)
-                self.update_status()
+                self.schedule_status_update()
             return "break"
         except:
             return "break"
@@ -382,7 +4560,7 @@ class TextEditor:
     def copy_text(self, event=None):
         try:
             if self.text_area.tag_ranges(tk.SEL):
-                selected_text = self.text_area.get(tk.SEL_FIRST, tk.SEL_LAST)
+                selected_text = self.model.get(*self.selection_range())
                 self.root.clipboard_clear()
                 self.root.clipboard_append(selected_text)
             return "break"
@@ -393,105 +4571,530 @@ class TextEditor:
         try:
             # Получаем текст из буфера обмена
             clipboard_text = self.root.clipboard_get()
+            self.finish_paste()
+            if self.loader is not None or self.large_view is not None or self.follower is not None:
+                return "break"
             
-            # Если есть выделение, заменяем его
-            if self.text_area.tag_ranges(tk.SEL):
-                self.text_area.delete(tk.SEL_FIRST, tk.SEL_LAST)
-            
-            # Вставляем текст на текущую позицию курсора
-            self.text_area.insert(tk.INSERT, clipboard_text)
-            self.update_status()
+            # Замена выделения и вся вставка - один шаг отмены
+            self.history.begin()
+            try:
+                # Если есть выделение, заменяем его
+                if self.text_area.tag_ranges(tk.SEL):
+                    self.text_area.delete(tk.SEL_FIRST, tk.SEL_LAST)
+                
+                if len(clipboard_text) < PASTE_CHUNK_THRESHOLD:
+                    # Вставляем текст на текущую позицию курсора
+                    self.text_area.insert(tk.INSERT, clipboard_text)
+                else:
+                    self.paster = PasteInserter(self.root, self.text_area, clipboard_text,
+                                                self.on_paste_progress, self.on_paste_finished)
+                    self.paster.start()
+                    self.on_paste_progress(0)
+            finally:
+                if self.paster is None:
+                    self.history.end()
+            self.schedule_status_update()
             return "break"
         except:
             return "break"
     
-    def undo_text(self):
+    def on_paste_progress(self, percent):
+        self.status_bar.config(text=f"Вставка: {percent}% (Esc - остановить)")
+    
+    def on_paste_finished(self, complete):
+        count = self.paster.position
+        self.paster = None
+        self.text_area.configure(state=tk.NORMAL)
+        self.text_area.mark_set(tk.INSERT, PASTE_MARK)
+        self.text_area.mark_unset(PASTE_MARK)
+        self.text_area.see(tk.INSERT)
+        self.history.end()
+        self.schedule_status_update()
+        if complete:
+            self.status_bar.config(text=f"Вставлено символов: {count}")
+        else:
+            self.status_bar.config(text=f"Вставка остановлена, вставлено символов: {count}")
+    
+    def finish_paste(self):
+        # Правки, сохранение и смена вкладки дожидаются конца вставки
+        if self.paster is not None:
+            self.paster.flush()
+    
+    def on_history_edit(self, kind, index, text):
+        # Загрузка файла, смена вкладки, окно большого файла и дочитывание
+        # при слежении в историю не попадают
+        if self.loader is not None or self.large_view is not None or self.follower is not None or self.switching:
+            return
+        self.document.edits += 1
+        self.document.disk_state = None
+        self.document.changes.on_edit(kind, index, text)
+        self.set_modified(True)
+        if kind == "reset":
+            self.history.clear()
+        elif kind == "insert":
+            self.history.add(("i", index, text))
+        else:
+            start = parse_index(index)
+            segments = self.style_runs.segments(start, text_end(start, text))
+            styles = None
+            if any(tag is not None for run_start, run_end, tag in segments):
+                styles = [(format_index(run_start), format_index(run_end), self.tag_styles.get(tag))
+                          for run_start, run_end, tag in segments]
+            self.history.add(("d", index, text, styles))
+    
+    def apply_history_record(self, record, undo):
+        # Возвращает позицию, куда ставится курсор после шага
+        kind = record[0]
+        if kind == "f":
+            style = record[3] if undo else record[4]
+            self.restyle_range(parse_index(record[1]), parse_index(record[2]),
+                               lambda current: dict(style) if style else {})
+            return record[2]
+        end = format_index(text_end(parse_index(record[1]), record[2]))
+        if (kind == "i") == undo:
+            self.text_area.delete(record[1], end)
+            return record[1]
+        self.text_area.insert(record[1], record[2])
+        if kind == "d" and record[3]:
+            for start, stop, style in record[3]:
+                self.restyle_range(parse_index(start), parse_index(stop),
+                                   lambda current: dict(style) if style else {})
+        return end
+    
+    def apply_history(self, records, undo):
+        if records is None:
+            return
+        self.history.applying = True
         try:
-            self.text_area.edit_undo()
-            self.update_status()
-        except tk.TclError:
-            pass
+            position = None
+            for record in (reversed(records) if undo else records):
+                position = self.apply_history_record(record, undo)
+        except tk.TclError as e:
+            # Текст разошелся с записями истории: дальше она неприменима
+            self.history.clear()
+            self.status_bar.config(text="История отмены очищена")
+            messagebox.showerror("Ошибка", f"Не удалось отменить или повторить правку, "
+                                           f"история отмены очищена:\n{str(e)}")
+        finally:
+            self.history.applying = False
+        if position is not None:
+            self.text_area.tag_remove(tk.SEL, 1.0, tk.END)
+            self.text_area.mark_set(tk.INSERT, position)
+            self.text_area.see(tk.INSERT)
+        self.schedule_status_update()
+    
+    def undo_text(self):
+        self.finish_paste()
+        if self.loader is None and self.large_view is None and self.follower is None:
+            self.apply_history(self.history.undo(), True)
+        return "break"
     
     def redo_text(self):
+        self.finish_paste()
+        if self.loader is None and self.large_view is None and self.follower is None:
+            self.apply_history(self.history.redo(), False)
+        return "break"
+    
+    def show_search_bar(self):
+        if self.large_view is not None:
+            self.status_bar.config(text="Поиск недоступен в режиме просмотра большого файла")
+            return
+        if not self.search_bar.winfo_ismapped():
+            self.search_bar.pack(side=tk.BOTTOM, fill=tk.X, after=self.status_bar)
+        self.search_entry.focus_set()
+        self.search_entry.select_range(0, tk.END)
+        self.schedule_search()
+    
+    def hide_search_bar(self):
+        self.search_worker.cancel()
+        self.search_generation = None
+        self.search_backlog = []
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+            self.search_job = None
+        self.text_area.tag_remove("search_match", 1.0, tk.END)
+        self.search_bar.pack_forget()
+        self.text_area.focus_set()
+    
+    def toggle_stats_panel(self):
+        if self.stats_panel.winfo_ismapped():
+            self.hide_stats_panel()
+        else:
+            self.stats_panel.pack(side=tk.RIGHT, fill=tk.Y, before=self.text_area)
+            self.refresh.mark("stats")
+    
+    def hide_stats_panel(self):
+        if self.stats_poll_job is not None:
+            self.root.after_cancel(self.stats_poll_job)
+            self.stats_poll_job = None
+        self.stats_panel.pack_forget()
+    
+    def on_stats_edit(self, kind, index, text):
+        # Правка только отмечает строки, подсчет - раз за кадр и в фоне
+        self.text_stats.on_edit(kind, index, text)
+        if self.stats_panel.winfo_ismapped():
+            self.refresh.mark("stats")
+    
+    def refresh_stats(self):
+        if not self.stats_panel.winfo_ismapped() or self.loader is not None:
+            return
+        if self.large_view is not None:
+            self.stats_label.config(text="Недоступно в режиме\nпросмотра большого файла")
+            return
+        self.text_stats.flush()
+        if self.stats_poll_job is None:
+            self.stats_poll_job = self.root.after(STATS_POLL_MS, self.poll_stats)
+    
+    def poll_stats(self):
+        self.stats_poll_job = None
+        result = self.text_stats.result
+        if result is not None and self.large_view is None:
+            lines, chars, words, nonblank, paragraphs = result
+            minutes = words / READING_WPM
+            reading = f"{minutes:.0f} мин" if minutes >= 1 else "меньше минуты"
+            counting = "\nПодсчет..." if self.text_stats.busy else ""
+            self.stats_label.config(text=f"Слов: {words}\nСтрок: {lines}\nНепустых строк: {nonblank}\n"
+                                         f"Абзацев: {paragraphs}\nСредняя длина строки: {chars / lines:.1f}\n"
+                                         f"Время чтения: {reading}{counting}")
+        if self.text_stats.busy:
+            self.stats_poll_job = self.root.after(STATS_POLL_MS, self.poll_stats)
+    
+    def on_search_edit(self, kind, index, text):
+        self.edit_count += 1
+        if self.search_bar.winfo_ismapped() and self.search_var.get():
+            self.schedule_search()
+    
+    def schedule_search(self):
+        # Ввод запроса подряд не запускает поиск на каждую клавишу
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(SEARCH_DELAY_MS, self.start_search)
+    
+    def search_pattern(self):
+        query = self.search_var.get()
+        if not query:
+            return None
+        flags = 0 if self.search_case.get() else re.IGNORECASE
+        if not self.search_regex.get():
+            query = re.escape(query)
+        return re.compile(query, flags | re.MULTILINE)
+    
+    def start_search(self):
+        self.search_job = None
+        self.search_backlog = []
+        self.search_count = 0
+        self.text_area.tag_remove("search_match", 1.0, tk.END)
         try:
-            self.text_area.edit_redo()
-            self.update_status()
-        except tk.TclError:
-            pass
+            pattern = self.search_pattern()
+        except re.error as e:
+            self.search_worker.cancel()
+            self.search_generation = None
+            self.status_bar.config(text=f"Ошибка в выражении: {e}")
+            return
+        if pattern is None:
+            self.search_worker.cancel()
+            self.search_generation = None
+            self.status_bar.config(text="Готово")
+            return
+        
+        self.search_generation = self.search_worker.search(self.model.get(), pattern)
+        self.status_bar.config(text="Поиск...")
+        self.ensure_search_polling()
+    
+    def ensure_search_polling(self):
+        if self.search_poll_job is None:
+            self.search_poll_job = self.root.after(SEARCH_POLL_MS, self.poll_search)
+    
+    def poll_search(self):
+        # За такт в виджет уходит ограниченное число подсветок, остаток ждет
+        self.search_poll_job = None
+        while True:
+            try:
+                kind, generation, payload = self.search_worker.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.search_generation:
+                continue
+            if kind == "matches":
+                self.search_backlog.append(payload)
+            elif kind == "done":
+                self.search_backlog.append(None)
+            elif kind == "replace":
+                self.apply_replace(*payload)
+            elif kind == "error":
+                self.search_generation = None
+                self.status_bar.config(text=f"Ошибка замены: {payload}")
+        
+        budget = SEARCH_TICK_LIMIT
+        while self.search_backlog and budget > 0:
+            batch = self.search_backlog[0]
+            if batch is None:
+                self.search_backlog.pop(0)
+                self.search_generation = None
+                self.status_bar.config(text=f"Найдено: {self.search_count}")
+                break
+            chunk, rest = batch[:2 * budget], batch[2 * budget:]
+            self.text_area.tag_add("search_match", *chunk)
+            self.search_count += len(chunk) // 2
+            budget -= len(chunk) // 2
+            if rest:
+                self.search_backlog[0] = rest
+            else:
+                self.search_backlog.pop(0)
+        
+        if self.search_generation is not None:
+            self.status_bar.config(text=f"Найдено: {self.search_count}...")
+        if self.search_generation is not None or self.search_backlog:
+            self.ensure_search_polling()
+    
+    def find_next(self):
+        found = self.text_area.tag_nextrange("search_match", "insert+1c")
+        if not found:
+            found = self.text_area.tag_nextrange("search_match", 1.0)
+        if found:
+            self.text_area.tag_remove(tk.SEL, 1.0, tk.END)
+            self.text_area.tag_add(tk.SEL, *found)
+            self.text_area.mark_set(tk.INSERT, found[0])
+            self.text_area.see(tk.INSERT)
+            self.schedule_status_update()
+        return "break"
+    
+    def replace_all(self):
+        if self.follower is not None:
+            self.status_bar.config(text="Во время слежения файл только для чтения")
+            return
+        try:
+            pattern = self.search_pattern()
+        except re.error as e:
+            self.status_bar.config(text=f"Ошибка в выражении: {e}")
+            return
+        if pattern is None:
+            return
+        replacement = self.replace_var.get()
+        if not self.search_regex.get():
+            replacement = replacement.replace("\\", "\\\\")
+        
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+            self.search_job = None
+        self.search_backlog = []
+        self.search_edit_count = self.edit_count
+        self.search_generation = self.search_worker.replace(
+            self.model.get(), pattern, replacement)
+        self.status_bar.config(text="Замена...")
+        self.ensure_search_polling()
+    
+    def apply_replace(self, count, edits, spans):
+        self.search_generation = None
+        self.finish_paste()
+        if self.edit_count != self.search_edit_count:
+            self.status_bar.config(text="Документ изменился во время замены, повторите")
+            return
+        
+        styles = None
+        if spans is not None:
+            styles = self.replaced_styles(parse_index(edits[0][0]), parse_index(edits[0][1]), spans)
+        # Все правки и восстановление стилей - один шаг отмены
+        self.history.begin()
+        try:
+            for start, end, text in edits:
+                self.text_area.delete(start, end)
+                self.text_area.insert(start, text)
+            if styles:
+                self.restyle_ranges([(self.model.position(start), self.model.position(end),
+                                      lambda current, style=style: dict(style) if style else {})
+                                     for start, end, style in styles])
+        finally:
+            self.history.end()
+        
+        self.text_area.tag_remove("search_match", 1.0, tk.END)
+        self.status_bar.config(text=f"Заменено: {count}")
+    
+    def replaced_styles(self, first, last, spans):
+        # Стили участка [first, last) после замены одной правкой, в смещениях
+        # нового текста: текст между совпадениями сохраняет свои отрезки,
+        # замена получает стиль, общий для соседних символов, как при вставке
+        # в Tk. Участок покрывается целиком, чтобы снять унаследованный тег
+        runs = self.style_runs.runs(first, last)
+        if not runs:
+            return None
+        model = self.model
+        runs = [(model.offset(start), model.offset(end), self.tag_styles.get(tag)) for start, end, tag in runs]
+        
+        def style_at(offset):
+            if offset < 0 or offset >= model.char_count:
+                return None
+            return self.tag_styles.get(self.style_runs.tag_at(model.position(offset)))
+        
+        styles = []
+        position = spans[0][2]
+        i = 0
+        kept = spans[0][0]
+        for old_start, old_end, new_start, new_end in spans:
+            shift = new_start - old_start
+            while i < len(runs) and runs[i][0] < old_start:
+                run_start, run_end, style = runs[i]
+                start = max(run_start, kept) + shift
+                end = min(run_end, old_start) + shift
+                if start < end:
+                    if position < start:
+                        styles.append((position, start, None))
+                    styles.append((start, end, style))
+                    position = end
+                if run_end > old_start:
+                    break
+                i += 1
+            style = style_at(old_start - 1)
+            if style is not None and new_start < new_end and style == style_at(old_end):
+                if position < new_start:
+                    styles.append((position, new_start, None))
+                styles.append((new_start, new_end, style))
+                position = new_end
+            kept = old_end
+        if position < spans[-1][3]:
+            styles.append((position, spans[-1][3], None))
+        return styles
     
     def create_tag(self, style_properties):
+        key = style_key(style_properties)
+        tag_name = self.style_tags.get(key)
+        if tag_name in self.tag_styles:
+            return tag_name
+        
         tag_name = f"tag_{self.tag_counter}"
         self.tag_counter += 1
         self.tag_styles[tag_name] = style_properties
+        self.style_tags[key] = tag_name
         self.text_area.tag_configure(tag_name, **style_properties)
         return tag_name
     
+    def on_model_edit(self, kind, index, text):
+        # Модель получает те же правки, что и виджет; индекс стилей в ней
+        # сдвигается вместе с текстом так же, как теги Tk
+        if kind == "insert":
+            self.model.insert(parse_index(index), text)
+            return
+        if kind == "delete":
+            start = parse_index(index)
+            self.model.delete(start, text_end(start, text))
+        else:
+            self.model.reset(self.text_area.get(1.0, "end-1c"))
+            self.rebuild_style_runs()
+        self.tags_dirty = True
+    
+    def rebuild_style_runs(self):
+        self.style_runs.clear()
+        for tag in self.tag_styles:
+            ranges = self.text_area.tag_ranges(tag)
+            for start, end in zip(ranges[0::2], ranges[1::2]):
+                self.style_runs.assign(parse_index(start), parse_index(end), tag)
+    
+    def schedule_tag_gc(self):
+        self.root.after_idle(self.collect_tags)
+        self.root.after(TAG_GC_INTERVAL_MS, self.schedule_tag_gc)
+    
+    def collect_tags(self):
+        # Удаляет теги без диапазонов и уплотняет таблицу стилей
+        if not self.tags_dirty:
+            return
+        self.tags_dirty = False
+        
+        used = set(self.style_runs.tags)
+        unused = [tag for tag in self.tag_styles
+                  if tag not in used and not self.text_area.tag_nextrange(tag, 1.0)]
+        if not unused:
+            return
+        self.text_area.tag_delete(*unused)
+        for tag in unused:
+            del self.tag_styles[tag]
+        self.tag_styles = dict(self.tag_styles)
+        self.style_tags = {key: tag for key, tag in self.style_tags.items() if tag in self.tag_styles}
+    
+    def selection_range(self):
+        if not self.text_area.tag_ranges(tk.SEL):
+            return None
+        return (parse_index(self.text_area.index(tk.SEL_FIRST)),
+                parse_index(self.text_area.index(tk.SEL_LAST)))
+    
+    def restyle_range(self, start, end, transform):
+        self.restyle_ranges([(start, end, transform)])
+    
+    def restyle_ranges(self, ranges):
+        # ranges - тройки (начало, конец, transform); transform получает копию
+        # стиля каждого отрезка и возвращает новый стиль (пустой - без
+        # форматирования). В виджет уходит по одному tag remove/tag add на
+        # каждый затронутый тег, а не на символ
+        self.finish_paste()
+        removed = defaultdict(list)
+        added = defaultdict(list)
+        self.history.begin()
+        for start, end, transform in ranges:
+            for run_start, run_end, tag in self.style_runs.segments(start, end):
+                style = transform(dict(self.tag_styles.get(tag, {})))
+                new_tag = self.create_tag(style) if style else None
+                if new_tag == tag:
+                    continue
+                self.style_runs.assign(run_start, run_end, new_tag)
+                bounds = (format_index(run_start), format_index(run_end))
+                self.journal.record(["f", bounds[0], bounds[1], style or None])
+                self.history.add(("f", bounds[0], bounds[1], self.tag_styles.get(tag),
+                                  self.tag_styles.get(new_tag)))
+                if tag is not None:
+                    removed[tag].extend(bounds)
+                if new_tag is not None:
+                    added[new_tag].extend(bounds)
+        self.history.end()
+        
+        for tag, indices in removed.items():
+            self.text_area.tk.call(self.text_area._w, "tag", "remove", tag, *indices)
+        for tag, indices in added.items():
+            self.text_area.tag_add(tag, *indices)
+        if removed:
+            self.tags_dirty = True
+    
+    def font_parts(self, style):
+        return parse_font(style.get('font', self.text_area.cget("font")),
+                          self.default_font_family, self.default_font_size)
+    
+    def has_font_flag(self, style, format_type):
+        font_family, font_size, font_weight, font_slant, font_underline = self.font_parts(style)
+        if format_type == 'bold':
+            return font_weight == "bold"
+        if format_type == 'italic':
+            return font_slant == "italic"
+        return font_underline
+    
     def apply_formatting(self, format_type):
         try:
-            if self.text_area.tag_ranges(tk.SEL):
-                start = self.text_area.index(tk.SEL_FIRST)
-                end = self.text_area.index(tk.SEL_LAST)
+            selection = self.selection_range()
+            if selection:
+                start, end = selection
                 
-                current_tags = self.text_area.tag_names(start)
+                # Смешанное выделение: флаг снимается, только если он стоит везде
+                enable = not all(self.has_font_flag(self.tag_styles.get(tag, {}), format_type)
+                                 for run_start, run_end, tag in self.style_runs.segments(start, end))
                 
-                new_style = {}
-                for tag in current_tags:
-                    if tag in self.tag_styles:
-                        new_style.update(self.tag_styles[tag])
+                def toggle(style):
+                    font_family, font_size, font_weight, font_slant, font_underline = self.font_parts(style)
+                    if format_type == 'bold':
+                        font_weight = "bold" if enable else "normal"
+                    elif format_type == 'italic':
+                        font_slant = "italic" if enable else "roman"
+                    elif format_type == 'underline':
+                        font_underline = enable
+                    
+                    new_font = [font_family, font_size]
+                    if font_weight == "bold":
+                        new_font.append("bold")
+                    if font_slant == "italic":
+                        new_font.append("italic")
+                    if font_underline:
+                        new_font.append("underline")
+                    
+                    style['font'] = new_font
+                    return style
                 
-                current_font = self.text_area.cget("font")
-                if 'font' in new_style:
-                    current_font = new_style['font']
-                
-                font_family = self.default_font_family
-                font_size = self.default_font_size
-                font_weight = "normal"
-                font_slant = "roman"
-                font_underline = False
-                
-                if isinstance(current_font, (list, tuple)):
-                    font_family = current_font[0] if len(current_font) > 0 else self.default_font_family
-                    font_size = current_font[1] if len(current_font) > 1 else self.default_font_size
-                    if len(current_font) > 2:
-                        for style in current_font[2:]:
-                            if "bold" in str(style).lower():
-                                font_weight = "bold"
-                            elif "italic" in str(style).lower():
-                                font_slant = "italic"
-                            elif "underline" in str(style).lower():
-                                font_underline = True
-                elif isinstance(current_font, str):
-                    parts = current_font.split()
-                    if parts:
-                        font_family = parts[0]
-                        for part in parts[1:]:
-                            if part.isdigit():
-                                font_size = int(part)
-                            elif "bold" in part.lower():
-                                font_weight = "bold"
-                            elif "italic" in part.lower():
-                                font_slant = "italic"
-                            elif "underline" in part.lower():
-                                font_underline = True
-                
-                if format_type == 'bold':
-                    font_weight = "bold" if font_weight != "bold" else "normal"
-                elif format_type == 'italic':
-                    font_slant = "italic" if font_slant != "italic" else "roman"
-                elif format_type == 'underline':
-                    font_underline = not font_underline
-                
-                new_font = [font_family, font_size]
-                if font_weight == "bold":
-                    new_font.append("bold")
-                if font_slant == "italic":
-                    new_font.append("italic")
-                if font_underline:
-                    new_font.append("underline")
-                
-                new_style['font'] = new_font
-                new_tag = self.create_tag(new_style)
-                self.text_area.tag_add(new_tag, start, end)
+                self.restyle_range(start, end, toggle)
                 
         except tk.TclError:
             pass
@@ -503,20 +5106,9 @@ class TextEditor:
     
     def apply_text_color(self, color):
         try:
-            if self.text_area.tag_ranges(tk.SEL):
-                start = self.text_area.index(tk.SEL_FIRST)
-                end = self.text_area.index(tk.SEL_LAST)
-                
-                current_tags = self.text_area.tag_names(start)
-                
-                new_style = {}
-                for tag in current_tags:
-                    if tag in self.tag_styles:
-                        new_style.update(self.tag_styles[tag])
-                
-                new_style['foreground'] = color
-                new_tag = self.create_tag(new_style)
-                self.text_area.tag_add(new_tag, start, end)
+            selection = self.selection_range()
+            if selection:
+                self.restyle_range(*selection, lambda style: {**style, 'foreground': color})
                 
         except tk.TclError:
             pass
@@ -528,46 +5120,34 @@ class TextEditor:
     
     def apply_bg_color(self, color):
         try:
-            if self.text_area.tag_ranges(tk.SEL):
-                start = self.text_area.index(tk.SEL_FIRST)
-                end = self.text_area.index(tk.SEL_LAST)
-                
-                current_tags = self.text_area.tag_names(start)
-                
-                new_style = {}
-                for tag in current_tags:
-                    if tag in self.tag_styles:
-                        new_style.update(self.tag_styles[tag])
-                
-                new_style['background'] = color
-                new_tag = self.create_tag(new_style)
-                self.text_area.tag_add(new_tag, start, end)
+            selection = self.selection_range()
+            if selection:
+                self.restyle_range(*selection, lambda style: {**style, 'background': color})
                 
         except tk.TclError:
             pass
     
     def clear_formatting(self):
         try:
-            if self.text_area.tag_ranges(tk.SEL):
-                start = self.text_area.index(tk.SEL_FIRST)
-                end = self.text_area.index(tk.SEL_LAST)
-                
-                tags = self.text_area.tag_names(start)
-                for tag in tags:
-                    if tag != 'sel':
-                        self.text_area.tag_remove(tag, start, end)
+            selection = self.selection_range()
+            if selection:
+                self.restyle_range(*selection, lambda style: {})
                 
         except tk.TclError:
             pass
     
     def change_font_dialog(self):
+        if self.font_window is not None:
+            self.font_window.lift()
+            return
         font_window = tk.Toplevel(self.root)
         font_window.title("Шрифт")
-        font_window.geometry("400x300")
+        font_window.geometry("560x380")
         font_window.configure(bg=self.bg_color, highlightthickness=0)
         font_window.resizable(False, False)
         font_window.transient(self.root)
         font_window.grab_set()
+        self.font_window = font_window
         
         main_frame = tk.Frame(font_window, bg=self.bg_color, padx=20, pady=20)
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -575,24 +5155,31 @@ class TextEditor:
         tk.Label(main_frame, text="Шрифт:", bg=self.bg_color, fg=self.fg_color, 
                 font=("Ubuntu", 10)).grid(row=0, column=0, sticky=tk.W, pady=5)
         
-        font_listbox = tk.Listbox(main_frame, bg=self.menu_bg, fg=self.fg_color, 
+        # Фильтр по подстроке применяется на каждое нажатие клавиши
+        self.font_filter_var = tk.StringVar()
+        filter_entry = tk.Entry(main_frame, textvariable=self.font_filter_var, bg=self.menu_bg, fg=self.fg_color,
+                                insertbackground=self.fg_color, bd=0, font=("Ubuntu", 10), highlightthickness=0)
+        filter_entry.grid(row=1, column=0, sticky=tk.EW, padx=(0, 10), pady=(0, 5))
+        
+        # Рядом со списком - образцы шрифтов, только для видимых строк
+        list_frame = tk.Frame(main_frame, bg=self.menu_bg)
+        list_frame.grid(row=2, column=0, sticky=tk.NSEW, padx=(0, 10))
+        font_scrollbar = tk.Scrollbar(list_frame, orient=tk.VERTICAL, bg=self.menu_bg, troughcolor=self.bg_color,
+                                      bd=0, highlightthickness=0)
+        font_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        font_listbox = tk.Listbox(list_frame, bg=self.menu_bg, fg=self.fg_color, 
                                  selectbackground=self.accent_color, bd=0,
                                  font=("Ubuntu", 10), highlightthickness=0,
-                                 exportselection=False)
-        font_listbox.grid(row=1, column=0, sticky=tk.NSEW, padx=(0, 10))
+                                 exportselection=False, width=22,
+                                 yscrollcommand=lambda first, last: self.on_font_list_scroll(font_scrollbar, first, last))
+        font_listbox.pack(side=tk.LEFT, fill=tk.Y)
+        self.font_preview = tk.Canvas(list_frame, bg=self.menu_bg, bd=0, highlightthickness=0, width=180)
+        self.font_preview.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        font_scrollbar.config(command=font_listbox.yview)
+        self.font_listbox = font_listbox
         
-        fonts = ["Ubuntu Mono", "Consolas", "Courier New", "Arial", "Times New Roman", 
-                "Verdana", "Tahoma", "Georgia", "Comic Sans MS", "Impact"]
-        
-        for f in fonts:
-            font_listbox.insert(tk.END, f)
-        
-        try:
-            index = fonts.index(self.default_font_family)
-            font_listbox.select_set(index)
-            font_listbox.see(index)
-        except ValueError:
-            pass
+        self.font_status = tk.Label(main_frame, bg=self.bg_color, fg=self.fg_color, font=("Ubuntu", 9), anchor=tk.W)
+        self.font_status.grid(row=3, column=0, sticky=tk.W)
         
         tk.Label(main_frame, text="Размер:", bg=self.bg_color, fg=self.fg_color,
                 font=("Ubuntu", 10)).grid(row=0, column=1, sticky=tk.W, pady=5)
@@ -600,8 +5187,8 @@ class TextEditor:
         size_listbox = tk.Listbox(main_frame, bg=self.menu_bg, fg=self.fg_color,
                                  selectbackground=self.accent_color, bd=0,
                                  font=("Ubuntu", 10), highlightthickness=0,
-                                 exportselection=False)
-        size_listbox.grid(row=1, column=1, sticky=tk.NSEW)
+                                 exportselection=False, width=6)
+        size_listbox.grid(row=1, column=1, rowspan=2, sticky=tk.NSEW)
         
         sizes = [8, 9, 10, 11, 12, 14, 16, 18, 20, 22, 24, 26, 28, 36, 48, 72]
         for s in sizes:
@@ -615,7 +5202,7 @@ class TextEditor:
             size_listbox.select_set(4)
         
         button_frame = tk.Frame(main_frame, bg=self.bg_color)
-        button_frame.grid(row=2, column=0, columnspan=2, pady=10)
+        button_frame.grid(row=4, column=0, columnspan=2, pady=10)
         
         ok_btn = tk.Button(button_frame, text="OK", command=lambda: self.apply_font_selection(
             font_listbox, size_listbox, font_window), bg=self.accent_color, fg=self.fg_color,
@@ -627,23 +5214,126 @@ class TextEditor:
                               font=("Ubuntu", 10), padx=20, pady=2, highlightthickness=0)
         cancel_btn.pack(side=tk.LEFT, padx=5)
         
-        main_frame.grid_rowconfigure(1, weight=1)
+        main_frame.grid_rowconfigure(2, weight=1)
         main_frame.grid_columnconfigure(0, weight=1)
-        main_frame.grid_columnconfigure(1, weight=1)
+        
+        self.font_choice = self.default_font_family
+        font_listbox.bind('<<ListboxSelect>>', self.on_font_select)
+        for widget in (font_listbox, self.font_preview):
+            widget.bind('<Configure>', lambda e: self.schedule_font_previews())
+        self.font_preview.bind('<MouseWheel>', lambda e: font_listbox.yview_scroll(-1 if e.delta > 0 else 1, "units"))
+        self.font_preview.bind('<Button-4>', lambda e: font_listbox.yview_scroll(-1, "units"))
+        self.font_preview.bind('<Button-5>', lambda e: font_listbox.yview_scroll(1, "units"))
+        self.font_preview.bind('<Button-1>', lambda e: self.on_font_preview_click(e.y))
+        font_window.bind('<Destroy>', self.on_font_window_destroy)
+        self.font_filter_var.trace_add("write", lambda *args: self.fill_font_list())
+        self.fill_font_list()
+        self.refresh_font_catalog()
+        filter_entry.focus_set()
         
         font_window.protocol("WM_DELETE_WINDOW", font_window.destroy)
     
+    def refresh_font_catalog(self):
+        if self.font_catalog.refresh() and self.font_job is None:
+            self.font_job = self.root.after(FONT_POLL_MS, self.poll_font_catalog)
+    
+    def poll_font_catalog(self):
+        self.font_job = None
+        changed = self.font_catalog.poll(self.root)
+        if changed is None:
+            self.font_job = self.root.after(FONT_POLL_MS, self.poll_font_catalog)
+        elif self.font_window is not None:
+            if changed:
+                self.fill_font_list()
+            else:
+                self.update_font_status()
+    
+    def update_font_status(self):
+        if self.font_catalog.refreshing:
+            self.font_status.config(text="Список шрифтов обновляется...")
+        else:
+            self.font_status.config(text=f"Шрифтов: {self.font_listbox.size()} из {len(self.font_catalog.families)}")
+    
+    def fill_font_list(self):
+        # Без кэша, пока идет первое обновление, в списке только текущий шрифт
+        names = self.font_catalog.matching(self.font_filter_var.get())
+        if not self.font_catalog.families:
+            names = [self.default_font_family]
+        self.font_names = names
+        self.font_listbox.delete(0, tk.END)
+        if names:
+            self.font_listbox.insert(tk.END, *names)
+        if self.font_choice in names:
+            index = names.index(self.font_choice)
+            self.font_listbox.select_set(index)
+            self.font_listbox.see(index)
+        self.update_font_status()
+        self.schedule_font_previews()
+    
+    def on_font_select(self, event=None):
+        selection = self.font_listbox.curselection()
+        if selection:
+            self.font_choice = self.font_names[selection[0]]
+    
+    def on_font_list_scroll(self, scrollbar, first, last):
+        scrollbar.set(first, last)
+        self.schedule_font_previews()
+    
+    def schedule_font_previews(self):
+        if self.font_preview_job is None:
+            self.font_preview_job = self.root.after_idle(self.draw_font_previews)
+    
+    def draw_font_previews(self):
+        # Образец рисуется на высоте своей строки списка; шрифт загружается
+        # только для строк, которые видны сейчас
+        self.font_preview_job = None
+        if self.font_window is None:
+            return
+        canvas = self.font_preview
+        listbox = self.font_listbox
+        canvas.delete("all")
+        if not listbox.size():
+            return
+        first = listbox.nearest(0)
+        last = listbox.nearest(listbox.winfo_height())
+        for index in range(first, last + 1):
+            box = listbox.bbox(index)
+            if box is None:
+                continue
+            x, y, width, height = box
+            canvas.create_text(6, y + height // 2, text=FONT_PREVIEW_TEXT, anchor=tk.W, fill=self.fg_color,
+                               font=(self.font_names[index], FONT_PREVIEW_SIZE))
+    
+    def on_font_preview_click(self, y):
+        index = self.font_listbox.nearest(y)
+        if 0 <= index < self.font_listbox.size():
+            self.font_listbox.selection_clear(0, tk.END)
+            self.font_listbox.select_set(index)
+            self.on_font_select()
+    
+    def on_font_window_destroy(self, event):
+        if event.widget is self.font_window:
+            self.font_window = None
+            if self.font_preview_job is not None:
+                self.root.after_cancel(self.font_preview_job)
+                self.font_preview_job = None
+    
     def apply_font_selection(self, font_listbox, size_listbox, window):
         try:
-            font_family = font_listbox.get(font_listbox.curselection()[0])
+            # Фильтр может скрыть выбранный шрифт и снять выделение в списке,
+            # поэтому выбор берется из font_choice
+            font_family = self.font_choice or font_listbox.get(font_listbox.curselection()[0])
             font_size = int(size_listbox.get(size_listbox.curselection()[0]))
             
-            self.default_font_family = font_family
-            self.default_font_size = font_size
-            
-            self.text_area.configure(font=(font_family, font_size))
-            
-            self.save_settings()
+            # Смена шрифта перекладывает весь текст виджета - без изменений она не нужна
+            if (font_family, font_size) != (self.default_font_family, self.default_font_size):
+                self.default_font_family = font_family
+                self.default_font_size = font_size
+                
+                self.text_area.configure(font=(font_family, font_size))
+                self.refresh.mark("gutter")
+                
+                self.save_settings()
             
             window.destroy()
         except IndexError:
@@ -651,6 +5341,64 @@ class TextEditor:
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось применить шрифт: {str(e)}")
     
+    def toggle_profiling(self):
+        if self.profiling_var.get():
+            PROFILER.enable(self.root)
+            self.status_bar.config(text="Профилирование включено")
+        else:
+            PROFILER.disable(self.root)
+            self.status_bar.config(text="Профилирование выключено")
+    
+    def show_profile_window(self):
+        if self.profile_window is not None:
+            self.profile_window.lift()
+            return
+        self.profile_window = tk.Toplevel(self.root)
+        self.profile_window.title("Профиль")
+        self.profile_window.configure(bg=self.bg_color)
+        self.profile_window.attributes("-topmost", True)
+        self.profile_window.protocol("WM_DELETE_WINDOW", self.close_profile_window)
+        self.profile_label = tk.Label(self.profile_window, text="", bg=self.bg_color, fg=self.fg_color,
+                                      font=("Ubuntu Mono", 9), justify=tk.LEFT, anchor=tk.NW, padx=10, pady=10)
+        self.profile_label.pack(fill=tk.BOTH, expand=True)
+        self.refresh_profile_window()
+    
+    def close_profile_window(self):
+        if self.profile_job is not None:
+            self.root.after_cancel(self.profile_job)
+            self.profile_job = None
+        self.profile_window.destroy()
+        self.profile_window = None
+    
+    def refresh_profile_window(self):
+        # Самые затратные операции по суммарному времени последних замеров
+        self.profile_job = None
+        if self.profile_window is None:
+            return
+        if not PROFILER.enabled:
+            text = "Профилирование выключено (Сервис - Профилирование)"
+        else:
+            report = sorted(PROFILER.report().items(), key=lambda item: item[1]["total_ms"], reverse=True)
+            lines = [f"{'операция':<40} {'вызовов':>8} {'p50 мс':>8} {'p90 мс':>8} {'p99 мс':>8} {'макс':>8} {'Tk':>7}"]
+            for name, row in report[:PROFILE_OVERLAY_ROWS]:
+                lines.append(f"{name[-40:]:<40} {row['count']:>8} {row['p50_ms']:>8.2f} {row['p90_ms']:>8.2f} "
+                             f"{row['p99_ms']:>8.2f} {row['max_ms']:>8.2f} {row['tk_calls']:>7.1f}")
+            text = "\n".join(lines)
+        self.profile_label.config(text=text)
+        self.profile_job = self.root.after(PROFILE_OVERLAY_MS, self.refresh_profile_window)
+    
+    def export_profile(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
+        if not file_path:
+            return
+        try:
+            with open(file_path, 'w', encoding='utf-8') as f:
+                json.dump({"time": time.time(), "ring_size": PROFILE_RING_SIZE,
+                           "operations": PROFILER.report()}, f, ensure_ascii=False, indent=2)
+            self.status_bar.config(text=f"Профиль сохранен: {file_path}")
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось сохранить профиль:\n{str(e)}")
+    
     def about_program(self):
         about_window = tk.Toplevel(self.root)
         about_window.title("О программе")
@@ -788,7 +5536,18 @@ class TextEditor:
         
         dev_window.protocol("WM_DELETE_WINDOW", dev_window.destroy)
 
+instrument(TextEditor)
+instrument(SyntaxHighlighter, {"run"})
+instrument(FileLoader, {"_step"})
+instrument(PasteInserter, {"_step"})
+instrument(LargeFileView, {"render"})
+instrument(RefreshScheduler, {"run"})
+instrument(BackgroundSaver, {"submit"})
+
 if __name__ == "__main__":
+    # С аргументами командной строки - пакетный режим без окна
+    if len(sys.argv) > 1:
+        sys.exit(run_batch(sys.argv[1:]))
     root = tk.Tk()
     app = TextEditor(root)
     root.mainloop()